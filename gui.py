@@ -13,6 +13,13 @@ from widgets import FlowPath, ElveflowDisplay, MiscLogger, COMPortSelector, Cons
 import tkinter.ttk as ttk
 import time
 from hardware import FileIO
+from hardware.SteadyState import is_steady
+from widgets.BlitRenderer import BlitRenderer
+from hardware.ExposureLog import ExposureSummaryLog
+from hardware.AnomalyDetection import AnomalyDetector, elveflow_rules
+from hardware.FlowSupervisor import SheathFlowSupervisor, NO_DATA, STEADY, OFF_TARGET
+from collections import deque
+from concurrent.futures import TimeoutError as FutureTimeout, CancelledError
 from configparser import ConfigParser
 import logging
 import winsound
@@ -62,6 +69,9 @@ class Main:
         self.adxIsDone = False
         self.illegal_chars = '!@#$%^&*()."\\|:;<>?=~ ' + "'"
         self.sheathflow_tolerance = 1
+        self.sheathflow_window = 5  # seconds of sheath flow history checked for steady state
+        self.sample_flow_tolerance = 1  # µL/min
+        self.equilibration_window = 3  # seconds of steady flow needed before an adaptive equilibration is over
         self.old_base_directory = '/mnt/currentdaq/BioSAXS/'
         self.old_sub_directory = ''
         self.main_window.attributes("-fullscreen", True)  # Makes the window fullscreen
@@ -137,7 +147,7 @@ class Main:
         self.purge_soap_button = tk.Button(self.auto_page, text='Purge Soap', command=self.purge_soap_command, font=auto_button_font, width=auto_button_width)
         self.purge_dry_button = tk.Button(self.auto_page, text='Dry Sheath', command=self.purge_dry_command, font=auto_button_font, width=auto_button_width)
         self.initialize_sheath_button = tk.Button(self.auto_page, text='Initialize\nSheath', command=self.initialize_sheath_command, font=auto_button_font, width=auto_button_width)
-        self.initialize_sheath_display_var = tk.StringVar(value='Sheath pressure:\n--')
+        self.initialize_sheath_display_var = tk.StringVar(value='Sheath flow:\n--')
         self.initialize_sheath_display = tk.Label(self.auto_page, textvariable=self.initialize_sheath_display_var, font=auto_button_half_font, bg=self.label_bg_color)
         # Elveflow Plots
         self.fig_dpi = 96  # this shouldn't matter too much (because we normalize against it) except in how font sizes are handled in the plot
@@ -149,6 +159,11 @@ class Main:
         self.graph_end_time = np.inf
         self.canvas = matplotlib.backends.backend_tkagg.FigureCanvasTkAgg(self.main_tab_fig, self.auto_page)
         self.canvas.draw()
+        # queue threads only ask for redraws (update_graph, graph_vline); the renderer does them on the main loop
+        self.graph_renderer = BlitRenderer(self.main_window, self.canvas, self.render_graph)
+        self.pending_vlines = deque()
+        self.clear_graph()
+        self.graph_renderer.start()
         # Manual Page
         self.manual_button_font = 'Arial 10 bold'
         self.tseries_button = tk.Button(self.manual_page, text='Take t-series', command=self.run_tseries, font=auto_button_font, width=auto_button_width+2)
@@ -186,6 +201,12 @@ class Main:
         self.sample_eq_volume_box = tk.Entry(self.config_page, textvariable=self.sample_eq_volume)
         self.last_buffer_eq_volume = tk.IntVar(value=1)      # May need to be a doublevar
         self.last_buffer_eq_volume_box = tk.Entry(self.config_page, textvariable=self.last_buffer_eq_volume)
+        self.adaptive_eq = tk.BooleanVar(value=False)
+        self.adaptive_eq_checkbutton = tk.Checkbutton(self.config_page, text='Start exposures once flow is steady\n(equilibration volumes are the maximum)', variable=self.adaptive_eq, bg=self.label_bg_color)
+        self.abort_on_clog = tk.BooleanVar(value=False)
+        self.abort_on_clog_checkbutton = tk.Checkbutton(self.config_page, text='Abort the run if\nthe flow clogs', variable=self.abort_on_clog, bg=self.label_bg_color)
+        self.correct_sheath = tk.BooleanVar(value=False)
+        self.correct_sheath_checkbutton = tk.Checkbutton(self.config_page, text='Reset the sheath flow between\nsteps if it has drifted', variable=self.correct_sheath, bg=self.label_bg_color)
         self.sample_flowrate_label = tk.Label(self.config_page, text="Sample-Buffer Infuse flowrate (µL/min)", bg=self.label_bg_color)
         self.sample_flowrate = tk.DoubleVar(value=10)
         self.sample_flowrate_box = tk.Entry(self.config_page, textvariable=self.sample_flowrate)
@@ -307,6 +328,9 @@ class Main:
         self.elveflow_sheath_volume = tk.StringVar()
         self.elveflow_sheath_channel_box = tk.Entry(self.config_page, textvariable=self.elveflow_sheath_channel)
         self.elveflow_sheath_volume_box = tk.Entry(self.config_page, textvariable=self.elveflow_sheath_volume)
+        self.elveflow_sample_channel_label = tk.Label(self.config_page, text='Elveflow sample flow sensor channel (blank for none)', bg=self.label_bg_color)
+        self.elveflow_sample_channel = tk.StringVar()
+        self.elveflow_sample_channel_box = tk.Entry(self.config_page, textvariable=self.elveflow_sample_channel)
 
         # Make Instrument
         self.AvailablePorts = []#SAXSDrivers.list_available_ports()
@@ -357,6 +381,22 @@ class Main:
         self.refresh_dropdown(self.cerberus_loading_valve_name_boxes, self.flowpath.valve8.gui_names, self.cerberus_loading_valve_names)
         self.draw_static()
         self.elveflow_display = ElveflowDisplay(self.elveflow_page, core_height, core_width, self.config['Elveflow'], self.python_logger, self)
+        # one row of flow conditions per SPEC exposure, for reduction to reject frames taken with bad flow
+        self.exposure_log = ExposureSummaryLog(lambda: self.elveflow_display.data,
+                                               os.path.join(ElveflowDisplay.OUTPUT_FOLDER, "exposures_%d.csv" % time.time()), self.python_logger)
+        # bubbles, clogs and pressure spikes, caught as the Elveflow samples come in rather than on the graph
+        self.anomaly_detector = AnomalyDetector(FileIO.ELVEFLOW_DATA_COLUMNS, callbacks=[self.flow_anomaly], errorlogger=self.python_logger)
+        # the sheath flow, watched all the time instead of only just before a run
+        self.sheath_supervisor = SheathFlowSupervisor(lambda: self.elveflow_display.data, tolerance=self.sheathflow_tolerance,
+                                                      window=self.sheathflow_window, errorlogger=self.python_logger)
+        self.sheath_supervisor.add_listener(self.sheath_flow_changed)
+        self.configure_flow_monitoring()
+        for var in (self.elveflow_sheath_channel, self.elveflow_sheath_volume, self.elveflow_sample_channel, self.sample_flowrate, self.elveflow_oil_channel):
+            var.trace('w', lambda *_: self.configure_flow_monitoring())
+        self.anomaly_detector.start()
+        self.elveflow_display.anomaly_detector = self.anomaly_detector
+        self.sheath_supervisor.start()
+        self.show_sheath_status()
         self.elveflow_display.grid(row=0, column=0)
         self.queue = solocomm.controlQueue
         self.manual_queue = solocomm.ManualControlQueue
@@ -446,11 +486,14 @@ class Main:
         self.first_buffer_eq_volume_box.grid(row=rowcounter, column=1, sticky=tk.W+tk.E+tk.N+tk.S)
         self.sample_eq_volume_box.grid(row=rowcounter, column=2, sticky=tk.W+tk.E+tk.N+tk.S)
         self.last_buffer_eq_volume_box.grid(row=rowcounter, column=3, sticky=tk.W+tk.E+tk.N+tk.S)
+        self.adaptive_eq_checkbutton.grid(row=rowcounter, column=4, columnspan=2, sticky=tk.W+tk.E+tk.N+tk.S)
+        self.abort_on_clog_checkbutton.grid(row=rowcounter, column=6, columnspan=2, sticky=tk.W+tk.E+tk.N+tk.S)
         rowcounter += 1
         self.sample_flowrate_label.grid(row=rowcounter, column=0, sticky=tk.W+tk.E+tk.N+tk.S)
         self.sample_flowrate_box.grid(row=rowcounter, column=1, sticky=tk.W+tk.E+tk.N+tk.S)
         self.oil_refill_flowrate_label.grid(row=rowcounter, column=2, sticky=tk.W+tk.E+tk.N+tk.S)
         self.oil_refill_flowrate_box.grid(row=rowcounter, column=3, sticky=tk.W+tk.E+tk.N+tk.S)
+        self.correct_sheath_checkbutton.grid(row=rowcounter, column=6, columnspan=2, sticky=tk.W+tk.E+tk.N+tk.S)
         self.cerberus_refill_rate_label.grid(row=rowcounter, column=4, sticky=tk.W+tk.E+tk.N+tk.S)
         self.cerberus_refill_rate_box.grid(row=rowcounter, column=5, sticky=tk.W+tk.E+tk.N+tk.S)
         rowcounter += 1
@@ -499,6 +542,9 @@ class Main:
         self.elveflow_sheath_channel_box.grid(row=rowcounter, column=1, sticky=tk.W+tk.E+tk.N+tk.S)
         self.elveflow_sheath_volume_box.grid(row=rowcounter, column=2, sticky=tk.W+tk.E+tk.N+tk.S)
         rowcounter += 1
+        self.elveflow_sample_channel_label.grid(row=rowcounter, column=0, sticky=tk.W+tk.E+tk.N+tk.S)
+        self.elveflow_sample_channel_box.grid(row=rowcounter, column=1, sticky=tk.W+tk.E+tk.N+tk.S)
+        rowcounter += 1
         self.tseries_label.grid(row=rowcounter, column=0, sticky=tk.W+tk.E+tk.N+tk.S)
         self.tseries_time_box.grid(row=rowcounter, column=2, sticky=tk.W+tk.E+tk.N+tk.S)
         self.tseries_frames_box.grid(row=rowcounter, column=1, sticky=tk.W+tk.E+tk.N+tk.S)
@@ -621,6 +667,7 @@ class Main:
         cerberus_loading_config = self.config['Cerberus Loading Valve']
         # Main Config
         self.sucrose = main_config.getboolean('Sucrose', False)
+        self.controller.trace.fsync_interval = main_config.getfloat('trace_fsync_interval', self.controller.trace.fsync_interval)
         self.color_sucrose_button()
         # Elveflow Config
         self.elveflow_sourcename.set(elveflow_config.get('elveflow_sourcename', b''))
@@ -632,6 +679,7 @@ class Main:
         self.elveflow_oil_pressure.set(elveflow_config.get('elveflow_oil_pressure', 0))
         self.elveflow_sheath_channel.set(elveflow_config.get('elveflow_sheath_channel', -1))
         self.elveflow_sheath_volume.set(elveflow_config.get('elveflow_sheath_volume', 0))
+        self.elveflow_sample_channel.set(elveflow_config.get('elveflow_sample_channel', ''))
         # SPEC Config
         self.spec_address.set(spec_config.get('spec_host', ''))
         self.tseries_time.set(spec_config.get('tseries_time', '10'))
@@ -651,6 +699,9 @@ class Main:
         self.first_buffer_eq_volume.set(run_config.get('buffer1_eq_vol', 0))
         self.sample_eq_volume.set(run_config.get('sample_eq_vol', 0))
         self.last_buffer_eq_volume.set(run_config.get('buffer2_eq_vol', 0))
+        self.adaptive_eq.set(run_config.getboolean('adaptive_eq', False))
+        self.abort_on_clog.set(run_config.getboolean('abort_on_clog', False))
+        self.correct_sheath.set(run_config.getboolean('correct_sheath', False))
         self.low_soap_time.set(run_config.get('low_soap_time', 0))
         self.high_soap_time.set(run_config.get('high_soap_time', 0))
         self.water_time.set(run_config.get('water_time', 0))
@@ -740,6 +791,7 @@ class Main:
             elveflow_config['elveflow_oil_pressure'] = self.elveflow_oil_pressure.get()
             elveflow_config['elveflow_sheath_channel'] = self.elveflow_sheath_channel.get()
             elveflow_config['elveflow_sheath_volume'] = self.elveflow_sheath_volume.get()
+            elveflow_config['elveflow_sample_channel'] = self.elveflow_sample_channel.get()
             # SPEC Config
             spec_config['spec_host'] = self.spec_address.get()
             spec_config['tseries_time'] = str(self.tseries_time.get())
@@ -757,6 +809,9 @@ class Main:
             run_config['buffer1_eq_vol'] = str(self.first_buffer_eq_volume.get())
             run_config['sample_eq_vol'] = str(self.sample_eq_volume.get())
             run_config['buffer2_eq_vol'] = str(self.last_buffer_eq_volume.get())
+            run_config['adaptive_eq'] = str(self.adaptive_eq.get())
+            run_config['abort_on_clog'] = str(self.abort_on_clog.get())
+            run_config['correct_sheath'] = str(self.correct_sheath.get())
             run_config['low_soap_time'] = str(self.low_soap_time.get())
             run_config['high_soap_time'] = str(self.high_soap_time.get())
             run_config['water_time'] = str(self.water_time.get())
@@ -850,6 +905,7 @@ class Main:
             self.solo_controller.ADXComm.tryReconnect(TryOnce=True, host=self.spec_address.get())
         except AttributeError:
             self.solo_controller = solocomm.initConnections(self, host=self.spec_address.get())
+            self.solo_controller.ADXComm.exposure_listener = self.exposure_log
 
     def start_manual_thread(self):
         """ Creates the thread for running instruments separate from auto thread"""
@@ -882,6 +938,9 @@ class Main:
             # even its first line of code. But hopefully that doesn't happen often
             print("STARTING EXIT PROCEDURE")
             self.stop()
+            self.anomaly_detector.stop()
+            self.sheath_supervisor.stop()
+            self.controller.trace.close(timeout=2)
             self.elveflow_display.stop(shutdown=True)
             # now that we've finished telling it to shut down, we can release the lock and
             # let the elveflow display run again
@@ -895,47 +954,65 @@ class Main:
         print("THANK Y'ALL FOR COMING! A LA PROCHAINE !")
         self.main_window.destroy()
 
-    def update_graph(self):
-        """Look into self's ElveflowDisplay and reproduce it on self.main_tab_fig."""
+    def clear_graph(self):
+        """Empty self.main_tab_fig, e.g. before a new scan. Main loop only."""
+        self.main_tab_ax1.clear()
+        self.main_tab_ax2.clear()
+        self.main_tab_ax3.clear()
+        self.main_tab_ax3.spines["right"].set_position(("outward", 60)) # offset second right axis
         self.main_tab_ax1.set_title("Elveflow readout for most recent scan", fontsize=16)
+        self.the_line1 = self.main_tab_ax1.plot([], [], color=ElveflowDisplay.COLOR_Y1)[0]
+        self.the_line2 = self.main_tab_ax2.plot([], [], color=ElveflowDisplay.COLOR_Y2)[0]
+        self.the_line3 = self.main_tab_ax3.plot([], [], color=ElveflowDisplay.COLOR_Y3)[0]
+        self.graph_renderer.clear_artists()
+        for line in (self.the_line1, self.the_line2, self.the_line3):
+            self.graph_renderer.add_artist(line)
+        self.graph_labels = None
+        self.graph_limits = None
+        self.graph_renderer.request(full=True)
+
+    def update_graph(self):
+        """Redraw self.main_tab_fig soon. Safe to call from any thread."""
+        self.graph_renderer.request()
+
+    def render_graph(self):
+        """Look into self's ElveflowDisplay and reproduce it on self.main_tab_fig.
+        This is self.graph_renderer's prepare step: returns whether the axes changed (not just the lines)."""
+        redraw_axes = False
         data_x_label_var = self.elveflow_display.data_x_label_var.get()
         data_y1_label_var = self.elveflow_display.data_y1_label_var.get()
         data_y2_label_var = self.elveflow_display.data_y2_label_var.get()
         data_y3_label_var = self.elveflow_display.data_y3_label_var.get()
-        self.main_tab_ax1.set_xlabel(data_x_label_var, fontsize=14)
-        self.main_tab_ax1.set_ylabel(data_y1_label_var, fontsize=14, color=ElveflowDisplay.COLOR_Y1)
-        self.main_tab_ax2.set_ylabel(data_y2_label_var, fontsize=14, color=ElveflowDisplay.COLOR_Y2)
-        self.main_tab_ax3.set_ylabel(data_y3_label_var, fontsize=14, color=ElveflowDisplay.COLOR_Y3)
+        labels = (data_x_label_var, data_y1_label_var, data_y2_label_var, data_y3_label_var)
+        if labels != self.graph_labels:
+            self.main_tab_ax1.set_xlabel(data_x_label_var, fontsize=14)
+            self.main_tab_ax1.set_ylabel(data_y1_label_var, fontsize=14, color=ElveflowDisplay.COLOR_Y1)
+            self.main_tab_ax2.set_ylabel(data_y2_label_var, fontsize=14, color=ElveflowDisplay.COLOR_Y2)
+            self.main_tab_ax3.set_ylabel(data_y3_label_var, fontsize=14, color=ElveflowDisplay.COLOR_Y3)
+            self.graph_labels = labels
+            redraw_axes = True
+        while self.pending_vlines:
+            x, color = self.pending_vlines.popleft()
+            self.graph_renderer.add_artist(self.main_tab_ax1.axvline(x, color=color, linewidth=5))
+        if self.elveflow_display.elveflow_handler is None:
+            return redraw_axes  # not connected, so there's no data to show
         try:
-            # read it once to avoid a race condition here when reading from
-            # self.elveflow_display.data at the same time as it gets data from the machine
-            elveflow_display_data = self.elveflow_display.data.copy()
-            data_x = np.array([elt[data_x_label_var] for elt in elveflow_display_data])
-            data_y1 = np.array([elt[data_y1_label_var] for elt in elveflow_display_data])
-            data_y2 = np.array([elt[data_y2_label_var] for elt in elveflow_display_data])
-            data_y3 = np.array([elt[data_y3_label_var] for elt in elveflow_display_data])
-
-            data_x_viable = (data_x >= self.graph_start_time)  # & (data_x < self.graph_end_time)
-            data_x = data_x[data_x_viable]
-            data_y1 = data_y1[data_x_viable]
-            data_y2 = data_y2[data_x_viable]
-            data_y3 = data_y3[data_x_viable]
-
-            if data_x_label_var == self.elveflow_display.elveflow_handler.header[0]:
-                data_x -= self.elveflow_display.starttime
-            if data_y1_label_var == self.elveflow_display.elveflow_handler.header[0]:
-                data_y1 -= self.elveflow_display.starttime
-            if data_y2_label_var == self.elveflow_display.elveflow_handler.header[0]:
-                data_y2 -= self.elveflow_display.starttime
-            if data_y3_label_var == self.elveflow_display.elveflow_handler.header[0]:
-                data_y3 -= self.elveflow_display.starttime
-
-            extremes = [np.nanmin(data_x), np.nanmax(data_x), np.nanmin(data_y1), np.nanmax(data_y1),
-                np.nanmin(data_y2), np.nanmax(data_y2), np.nanmin(data_y3), np.nanmax(data_y3)]
-            if len(data_x) > 0:
-                self.the_line1.set_data(data_x, data_y1)
-                self.the_line2.set_data(data_x, data_y2)
-                self.the_line3.set_data(data_x, data_y3)
+            # zero-copy views of only the rows since the graph started, found by binary search on the time
+            first, columns = self.elveflow_display.data.window(self.graph_start_time, None, *labels)
+            time_label = self.elveflow_display.elveflow_handler.header[0]
+            offsets = [self.elveflow_display.starttime if label == time_label else 0 for label in labels]
+            # fmin/fmax skip NaNs, and raise ValueError if there's no data yet
+            extremes = []
+            for column, offset in zip(columns, offsets):
+                extremes += [np.fmin.reduce(column) - offset, np.fmax.reduce(column) - offset]
+            if len(columns[0]) > 0:
+                # about two points per pixel is plenty, as long as each keeps its spikes and dips.
+                # The pyramids are shared with the Elveflow tab's plot
+                n_buckets = max(int(self.main_tab_ax1.bbox.width), 1)
+                rows = (first, first + len(columns[0]))
+                for (line, y_label, y_offset) in ((self.the_line1, data_y1_label_var, offsets[1]), (self.the_line2, data_y2_label_var, offsets[2]), (self.the_line3, data_y3_label_var, offsets[3])):
+                    x, y = self.elveflow_display.decimation.view(data_x_label_var, y_label, n_buckets=n_buckets, x_sorted=False, rows=rows)
+                    line.set_data(x - offsets[0], y - y_offset)
         except (ValueError, KeyError):
             extremes = [*self.main_tab_ax1.get_xlim(), *self.main_tab_ax1.get_ylim(),
                 *self.main_tab_ax2.get_ylim(), *self.main_tab_ax3.get_ylim()]
@@ -949,16 +1026,90 @@ class Main:
             extremes[7] += 1
         limits = [item if item is not None else extremes[i]
                   for (i, item) in enumerate(self.elveflow_display.axisLimits_numbers)]
-        self.main_tab_ax1.set_xlim(*extremes[0:2])
-        self.main_tab_ax1.set_ylim(*limits[2:4])
-        self.main_tab_ax2.set_ylim(*limits[4:6])
-        self.main_tab_ax3.set_ylim(*limits[6:8])
+        limits[0:2] = extremes[0:2]
+        if limits != self.graph_limits:
+            self.main_tab_ax1.set_xlim(*limits[0:2])
+            self.main_tab_ax1.set_ylim(*limits[2:4])
+            self.main_tab_ax2.set_ylim(*limits[4:6])
+            self.main_tab_ax3.set_ylim(*limits[6:8])
+            self.graph_limits = limits
+            redraw_axes = True
+        return redraw_axes
+
+    def graph_vline(self, color='k', when=None):
+        """Add a vertical line to the graph, at the time when (by default, now). Safe to call from any thread."""
+        when = time.time() if when is None else when
+        self.pending_vlines.append((int(when - self.elveflow_display.starttime), color))
+        self.graph_renderer.request()
+
+    def configure_flow_monitoring(self):
+        """point the anomaly detector and the sheath supervisor at the configured sheath, sample and oil channels"""
+        flow_channels, pressure_channels, expected_flowrates = [], [], {}
+        try:
+            sheath_channel = int(self.elveflow_sheath_channel.get())
+            flow_channels.append(sheath_channel)
+            pressure_channels.append(sheath_channel)
+            expected_flowrates[sheath_channel] = float(self.elveflow_sheath_volume.get())
+            self.sheath_supervisor.set_setpoint(sheath_channel, expected_flowrates[sheath_channel])
+            if self.elveflow_sample_channel.get().strip() != '':
+                sample_channel = int(self.elveflow_sample_channel.get())
+                flow_channels.append(sample_channel)
+                expected_flowrates[sample_channel] = float(self.sample_flowrate.get())
+            pressure_channels.append(int(self.elveflow_oil_channel.get()))
+            self.anomaly_detector.set_rules(elveflow_rules(flow_channels, pressure_channels, expected_flowrates))
+            # no flow only means a clog while the flow is supposed to be on
+            self.anomaly_detector.set_armed('Volume flow rate %i [µL/min]' % sheath_channel,
+                                            lambda: self.elveflow_display.flow_set.get(sheath_channel) is not None)
+            if self.elveflow_sample_channel.get().strip() != '':
+                self.anomaly_detector.set_armed('Volume flow rate %i [µL/min]' % sample_channel, self.sample_pump_infusing)
+        except (ValueError, KeyError, tk.TclError) as e:
+            # also happens halfway through typing a channel in, so don't make a fuss
+            self.python_logger.debug("Flow monitoring is not set up for the configured Elveflow channels (%s)" % e)
+
+    def sample_pump_infusing(self):
+        """whether the sample pump is infusing a volume right now (from the completion tracker, without asking the pump)"""
+        pump = self.pump
+        if pump is None or pump.completion is None:
+            return False
+        return pump.infusing and not pump.completion.done()
+
+    def flow_anomaly(self, anomaly):
+        """called by the anomaly detector (on its own thread) for every bubble, clog or pressure spike"""
+        self.python_logger.warning("%s in %s at %s: %.1f (score %.1f)" % (anomaly.kind.capitalize(), anomaly.column,
+                                   time.strftime('%H:%M:%S', time.localtime(anomaly.time)), anomaly.value, anomaly.score))
+        self.graph_vline('red', when=anomaly.time)
+        if anomaly.kind == 'clog' and self.abort_on_clog.get() and self.queue_busy:
+            self.python_logger.warning("Aborting the run because the flow clogged")
+            # stop the pumps right away, like the Abort button: the queue is probably waiting for the pump to finish
+            # its volume, and would only notice abortProcess once it had
+            self.stop()
+            self.solo_controller.ADXComm.abort()
+
+    def sheath_flow_changed(self, supervisor, old_status, status):
+        """called by the sheath supervisor (on its own thread) whenever the sheath flow status changes"""
+        mean, std, _ = supervisor.flow_stats
+        message = "Sheath flow is %s (%.2f ± %.2f µL/min)" % (status, mean, std)
+        if status == OFF_TARGET and self.queue_busy:
+            self.python_logger.warning(message)
+            self.graph_vline('orange')
+        else:
+            self.python_logger.debug(message)
 
-        self.canvas.draw()  # may need the stupid hack from widgets.py
+    def show_sheath_status(self):
+        """refresh the sheath flow indicator on the Auto tab, then again a second later"""
+        status = self.sheath_supervisor.status
+        if status == NO_DATA:
+            self.initialize_sheath_display_var.set('Sheath flow:\n--')
+        else:
+            self.initialize_sheath_display_var.set('Sheath flow:\n%.2f µL/min' % self.sheath_supervisor.flow_stats[0])
+        colors = {NO_DATA: self.label_bg_color, STEADY: 'pale green', OFF_TARGET: 'tomato'}
+        self.initialize_sheath_display.configure(bg=colors.get(status, 'khaki'))
+        self.main_window.after(1000, self.show_sheath_status)
 
-    def graph_vline(self, color='k'):
-        """Add a vertical line to the graph."""
-        self.main_tab_ax1.axvline(int(time.time() - self.elveflow_display.starttime), color=color, linewidth=5)
+    def correct_sheath_flow(self):
+        """between the steps of a run: if enabled, bring the sheath flow back to its setpoint if it has drifted off"""
+        if self.correct_sheath.get() and self.elveflow_display.elveflow_handler is not None:
+            self.sheath_supervisor.correct(self.elveflow_display.run_volume)
 
     def auto_run_choice(self):
         self.queue.put((self.set_insert_purge, False))
@@ -1002,9 +1153,7 @@ class Main:
             else:
                 return
 
-        if np.abs(
-            self.elveflow_display.elveflow_handler.getVolume(int(self.elveflow_sheath_channel.get()))
-             - float(self.elveflow_sheath_volume.get()) ) > self.sheathflow_tolerance:
+        if not self.sheath_flow_is_steady():
          MsgBox = messagebox.askquestion('Warning', 'Sheath flow rate is not the expected sheath flow rate; continue with buffer/sample/buffer?', icon='warning')
          if MsgBox == 'yes':
              pass
@@ -1019,13 +1168,7 @@ class Main:
                 return
 
         # before scheduling anything, clear the graph
-        self.main_tab_ax1.clear()
-        self.main_tab_ax2.clear()
-        self.main_tab_ax3.clear()
-        self.main_tab_ax3.spines["right"].set_position(("outward", 60)) # offset second right axis
-        self.the_line1 = self.main_tab_ax1.plot([], [], color=ElveflowDisplay.COLOR_Y1)[0]
-        self.the_line2 = self.main_tab_ax2.plot([], [], color=ElveflowDisplay.COLOR_Y2)[0]
-        self.the_line3 = self.main_tab_ax3.plot([], [], color=ElveflowDisplay.COLOR_Y3)[0]
+        self.clear_graph()
         self.graph_start_time = int(time.time())
         self.graph_end_time = np.inf
         self.python_logger.debug("main page graph start time: %s" % self.graph_start_time)
@@ -1033,6 +1176,7 @@ class Main:
 
         self.update_graph()
         self.oil_refill_flag = False
+        equilibration_checks = self.equilibration_checks() if self.adaptive_eq.get() else None
 
         self.queue.put((self.python_logger.info, "Starting to run buffer-sample-buffer"))
         self.queue.put(self.update_graph)
@@ -1040,12 +1184,13 @@ class Main:
 
         # prebuffer
         self.queue.put((self.python_logger.info, "Starting to run pre-buffer"))
+        self.queue.put(self.correct_sheath_flow)
         self.queue.put((self.flowpath.valve2.set_auto_position, "Run"))
         self.queue.put((self.flowpath.valve3.set_auto_position, 0))
         self.queue.put((self.flowpath.valve4.set_auto_position, "Run"))
         self.queue.put((self.pump.infuse_volume, self.first_buffer_volume.get()/1000, self.sample_flowrate.get()))
         self.queue.put((self.python_logger.debug, f'Calculated equilibration time: {self.first_buffer_eq_volume.get()/self.sample_flowrate.get()*60}'))
-        self.queue.put((self.pump.wait_until_time, self.first_buffer_eq_volume.get()/self.sample_flowrate.get()*60, self.update_graph)) # wait some amount of time until stable
+        self.queue.put((self.wait_for_equilibration, self.first_buffer_eq_volume.get()/self.sample_flowrate.get()*60, equilibration_checks, self.update_graph)) # wait until stable, or at most some amount of time
         self.queue.put((self.graph_vline, 'chartreuse'))
         self.run_tseries(postfix="pre")
         self.queue.put((self.pump.wait_until_stopped, self.first_buffer_volume.get()/self.sample_flowrate.get()*60, self.update_graph)) # wait the remaining amount of time
@@ -1053,12 +1198,13 @@ class Main:
         # sample
         self.queue.put(self.graph_vline)
         self.queue.put((self.python_logger.info, "Starting to run sample"))
+        self.queue.put(self.correct_sheath_flow)
         self.queue.put((self.flowpath.valve2.set_auto_position, "Run"))
         self.queue.put((self.flowpath.valve3.set_auto_position, 1))
         self.queue.put((self.flowpath.valve4.set_auto_position, "Run"))
         self.queue.put((self.pump.infuse_volume, self.sample_volume.get()/1000, self.sample_flowrate.get()))
         self.queue.put((self.python_logger.debug, f'Calculated equilibration time: {self.first_buffer_eq_volume.get()/self.sample_flowrate.get()*60}'))
-        self.queue.put((self.pump.wait_until_time, self.sample_eq_volume.get()/self.sample_flowrate.get()*60, self.update_graph)) # wait some amount of time until stable
+        self.queue.put((self.wait_for_equilibration, self.sample_eq_volume.get()/self.sample_flowrate.get()*60, equilibration_checks, self.update_graph)) # wait until stable, or at most some amount of time
         self.queue.put((self.graph_vline, 'chartreuse'))
         self.run_tseries(postfix="sample")
         self.queue.put((self.pump.wait_until_stopped, self.sample_volume.get()/self.sample_flowrate.get()*60, self.update_graph))
@@ -1066,12 +1212,13 @@ class Main:
         # postbuffer
         self.queue.put(self.graph_vline)
         self.queue.put((self.python_logger.info, "Starting to run post-buffer"))
+        self.queue.put(self.correct_sheath_flow)
         self.queue.put((self.flowpath.valve2.set_auto_position, "Run"))
         self.queue.put((self.flowpath.valve3.set_auto_position, 0))
         self.queue.put((self.flowpath.valve4.set_auto_position, "Run"))
         self.queue.put((self.pump.infuse_volume, self.last_buffer_volume.get()/1000, self.sample_flowrate.get()))
         self.queue.put((self.python_logger.debug, f'Calculated equilibration time: {self.first_buffer_eq_volume.get()/self.sample_flowrate.get()*60}'))
-        self.queue.put((self.pump.wait_until_time, self.last_buffer_eq_volume.get()/self.sample_flowrate.get()*60, self.update_graph)) # wait some amount of time until stable
+        self.queue.put((self.wait_for_equilibration, self.last_buffer_eq_volume.get()/self.sample_flowrate.get()*60, equilibration_checks, self.update_graph)) # wait until stable, or at most some amount of time
         self.queue.put((self.graph_vline, 'chartreuse'))
         self.run_tseries(postfix="post")
         self.queue.put((self.pump.wait_until_stopped, self.last_buffer_volume.get()/self.sample_flowrate.get()*60, self.update_graph))
@@ -1114,9 +1261,7 @@ class Main:
             else:
                 return
 
-        if np.abs(
-                self.elveflow_display.elveflow_handler.getVolume(int(self.elveflow_sheath_channel.get()))
-                 - float(self.elveflow_sheath_volume.get()) ) > self.sheathflow_tolerance:
+        if not self.sheath_flow_is_steady():
              MsgBox = messagebox.askquestion('Warning', 'Sheath may not be running; continue with buffer/sample/buffer?', icon='warning')
              if MsgBox == 'yes':
                  pass
@@ -1131,13 +1276,7 @@ class Main:
                 return
 
         # before scheduling anything, clear the graph
-        self.main_tab_ax1.clear()
-        self.main_tab_ax2.clear()
-        self.main_tab_ax3.clear()
-        self.main_tab_ax3.spines["right"].set_position(("outward", 60)) # offset second right axis
-        self.the_line1 = self.main_tab_ax1.plot([], [], color=ElveflowDisplay.COLOR_Y1)[0]
-        self.the_line2 = self.main_tab_ax2.plot([], [], color=ElveflowDisplay.COLOR_Y2)[0]
-        self.the_line3 = self.main_tab_ax3.plot([], [], color=ElveflowDisplay.COLOR_Y3)[0]
+        self.clear_graph()
         self.graph_start_time = int(time.time())
         self.graph_end_time = np.inf
         self.python_logger.debug("main page graph start time: %s" % self.graph_start_time)
@@ -1152,6 +1291,7 @@ class Main:
         self.queue.put(self.elveflow_display.start_saving)
 
         self.queue.put((self.python_logger.info, "Starting to run pre-buffer"))
+        self.queue.put(self.correct_sheath_flow)
         # Start cerberus
         self.queue.put((self.flowpath.valve6.set_auto_position, "Run"))
         self.queue.put((self.flowpath.valve8.set_auto_position, "Run"))
@@ -1172,6 +1312,7 @@ class Main:
         self.queue.put(self.graph_vline)
         self.queue.put(self.update_graph)
         self.queue.put((self.python_logger.info, "Starting to run sample"))
+        self.queue.put(self.correct_sheath_flow)
         self.queue.put((self.flowpath.valve2.set_auto_position, "Run"))
         self.queue.put((self.flowpath.valve3.set_auto_position, 1))
         self.queue.put((self.flowpath.valve4.set_auto_position, "Run"))
@@ -1184,6 +1325,7 @@ class Main:
         self.queue.put(self.graph_vline)
         self.queue.put(self.update_graph)
         self.queue.put((self.python_logger.info, "Starting to run post-buffer"))
+        self.queue.put(self.correct_sheath_flow)
         self.queue.put((self.flowpath.valve2.set_auto_position, "Run"))
         self.queue.put((self.flowpath.valve3.set_auto_position, 0))
         self.queue.put((self.flowpath.valve4.set_auto_position, "Run"))
@@ -1232,9 +1374,7 @@ class Main:
             tk.messagebox.showinfo('Error', 'Filename is blank or contains invalid characters. \nThese include: %s (includes spaces).' % (self.illegal_chars))
             return
 
-        if np.abs(
-            self.elveflow_display.elveflow_handler.getVolume(int(self.elveflow_sheath_channel.get()))
-             - float(self.elveflow_sheath_volume.get()) ) > self.sheathflow_tolerance:
+        if not self.sheath_flow_is_steady():
          MsgBox = messagebox.askquestion('Warning', 'Sheath flow rate is not the expected sheath flow rate; continue with buffer/sample/buffer?', icon='warning')
          if MsgBox == 'yes':
              pass
@@ -1255,13 +1395,7 @@ class Main:
             return
 
         # before scheduling anything, clear the graph
-        self.main_tab_ax1.clear()
-        self.main_tab_ax2.clear()
-        self.main_tab_ax3.clear()
-        self.main_tab_ax3.spines["right"].set_position(("outward", 60)) # offset second right axis
-        self.the_line1 = self.main_tab_ax1.plot([], [], color=ElveflowDisplay.COLOR_Y1)[0]
-        self.the_line2 = self.main_tab_ax2.plot([], [], color=ElveflowDisplay.COLOR_Y2)[0]
-        self.the_line3 = self.main_tab_ax3.plot([], [], color=ElveflowDisplay.COLOR_Y3)[0]
+        self.clear_graph()
         self.graph_start_time = int(time.time())
         self.graph_end_time = np.inf
         self.python_logger.debug("main page graph start time: %s" % self.graph_start_time)
@@ -1276,6 +1410,7 @@ class Main:
 
         # prebuffer
         self.queue.put((self.python_logger.info, "Starting to run pre-buffer"))
+        self.queue.put(self.correct_sheath_flow)
         self.queue.put((self.flowpath.valve2.set_auto_position, "Run"))
         self.queue.put((self.flowpath.valve3.set_auto_position, 0))
         self.queue.put((self.flowpath.valve4.set_auto_position, "Run"))
@@ -1297,9 +1432,7 @@ class Main:
             tk.messagebox.showinfo('Error', 'Filename is blank or contains invalid characters. \nThese include: %s (includes spaces).' % (self.illegal_chars))
             return
 
-        if np.abs(
-                self.elveflow_display.elveflow_handler.getVolume(int(self.elveflow_sheath_channel.get()))
-                 - float(self.elveflow_sheath_volume.get()) ) > self.sheathflow_tolerance:
+        if not self.sheath_flow_is_steady():
              MsgBox = messagebox.askquestion('Warning', 'Sheath may not be running; continue with buffer/sample/buffer?', icon='warning')
              if MsgBox == 'yes':
                  pass
@@ -1319,13 +1452,7 @@ class Main:
             return
 
         # before scheduling anything, clear the graph
-        self.main_tab_ax1.clear()
-        self.main_tab_ax2.clear()
-        self.main_tab_ax3.clear()
-        self.main_tab_ax3.spines["right"].set_position(("outward", 60)) # offset second right axis
-        self.the_line1 = self.main_tab_ax1.plot([], [], color=ElveflowDisplay.COLOR_Y1)[0]
-        self.the_line2 = self.main_tab_ax2.plot([], [], color=ElveflowDisplay.COLOR_Y2)[0]
-        self.the_line3 = self.main_tab_ax3.plot([], [], color=ElveflowDisplay.COLOR_Y3)[0]
+        self.clear_graph()
         self.graph_start_time = int(time.time())
         self.graph_end_time = np.inf
         self.python_logger.debug("main page graph start time: %s" % self.graph_start_time)
@@ -1339,6 +1466,7 @@ class Main:
         self.queue.put(self.elveflow_display.start_saving)
 
         self.queue.put((self.python_logger.info, "Starting to run pre-buffer"))
+        self.queue.put(self.correct_sheath_flow)
         # Start cerberus
         self.queue.put((self.flowpath.valve6.set_auto_position, "Run"))
         self.queue.put((self.flowpath.valve8.set_auto_position, "Run"))
@@ -1378,9 +1506,7 @@ class Main:
             tk.messagebox.showinfo('Error', 'Filename is blank or contains invalid characters. \nThese include: %s (includes spaces).' % (self.illegal_chars))
             return
 
-        if np.abs(
-            self.elveflow_display.elveflow_handler.getVolume(int(self.elveflow_sheath_channel.get()))
-             - float(self.elveflow_sheath_volume.get()) ) > self.sheathflow_tolerance:
+        if not self.sheath_flow_is_steady():
          MsgBox = messagebox.askquestion('Warning', 'Sheath flow rate is not the expected sheath flow rate; continue with buffer/sample/buffer?', icon='warning')
          if MsgBox == 'yes':
              pass
@@ -1401,13 +1527,7 @@ class Main:
             return
 
         # before scheduling anything, clear the graph
-        self.main_tab_ax1.clear()
-        self.main_tab_ax2.clear()
-        self.main_tab_ax3.clear()
-        self.main_tab_ax3.spines["right"].set_position(("outward", 60)) # offset second right axis
-        self.the_line1 = self.main_tab_ax1.plot([], [], color=ElveflowDisplay.COLOR_Y1)[0]
-        self.the_line2 = self.main_tab_ax2.plot([], [], color=ElveflowDisplay.COLOR_Y2)[0]
-        self.the_line3 = self.main_tab_ax3.plot([], [], color=ElveflowDisplay.COLOR_Y3)[0]
+        self.clear_graph()
         self.graph_start_time = int(time.time())
         self.graph_end_time = np.inf
         self.python_logger.debug("main page graph start time: %s" % self.graph_start_time)
@@ -1422,6 +1542,7 @@ class Main:
 
         # sample
         self.queue.put((self.python_logger.info, "Starting to run sample"))
+        self.queue.put(self.correct_sheath_flow)
         self.queue.put((self.flowpath.valve2.set_auto_position, "Run"))
         self.queue.put((self.flowpath.valve3.set_auto_position, 1))
         self.queue.put((self.flowpath.valve4.set_auto_position, "Run"))
@@ -1443,9 +1564,7 @@ class Main:
             tk.messagebox.showinfo('Error', 'Filename is blank or contains invalid characters. \nThese include: %s (includes spaces).' % (self.illegal_chars))
             return
 
-        if np.abs(
-                self.elveflow_display.elveflow_handler.getVolume(int(self.elveflow_sheath_channel.get()))
-                 - float(self.elveflow_sheath_volume.get()) ) > self.sheathflow_tolerance:
+        if not self.sheath_flow_is_steady():
              MsgBox = messagebox.askquestion('Warning', 'Sheath may not be running; continue with buffer/sample/buffer?', icon='warning')
              if MsgBox == 'yes':
                  pass
@@ -1465,13 +1584,7 @@ class Main:
             return
 
         # before scheduling anything, clear the graph
-        self.main_tab_ax1.clear()
-        self.main_tab_ax2.clear()
-        self.main_tab_ax3.clear()
-        self.main_tab_ax3.spines["right"].set_position(("outward", 60)) # offset second right axis
-        self.the_line1 = self.main_tab_ax1.plot([], [], color=ElveflowDisplay.COLOR_Y1)[0]
-        self.the_line2 = self.main_tab_ax2.plot([], [], color=ElveflowDisplay.COLOR_Y2)[0]
-        self.the_line3 = self.main_tab_ax3.plot([], [], color=ElveflowDisplay.COLOR_Y3)[0]
+        self.clear_graph()
         self.graph_start_time = int(time.time())
         self.graph_end_time = np.inf
         self.python_logger.debug("main page graph start time: %s" % self.graph_start_time)
@@ -1485,12 +1598,14 @@ class Main:
         self.queue.put(self.elveflow_display.start_saving)
 
         self.queue.put((self.python_logger.info, "Starting to run pre-buffer"))
+        self.queue.put(self.correct_sheath_flow)
         # Start cerberus
         self.queue.put((self.flowpath.valve6.set_auto_position, "Run"))
         self.queue.put((self.flowpath.valve8.set_auto_position, "Run"))
         self.queue.put((self.cerberus_pump.infuse_volume, self.cerberus_volume.get()/1000, self.cerberus_flowrate.get()))
         # Run Sample
         self.queue.put((self.python_logger.info, "Starting to run sample"))
+        self.queue.put(self.correct_sheath_flow)
         self.queue.put((self.flowpath.valve2.set_auto_position, "Run"))
         self.queue.put((self.flowpath.valve3.set_auto_position, 1))
         self.queue.put((self.flowpath.valve4.set_auto_position, "Run"))
@@ -2359,6 +2474,75 @@ class Main:
                 solocomm.controlQueue.put([('G', 'ADXDONE_OK')])
         pass
 
+    def sheath_flow_is_steady(self):
+        """returns whether the sheath flow rate has been steady at the expected rate (within sheathflow_tolerance)
+        over the last sheathflow_window seconds of the Elveflow stream"""
+        channel = int(self.elveflow_sheath_channel.get())
+        target = float(self.elveflow_sheath_volume.get())
+        status = self.sheath_supervisor.check()
+        if status == NO_DATA:
+            # no stream to look at: fall back to a single reading
+            return np.abs(self.elveflow_display.elveflow_handler.getVolume(channel) - target) <= self.sheathflow_tolerance
+        return status == STEADY
+
+    def equilibration_checks(self):
+        """the (channel, target flow rate, tolerance) of every Elveflow flow sensor that has to be steady
+        before an adaptive equilibration is over: the sheath, and the sample if it has a sensor"""
+        checks = [(int(self.elveflow_sheath_channel.get()), float(self.elveflow_sheath_volume.get()), self.sheathflow_tolerance)]
+        if self.elveflow_sample_channel.get().strip() != '':
+            checks.append((int(self.elveflow_sample_channel.get()), float(self.sample_flowrate.get()), self.sample_flow_tolerance))
+        return checks
+
+    def flows_are_steady(self, checks, since):
+        """whether every flow in checks (see equilibration_checks) has been steady for the last
+        equilibration_window seconds, counting only data from after the time since"""
+        store = self.elveflow_display.data
+        for (channel, target, tolerance) in checks:
+            try:
+                times, flowrates = store.columns('time [s]', 'Volume flow rate %i [µL/min]' % channel)
+            except KeyError:
+                return False
+            first = np.searchsorted(times, since)
+            if len(times) - first < 2 or times[-1] - times[first] < self.equilibration_window:
+                return False
+            if not is_steady(times[first:], flowrates[first:], self.equilibration_window, target=target, margin=tolerance):
+                return False
+        return True
+
+    def wait_for_equilibration(self, max_wait, checks=None, command_while_waiting=lambda *_: None):
+        """wait while the pump runs, for max_wait seconds at most. If checks (see equilibration_checks) is given,
+        stop waiting as soon as all of those flows are steady"""
+        if checks is None:
+            self.pump.wait_until_time(max_wait, command_while_waiting)
+            return
+        start = time.time()
+        completion = self.pump.completion
+        ask_pump = True  # False once asking whether the pump's done has failed: then just wait out max_wait
+        while time.time() < start + max_wait:
+            if not ask_pump:
+                time.sleep(0.1)
+            elif completion is None:
+                if not self.pump.is_running():
+                    break
+                time.sleep(0.1)
+            else:
+                # the completion tracker asks the pump, only around when it should be done
+                try:
+                    completion.result(timeout=0.1)
+                    break
+                except CancelledError:
+                    break  # the pump was started again
+                except FutureTimeout:
+                    pass
+                except Exception as e:
+                    self.python_logger.warning("Can't tell whether the pump is done (%s); waiting up to %.1f s for the flow" % (e, max_wait))
+                    ask_pump = False
+            command_while_waiting()
+            if self.flows_are_steady(checks, start):
+                self.python_logger.info("Flow equilibrated after %.1f s (at most %.1f s)" % (time.time() - start, max_wait))
+                return
+        self.python_logger.info("Flow did not equilibrate in %.1f s; starting anyway" % (time.time() - start))
+
     def is_filename_safe(self):
         """returns whether or not the tseries filename is existent and properly formatted."""
         filename = self.spec_filename.get().strip()
@@ -2416,6 +2600,7 @@ class Main:
             if postfix is not None:
                 file += '_' + postfix
 
+            self.exposure_log.plan(file, frames=number_of_frames, exposure_time=exposure_time)
             solocomm.controlQueue.put([('A', 'EXPOSE ' + file + ',' +
                                         str(exposure_time) + ',' + str(number_of_frames) +
                                         ',' + str(directory) + ',' + str(new_dark))])
@@ -0,0 +1,258 @@
+"""Streaming detection of bubbles, clogs and pressure spikes in the Elveflow data.
+
+AnomalyDetector is a pipeline stage on the acquisition stream: the reading
+thread feeds it every sample as soon as it's taken (feed() never blocks), and
+its own thread runs the rules over whatever has come in since last time and
+calls the callbacks for anything anomalous. That way a clog gets noticed within
+a tick or two, instead of whenever someone next looks at the graph.
+
+Each rule watches one column and works on whole batches of samples at once
+(with NumPy), keeping whatever state it needs between batches:
+
+    ZScoreRule      a sample far from the mean of the samples just before it, in standard deviations
+                    (a bubble makes the flow rate dip suddenly)
+    DerivativeRule  a value changing faster than some rate (a pressure spike)
+    ThresholdRule   a value outside some bounds for at least some time (a clog: the flow rate stays low)
+
+A rule made with needs_arming=True only runs while its column is armed (see
+AnomalyDetector.set_armed): a flow rate of zero is only a clog if something is
+supposed to be pushing liquid through.
+"""
+import threading
+import logging
+from collections import namedtuple
+from queue import Queue, Empty as Queue_Empty, Full as Queue_Full
+import numpy as np
+
+Anomaly = namedtuple('Anomaly', ['time', 'column', 'kind', 'value', 'score', 'rule'])
+
+
+class ZScoreRule:
+    """flags samples more than threshold standard deviations away from the mean of the `window` samples before them.
+    direction -1 only flags dips, +1 only flags peaks, and 0 both. min_std keeps a very quiet signal from
+    turning every bit of sensor noise into an anomaly"""
+
+    def __init__(self, window=50, threshold=5.0, direction=0, min_std=0.0, kind='outlier'):
+        self.window = window
+        self.threshold = threshold
+        self.direction = direction
+        self.min_std = min_std
+        self.kind = kind
+        self.history = np.empty(0)
+
+    def check(self, times, values):
+        """returns (mask of the anomalous samples, their scores) for a batch of samples"""
+        extended = np.concatenate((self.history, values))
+        valid = ~np.isnan(extended)
+        filled = np.where(valid, extended, 0.0)
+        # running sums with a leading zero, so the sum over extended[a:b] is sums[b] - sums[a]
+        sums = np.concatenate(([0.0], np.cumsum(filled)))
+        squares = np.concatenate(([0.0], np.cumsum(filled * filled)))
+        counts = np.concatenate(([0], np.cumsum(valid)))
+        ends = np.arange(len(self.history), len(extended))  # the window of each new sample ends just before it
+        starts = np.maximum(ends - self.window, 0)
+        n = counts[ends] - counts[starts]
+        with np.errstate(invalid='ignore', divide='ignore'):
+            mean = (sums[ends] - sums[starts]) / n
+            std = np.sqrt(np.maximum((squares[ends] - squares[starts]) / n - mean * mean, 0))
+            scores = (values - mean) / np.maximum(std, self.min_std)
+        # don't judge anything until there's a full window to compare against
+        scores[n < self.window] = np.nan
+        if self.direction < 0:
+            mask = scores < -self.threshold
+        elif self.direction > 0:
+            mask = scores > self.threshold
+        else:
+            mask = np.abs(scores) > self.threshold
+        self.history = extended[-self.window:]
+        return mask, scores
+
+
+class DerivativeRule:
+    """flags samples where the value changed faster than max_rate (per second) since the sample before"""
+
+    def __init__(self, max_rate, kind='spike'):
+        self.max_rate = max_rate
+        self.kind = kind
+        self.last = None  # (time, value) of the last sample seen
+
+    def check(self, times, values):
+        if self.last is None:
+            previous_times, previous_values = times[:1], values[:1]
+        else:
+            previous_times, previous_values = [self.last[0]], [self.last[1]]
+        dt = np.diff(np.concatenate((previous_times, times)))
+        with np.errstate(invalid='ignore', divide='ignore'):
+            rates = np.diff(np.concatenate((previous_values, values))) / dt
+        rates[dt <= 0] = np.nan
+        self.last = (times[-1], values[-1])
+        return np.abs(rates) > self.max_rate, rates
+
+
+class ThresholdRule:
+    """flags samples once the value has been below low or above high (either can be None) for at least `duration` seconds
+    (so a single noisy sample doesn't count)"""
+
+    def __init__(self, low=None, high=None, duration=0.0, kind='threshold', needs_arming=False):
+        self.low = low
+        self.high = high
+        self.duration = duration
+        self.kind = kind
+        self.needs_arming = needs_arming
+        self.out_since = None  # when the current run of out-of-bounds samples started
+
+    def reset(self):
+        self.out_since = None
+
+    def check(self, times, values):
+        out = np.zeros(len(values), dtype=bool)
+        if self.low is not None:
+            out |= values < self.low
+        if self.high is not None:
+            out |= values > self.high
+        # the start time of the run of out-of-bounds samples each sample is in
+        run_starts = np.where(out & ~np.concatenate(([False], out[:-1])), times, np.nan)
+        if self.out_since is not None and len(out) > 0 and out[0]:
+            run_starts[0] = self.out_since
+        run_starts = np.fmax.accumulate(np.where(out, run_starts, -np.inf))
+        elapsed = np.where(out, times - run_starts, 0.0)
+        self.out_since = run_starts[-1] if len(out) > 0 and out[-1] else None
+        return out & (elapsed >= self.duration), values
+
+
+class AnomalyDetector:
+    """runs rules on a stream of rows (one column per entry of column_map, like the Elveflow data) and calls
+    every callback with an Anomaly when one fires. After firing, a rule stays quiet for `cooldown` seconds,
+    so a long clog is reported once rather than ten times a second.
+
+    Callbacks run on the detector's thread: they can log or queue things up, but shouldn't take long."""
+    MAX_QUEUE = 10000  # rows
+
+    def __init__(self, column_map, rules=(), callbacks=(), cooldown=5.0, time_column=0, errorlogger=None):
+        self.column_map = dict(column_map)
+        self.time_column = time_column
+        self.rules = []  # (column name, rule)
+        for (column, rule) in rules:
+            self.add_rule(column, rule)
+        self.callbacks = list(callbacks)
+        self.cooldown = cooldown
+        self.errorlogger = logging.getLogger("python") if errorlogger is None else errorlogger
+        self.last_fired = {}  # rule index -> time it last fired
+        self.arming = {}  # column -> whether its rules that need arming run: a bool, or a function returning one
+        self.queue = Queue(maxsize=AnomalyDetector.MAX_QUEUE)
+        self.n_rows = 0
+        self.n_dropped = 0
+        self.n_anomalies = 0
+        self.run_flag = threading.Event()
+        self.thread = None
+
+    def set_rules(self, rules):
+        """replace all the rules with rules, a list of (column name, rule), e.g. from elveflow_rules"""
+        for (column, rule) in rules:
+            self.column_map[column]
+        # one assignment, so the detector's thread sees either all the old rules or all the new ones
+        self.rules, self.last_fired = list(rules), {}
+
+    def add_rule(self, column, rule):
+        self.column_map[column]  # raises KeyError for an unknown column now rather than later
+        self.rules.append((column, rule))
+
+    def set_armed(self, column, armed):
+        """arm or disarm the rules on column that need arming. armed is a bool, or a function that's called
+        for every batch (from the detector's thread, so it should be quick) and returns one"""
+        self.column_map[column]
+        self.arming[column] = armed
+
+    def is_armed(self, column):
+        armed = self.arming.get(column, False)
+        if callable(armed):
+            try:
+                return bool(armed())
+            except Exception:
+                self.errorlogger.exception("Can't tell whether anomaly detection on %s is armed" % column)
+                return False
+        return armed
+
+    def add_callback(self, callback):
+        self.callbacks.append(callback)
+
+    def feed(self, row):
+        """queue up one sample (copied, so row can be reused right away). Safe to call from any thread; never blocks"""
+        try:
+            self.queue.put_nowait(np.array(row, dtype=float))
+        except Queue_Full:
+            self.n_dropped += 1
+
+    def process(self, rows):
+        """run every rule over a 2-D batch of rows, call the callbacks, and return the anomalies that fired"""
+        rows = np.atleast_2d(rows)
+        if len(rows) == 0:
+            return []
+        self.n_rows += len(rows)
+        times = rows[:, self.time_column]
+        anomalies = []
+        rules, last_fired = self.rules, self.last_fired
+        for (i, (column, rule)) in enumerate(rules):
+            if getattr(rule, 'needs_arming', False) and not self.is_armed(column):
+                rule.reset()  # so that it only counts from when it's armed
+                continue
+            values = rows[:, self.column_map[column]]
+            mask, scores = rule.check(times, values)
+            for j in np.flatnonzero(mask):
+                if times[j] - last_fired.get(i, -np.inf) < self.cooldown:
+                    continue
+                last_fired[i] = times[j]
+                anomalies.append(Anomaly(float(times[j]), column, rule.kind, float(values[j]), float(scores[j]), rule))
+        anomalies.sort(key=lambda anomaly: anomaly.time)
+        self.n_anomalies += len(anomalies)
+        for anomaly in anomalies:
+            for callback in self.callbacks:
+                try:
+                    callback(anomaly)
+                except Exception:
+                    self.errorlogger.exception("Anomaly callback %s failed" % callback)
+        return anomalies
+
+    def start(self):
+        """start processing fed rows on a thread of its own"""
+        def run():
+            while self.run_flag.is_set():
+                try:
+                    batch = [self.queue.get(timeout=0.1)]
+                except Queue_Empty:
+                    continue
+                # everything that came in meanwhile goes in the same batch
+                try:
+                    while True:
+                        batch.append(self.queue.get_nowait())
+                except Queue_Empty:
+                    pass
+                try:
+                    self.process(np.array(batch))
+                except Exception:
+                    self.errorlogger.exception("Anomaly detection failed on a batch of %d rows" % len(batch))
+        self.run_flag.set()
+        self.thread = threading.Thread(target=run, name="AnomalyDetector", daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.run_flag.clear()
+
+    def stats(self):
+        return {'rows': self.n_rows, 'dropped rows': self.n_dropped, 'anomalies': self.n_anomalies, 'backlog': self.queue.qsize()}
+
+
+def elveflow_rules(flow_channels=(), pressure_channels=(), expected_flowrates=None,
+                   bubble_threshold=5.0, clog_fraction=0.5, clog_duration=1.0, max_pressure_rate=2000.0):
+    """a standard set of rules for the Elveflow columns (see FileIO.ELVEFLOW_DATA_COLUMNS):
+    bubbles (sudden dips) on each of flow_channels, clogs (flow below clog_fraction of the expected flow rate for
+    clog_duration seconds) on the channels in expected_flowrates (channel -> µL/min), and spikes (faster than
+    max_pressure_rate mbar/s) on each of pressure_channels. The clog rules need arming, for when the flow is supposed to be on"""
+    rules = []
+    for channel in flow_channels:
+        rules.append(('Volume flow rate %i [µL/min]' % channel, ZScoreRule(direction=-1, threshold=bubble_threshold, min_std=0.1, kind='bubble')))
+    for (channel, flowrate) in (expected_flowrates or {}).items():
+        rules.append(('Volume flow rate %i [µL/min]' % channel, ThresholdRule(low=clog_fraction * flowrate, duration=clog_duration, kind='clog', needs_arming=True)))
+    for channel in pressure_channels:
+        rules.append(('Pressure %i [mbar]' % channel, DerivativeRule(max_pressure_rate, kind='pressure spike')))
+    return rules
@@ -0,0 +1,203 @@
+"""Level-of-detail decimation for plotting long time series.
+
+A plot is only about a thousand pixels wide, so drawing every raw sample of
+a 10-hour trace wastes time on points that land on the same pixel. Instead,
+the visible range is split into about one bucket per pixel, and each bucket
+contributes only its minimum and its maximum sample. Unlike averaging or
+plain striding, this keeps single-sample pressure spikes and flow rate dips
+(bubbles) visible at any zoom level.
+
+MinMaxPyramid precomputes the buckets at several resolutions (each level
+`factor` times coarser than the one below), and updates them incrementally
+as samples come in, so picking the points for any visible range costs about
+the same whatever the length of the trace.
+"""
+import numpy as np
+
+
+def _argmin_argmax(buckets):
+    """per-row positions of the min and max of a 2-D array, ignoring NaNs (an all-NaN row gives position 0)"""
+    nans = np.isnan(buckets)
+    if nans.any():
+        return np.where(nans, np.inf, buckets).argmin(axis=1), np.where(nans, -np.inf, buckets).argmax(axis=1)
+    return buckets.argmin(axis=1), buckets.argmax(axis=1)
+
+
+def minmax_indices(values, n_buckets, start=0, stop=None):
+    """indices (sorted, without duplicates) of the min and max of values[start:stop] in each of about
+    n_buckets equal buckets. If there are fewer than 2 * n_buckets samples, they are all returned"""
+    stop = len(values) if stop is None else stop
+    n = stop - start
+    if n <= 2 * n_buckets:
+        return np.arange(start, stop)
+    size = n // n_buckets
+    n_full = n // size
+    arg_min, arg_max = _argmin_argmax(values[start:start + n_full * size].reshape(n_full, size))
+    offsets = start + np.arange(n_full) * size
+    return np.unique(np.concatenate((offsets + arg_min, offsets + arg_max, np.arange(start + n_full * size, stop))))
+
+
+def minmax_decimate(x, y, n_buckets):
+    """one-off min/max decimation of the line (x, y) into about n_buckets buckets; returns (x, y)"""
+    indices = minmax_indices(y, n_buckets)
+    return x[indices], y[indices]
+
+
+class _Level:
+    """the complete buckets of one pyramid level: for each, the index and value of its min and of its max"""
+
+    def __init__(self):
+        self.n = 0
+        self._arrays = [np.empty(64, dtype=np.int64), np.empty(64), np.empty(64, dtype=np.int64), np.empty(64)]
+
+    def append(self, index_min, value_min, index_max, value_max):
+        needed = self.n + len(index_min)
+        if needed > len(self._arrays[0]):
+            capacity = max(needed, 2 * len(self._arrays[0]))
+            for i, array in enumerate(self._arrays):
+                grown = np.empty(capacity, dtype=array.dtype)
+                grown[:self.n] = array[:self.n]
+                self._arrays[i] = grown
+        for array, new in zip(self._arrays, (index_min, value_min, index_max, value_max)):
+            array[self.n:needed] = new
+        self.n = needed
+
+    @property
+    def index_min(self):
+        return self._arrays[0][:self.n]
+
+    @property
+    def value_min(self):
+        return self._arrays[1][:self.n]
+
+    @property
+    def index_max(self):
+        return self._arrays[2][:self.n]
+
+    @property
+    def value_max(self):
+        return self._arrays[3][:self.n]
+
+
+class MinMaxPyramid:
+    """min/max buckets of one growing column at several resolutions.
+
+    Level 0 buckets hold bucket_size samples, and every level above holds `factor` buckets of the one below.
+    Only complete buckets are stored; indices() fills in the samples past the last complete bucket from finer levels
+    (and finally the raw samples), so the newest data always shows up."""
+
+    def __init__(self, bucket_size=8, factor=4):
+        self.bucket_size = bucket_size
+        self.factor = factor
+        self.levels = [_Level()]
+
+    def bucket_length(self, level):
+        return self.bucket_size * self.factor**level
+
+    def extend(self, values):
+        """bring the pyramid up to date with values, which is the whole column so far (the pyramid remembers how
+        much of it it has already seen, so only the new samples are looked at)"""
+        first = self.levels[0].n
+        last = len(values) // self.bucket_size
+        if last > first:
+            buckets = values[first * self.bucket_size:last * self.bucket_size].reshape(-1, self.bucket_size)
+            arg_min, arg_max = _argmin_argmax(buckets)
+            rows = np.arange(len(buckets))
+            offsets = (first + rows) * self.bucket_size
+            self.levels[0].append(offsets + arg_min, buckets[rows, arg_min], offsets + arg_max, buckets[rows, arg_max])
+        level = 0
+        while self.levels[level].n >= self.factor:
+            if level + 1 == len(self.levels):
+                self.levels.append(_Level())
+            below, above = self.levels[level], self.levels[level + 1]
+            first, last = above.n, below.n // self.factor
+            if last > first:
+                part = slice(first * self.factor, last * self.factor)
+                mins = below.value_min[part].reshape(-1, self.factor)
+                maxs = below.value_max[part].reshape(-1, self.factor)
+                arg_min, _ = _argmin_argmax(mins)
+                _, arg_max = _argmin_argmax(maxs)
+                rows = np.arange(len(mins))
+                above.append(below.index_min[part].reshape(-1, self.factor)[rows, arg_min], mins[rows, arg_min],
+                             below.index_max[part].reshape(-1, self.factor)[rows, arg_max], maxs[rows, arg_max])
+            level += 1
+
+    def indices(self, start, stop, n_buckets):
+        """sorted indices of the samples to draw for the range [start, stop) at about n_buckets buckets"""
+        n = stop - start
+        if n <= 2 * n_buckets:
+            return np.arange(start, stop)
+        # the coarsest level that still gives at least n_buckets buckets over the range
+        top = 0
+        while top + 1 < len(self.levels) and self.bucket_length(top + 1) * n_buckets <= n:
+            top += 1
+        # cover the range with whole buckets of that level, and the bits left over at either edge with finer levels
+        # (a bucket sticking out of the range could pick an off-screen extreme over an on-screen one)
+        parts = []
+        pending = [(start, stop, top)]
+        while pending:
+            start, stop, level = pending.pop()
+            if level < 0:
+                parts.append(np.arange(start, stop))
+                continue
+            length = self.bucket_length(level)
+            first = -(-start // length)
+            last = min(stop // length, self.levels[level].n)
+            if last <= first:
+                pending.append((start, stop, level - 1))
+                continue
+            parts.append(self.levels[level].index_min[first:last])
+            parts.append(self.levels[level].index_max[first:last])
+            if start < first * length:
+                pending.append((start, first * length, level - 1))
+            if last * length < stop:
+                pending.append((last * length, stop, level - 1))
+        return np.unique(np.concatenate(parts))
+
+
+class DecimationCache:
+    """min/max pyramids of the columns of a TimeSeriesStore, for plotting any range of them at screen resolution.
+
+    The pyramids are kept up to date with the store each time view() is called, and thrown away when the
+    store is reset or pushes old rows out of memory. Not thread safe: use it from one (the GUI) thread."""
+
+    def __init__(self, store, bucket_size=8, factor=4):
+        self.store = store
+        self.bucket_size = bucket_size
+        self.factor = factor
+        self.clear()
+
+    def clear(self):
+        self.pyramids = {}
+        self._first_index = None
+        self._total_rows = 0
+
+    def pyramid(self, key, values):
+        """the pyramid of column key, brought up to date with values (the in-memory rows of that column)"""
+        if key not in self.pyramids:
+            self.pyramids[key] = MinMaxPyramid(self.bucket_size, self.factor)
+        pyramid = self.pyramids[key]
+        pyramid.extend(values)
+        return pyramid
+
+    def view(self, x_key, y_key, x_range=None, n_buckets=1000, x_sorted=True, rows=None):
+        """returns (x, y) arrays of the samples to draw for the line y_key vs x_key, with about n_buckets buckets
+        across x_range (which is (x_min, x_max), or None for everything in memory).
+        x_range is only used if x_sorted, i.e. x_key is a column that only ever increases, like the time.
+        rows optionally limits the line to the rows with overall indices in [rows[0], rows[1]) (see TimeSeriesStore.window)"""
+        first, (x, y) = self.store.tail(0, x_key, y_key)
+        total_rows = first + len(x)
+        if first != self._first_index or total_rows < self._total_rows:
+            self.clear()
+            self._first_index = first
+        self._total_rows = total_rows
+        start, stop = 0, len(x)
+        if rows is not None:
+            start = min(max(rows[0] - first, 0), len(x))
+            stop = min(max(rows[1] - first, start), len(x))
+        if x_range is not None and x_sorted:
+            # one sample past each edge, so the line runs all the way across
+            start = max(int(np.searchsorted(x[:stop], x_range[0], side='left')) - 1, start)
+            stop = min(int(np.searchsorted(x[:stop], x_range[1], side='right')) + 1, stop)
+        indices = self.pyramid(y_key, y).indices(start, stop, n_buckets)
+        return x[indices], y[indices]
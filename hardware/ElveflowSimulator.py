@@ -0,0 +1,189 @@
+"""A simulated Elveflow OB1, for running FileIO without Elveflow64.dll.
+
+OB1Simulator has the same OB1_* functions as the Elveflow64 wrapper module
+(and takes the same ctypes arguments, writing results through byref()), so it
+can be passed to ElveflowHandler_SDK as its sdk. Each channel is a simple
+fluidic model: the pressure regulator follows its setpoint with a first-order
+lag, and the flow rate follows pressure / resistance with another first-order
+lag, plus Gaussian sensor noise.
+
+Time comes from a clock object (anything with monotonic(), time() and sleep(),
+like the time module). VirtualClock runs faster than real time, so PID loops
+and whole buffer/sample/buffer sequences can be benchmarked and tested offline.
+"""
+import math
+import threading
+import time
+import numpy as np
+
+# full-scale flow rate of each SDK flow sensor type (see FileIO.SDK_SENSOR_TYPES), in µL/min
+SENSOR_RANGES = {1: 1.5, 2: 7, 3: 50, 4: 80, 5: 1000, 6: 5000}
+MAX_PRESSURE = 8000  # mbar, for the 0-8000 mbar regulators
+ERROR_INVALID_CHANNEL = -1  # the real DLL's error codes aren't documented; this one is ours
+
+
+class VirtualClock:
+    """a clock whose sleep() advances time instead of waiting.
+
+    With speedup=None, sleep() doesn't wait at all (as fast as possible); otherwise it waits
+    dt / speedup real seconds. monotonic() and time() both move in virtual seconds."""
+
+    def __init__(self, speedup=None, start_time=None):
+        self.speedup = speedup
+        self._lock = threading.Lock()
+        self._now = 0.0
+        self._wall_clock_offset = time.time() if start_time is None else start_time
+
+    def monotonic(self):
+        with self._lock:
+            return self._now
+
+    def time(self):
+        return self.monotonic() + self._wall_clock_offset
+
+    def sleep(self, dt):
+        if dt <= 0:
+            return
+        if self.speedup is not None:
+            time.sleep(dt / self.speedup)
+        with self._lock:
+            self._now += dt
+
+
+class ChannelModel:
+    """one OB1 channel: a pressure regulator driving flow through a resistance.
+
+    resistance is in mbar per µL/min, pressure_lag and flow_lag are first-order time constants in seconds,
+    and noise is the standard deviation of the flow sensor reading in µL/min"""
+
+    def __init__(self, resistance=100.0, pressure_lag=0.05, flow_lag=1.0, noise=0.05):
+        self.resistance = resistance
+        self.pressure_lag = pressure_lag
+        self.flow_lag = flow_lag
+        self.noise = noise
+        self.setpoint = 0.0
+        self.pressure = 0.0
+        self.flowrate = 0.0
+
+    @staticmethod
+    def _relax(value, target, dt, tau):
+        """exact solution of a first-order lag over dt, so big time steps are stable"""
+        if tau <= 0:
+            return target
+        return target + (value - target) * math.exp(-dt / tau)
+
+    def advance(self, dt):
+        """step the model forward dt seconds"""
+        if dt <= 0:
+            return
+        self.pressure = self._relax(self.pressure, self.setpoint, dt, self.pressure_lag)
+        self.flowrate = self._relax(self.flowrate, self.pressure / self.resistance, dt, self.flow_lag)
+
+
+def _deref(ref):
+    """the ctypes object behind byref(x), pointer(x) or x itself"""
+    if hasattr(ref, '_obj'):
+        return ref._obj
+    if hasattr(ref, 'contents'):
+        return ref.contents
+    return ref
+
+
+def _value(arg):
+    """a plain number from a ctypes number or a plain number"""
+    return getattr(arg, 'value', arg)
+
+
+class OB1Simulator:
+    """stands in for the Elveflow64 module (for one OB1). channel_models is a list of four ChannelModels"""
+
+    def __init__(self, channel_models=None, clock=time, seed=None):
+        self.channels = [ChannelModel() for _ in range(4)] if channel_models is None else list(channel_models)
+        self.clock = clock
+        self.rng = np.random.default_rng(seed)
+        self.sensortypes = [0] * len(self.channels)
+        self.instrument_id = 0
+        self._lock = threading.Lock()
+        self._last_update = clock.monotonic()
+
+    def _advance(self):
+        """bring every channel up to the current time; call with the lock held"""
+        now = self.clock.monotonic()
+        dt = now - self._last_update
+        self._last_update = now
+        for channel in self.channels:
+            channel.advance(dt)
+
+    def _channel(self, channel_1_to_4):
+        i = int(_value(channel_1_to_4)) - 1
+        if 0 <= i < len(self.channels):
+            return i
+        return None
+
+    def OB1_Initialization(self, Device_Name, Reg_Ch_1, Reg_Ch_2, Reg_Ch_3, Reg_Ch_4, OB1_ID_out):
+        self.instrument_id += 1
+        _deref(OB1_ID_out).value = self.instrument_id
+        return 0
+
+    def Elveflow_Calibration_Default(self, Calib_Array_out, len):
+        return 0
+
+    def OB1_Add_Sens(self, OB1_ID, Channel_1_to_4, SensorType, DigitalAnalog, FSens_Digit_Calib, FSens_Digit_Resolution):
+        i = self._channel(Channel_1_to_4)
+        if i is None:
+            return ERROR_INVALID_CHANNEL
+        self.sensortypes[i] = int(_value(SensorType))
+        return 0
+
+    def OB1_Get_Press(self, OB1_ID, Channel_1_to_4, Acquire_Data1True0False, Calib_array_in, Pressure, Calib_Array_len):
+        i = self._channel(Channel_1_to_4)
+        if i is None:
+            return ERROR_INVALID_CHANNEL
+        with self._lock:
+            self._advance()
+            _deref(Pressure).value = self.channels[i].pressure
+        return 0
+
+    def OB1_Set_Press(self, OB1_ID, Channel_1_to_4, Pressure, Calib_array_in, Calib_Array_len):
+        i = self._channel(Channel_1_to_4)
+        if i is None:
+            return ERROR_INVALID_CHANNEL
+        with self._lock:
+            self._advance()
+            self.channels[i].setpoint = min(max(float(_value(Pressure)), 0), MAX_PRESSURE)
+        return 0
+
+    def OB1_Get_Sens_Data(self, OB1_ID, Channel_1_to_4, Acquire_Data1True0False, Sens_Data):
+        i = self._channel(Channel_1_to_4)
+        if i is None:
+            return ERROR_INVALID_CHANNEL
+        with self._lock:
+            self._advance()
+            sensortype = self.sensortypes[i]
+            if sensortype == 0:
+                flowrate = 0.0  # no sensor plugged in
+            else:
+                flowrate = self.channels[i].flowrate + self.rng.normal(0, self.channels[i].noise)
+                full_scale = SENSOR_RANGES.get(sensortype, math.inf)
+                flowrate = min(max(flowrate, -full_scale), full_scale)
+        _deref(Sens_Data).value = flowrate
+        return 0
+
+    def OB1_Destructor(self, OB1_ID):
+        return 0
+
+
+if __name__ == '__main__':
+    # benchmark: how long (in simulated seconds) the sheath channel takes to reach a flow rate, and how fast that runs
+    from hardware import FileIO
+    clock = VirtualClock()
+    simulator = OB1Simulator(clock=clock, seed=0)
+    handler = FileIO.ElveflowHandler_SDK(sourcename='simulator', sensortypes=[4, 2, 4, 4], sdk=simulator, clock=clock)
+    handler.start()
+    real_start = time.perf_counter()
+    simulated_start = clock.monotonic()
+    end_pressure = handler.run_volume(4, 25, margin=0.5, stable_time=2, timeout=120)
+    print("reached %.3f mbar (flow rate %.3f µL/min) after %.1f simulated s in %.2f real s" %
+          (end_pressure, handler.getVolume(4), clock.monotonic() - simulated_start, time.perf_counter() - real_start))
+    print(handler.getControlStats())
+    handler.stop()
@@ -0,0 +1,110 @@
+"""Flow conditions during each SAXS exposure.
+
+SPEC only knows about frames and the Elveflow recordings only know about
+times, so finding out what the flow was doing during a given exposure used to
+mean digging through the raw logs. ExposureSummaryLog gets told when each
+exposure starts and ends (by the SPEC communication thread), and appends one
+row per exposure to a CSV summary file, keyed by the SPEC file name: the start
+and end times, and the mean, standard deviation, minimum and maximum of every
+pressure and flow rate column of the live store during the exposure. Frames
+taken with bad flow can then be thrown out at reduction time from the summary
+alone.
+"""
+import csv
+import os
+import time
+import threading
+import logging
+import numpy as np
+
+STATISTICS = ('mean', 'std', 'min', 'max')
+
+
+def column_statistics(values):
+    """(mean, std, min, max) of values, ignoring NaNs (all NaN if there's nothing left)"""
+    values = values[~np.isnan(values)]
+    if len(values) == 0:
+        return (float('nan'),) * 4
+    return float(np.mean(values)), float(np.std(values)), float(np.min(values)), float(np.max(values))
+
+
+class ExposureSummaryLog:
+    """keeps track of exposures and writes a summary of the Elveflow data during each one to filename
+
+    get_store returns the TimeSeriesStore to read (it's a function because the Elveflow display makes a new store
+    each time it's restarted). Times are those of the store's time column, so this only makes sense when reading
+    straight from the Elveflow (whose times are time.time()), not an Elveflow log file."""
+    CATCH_UP_TIMEOUT = 5  # seconds to wait for the store to get the data up to the end of an exposure
+
+    def __init__(self, get_store, filename, errorlogger=None, clock=time):
+        self.get_store = get_store
+        self.filename = filename
+        self.errorlogger = logging.getLogger("python") if errorlogger is None else errorlogger
+        self.clock = clock
+        self._lock = threading.Lock()
+        self.planned = {}  # SPEC file name -> dict of details known before the exposure (frames, exposure time...)
+        self.started = {}  # SPEC file name -> start time
+        self.summaries = {}  # SPEC file name -> the summary row written for it
+        self.fieldnames = None
+
+    def plan(self, spec_filename, **details):
+        """remember details about an upcoming exposure, to go into its summary row"""
+        with self._lock:
+            self.planned[spec_filename] = details
+
+    def exposure_started(self, spec_filename):
+        with self._lock:
+            self.started[spec_filename] = self.clock.time()
+
+    def exposure_finished(self, spec_filename, aborted=False):
+        """summarize the exposure in the background (once the store has caught up with it)"""
+        end = self.clock.time()
+        with self._lock:
+            start = self.started.pop(spec_filename, None)
+        if start is None:
+            self.errorlogger.warning("Exposure %s finished, but it never started; not summarizing it" % spec_filename)
+            return
+        threading.Thread(target=self._summarize_when_ready, args=(spec_filename, start, end, aborted), daemon=True).start()
+
+    def _summarize_when_ready(self, spec_filename, start, end, aborted):
+        # the display only polls the Elveflow every so often, so the last bit of the exposure may not be in yet
+        deadline = self.clock.monotonic() + ExposureSummaryLog.CATCH_UP_TIMEOUT
+        while self.clock.monotonic() < deadline:
+            times = self.get_store().column(0)
+            if len(times) > 0 and times[-1] >= end:
+                break
+            self.clock.sleep(0.2)
+        try:
+            self.summarize(spec_filename, start, end, aborted)
+        except Exception:
+            self.errorlogger.exception("Could not summarize exposure %s" % spec_filename)
+
+    def summarize(self, spec_filename, start, end, aborted=False):
+        """compute the summary of one exposure, append it to the summary file and return it (as a dict)"""
+        store = self.get_store()
+        # every named column but the time
+        names = [name for (name, index) in sorted(store.column_map.items(), key=lambda item: item[1]) if index != 0 and name.strip()]
+        _, columns = store.window(start, end, *names)
+        with self._lock:
+            details = self.planned.pop(spec_filename, {})
+        row = {'SPEC file': spec_filename, 'start time': start, 'end time': end, 'duration [s]': end - start,
+               'frames': details.get('frames', ''), 'exposure time [s]': details.get('exposure_time', ''),
+               'samples': len(columns[0]) if columns else 0, 'aborted': aborted}
+        for (name, column) in zip(names, columns):
+            for (statistic, value) in zip(STATISTICS, column_statistics(column)):
+                row['%s %s' % (name, statistic)] = value
+        self._write(row)
+        self.errorlogger.debug("Exposure %s: %d Elveflow samples over %.1f s" % (spec_filename, row['samples'], end - start))
+        return row
+
+    def _write(self, row):
+        with self._lock:
+            self.summaries[row['SPEC file']] = row
+            new_file = not os.path.exists(self.filename) or os.path.getsize(self.filename) == 0
+            if self.fieldnames is None:
+                self.fieldnames = list(row.keys())
+            with open(self.filename, 'a', encoding="utf-8", newline='') as f:
+                writer = csv.DictWriter(f, fieldnames=self.fieldnames, extrasaction='ignore')
+                if new_file:
+                    writer.writeheader()
+                writer.writerow(row)
@@ -1,11 +1,19 @@
 # encoding: utf8
 import csv
+import json
+import os
 import time
 import threading
 import math
+import numpy as np
+from collections import deque
+from concurrent.futures import Future, wait as wait_for_futures
 from queue import Queue, Empty as Queue_Empty, Full as Queue_Full
 from tkinter import filedialog
 from simple_pid import PID
+from hardware.Scheduling import FixedRateScheduler
+from hardware.SteadyState import SteadyStateDetector
+from hardware.SDKInstrumentation import SDKInstrumentation
 
 USE_SDK = True
 SDK_SENSOR_TYPES = {
@@ -36,17 +44,510 @@ ELVEFLOW_DATA_COLUMNS = {
 } # I guess I'm hard-coding them in here now. Unlike the sensor types, these numbers aren't used outside this program
 
 if USE_SDK:
-    from ctypes import c_int32, c_double, byref
+    from ctypes import c_int32, c_double, byref, POINTER
     import sys
     import os.path
     sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "Elveflow_SDK"))   # add the path of the LoadElveflow.py
-    import Elveflow64 as Elveflow_SDK
+    try:
+        import Elveflow64 as Elveflow_SDK
+        SDK_LOAD_ERROR = None
+    except OSError as e:
+        # no Elveflow64.dll (e.g. not on Windows): only an ElveflowHandler_SDK given an sdk (like the simulator) can work
+        Elveflow_SDK = None
+        SDK_LOAD_ERROR = e
+
+    # the argument types of the SDK functions on the hot path, copied from Elveflow64.py
+    SDK_ARGTYPES = {
+        'OB1_Get_Press': [c_int32, c_int32, c_int32, POINTER(c_double*1000), POINTER(c_double), c_int32],
+        'OB1_Set_Press': [c_int32, c_int32, c_double, POINTER(c_double*1000), c_int32],
+        'OB1_Get_Sens_Data': [c_int32, c_int32, c_int32, POINTER(c_double)],
+    }
+
+
+def bind_sdk_function(sdk, name):
+    """look up an SDK function once, up front. The wrappers in Elveflow64.py look up the DLL function and
+    re-set its argtypes on every single call, so when the DLL is there, call it directly instead"""
+    try:
+        function = getattr(sdk.ElveflowDLL, name)
+    except AttributeError:
+        return getattr(sdk, name)
+    function.argtypes = SDK_ARGTYPES[name]
+    return function
+
+
+class SDKReadContext:
+    """preallocated ctypes buffers and channel arguments for talking to one OB1, so that reading
+    (and setting) doesn't allocate new ctypes objects on every call.
+
+    read_all() writes straight into a NumPy row laid out like ELVEFLOW_DATA_COLUMNS.
+    The buffers are shared, so only one thread may use a context at a time: hold self.lock if in doubt.
+    If instrumentation (an SDKInstrumentation) is given, every SDK call is timed through it."""
+
+    def __init__(self, sdk, instr_ID, calib, clock=time, instrumentation=None):
+        self.clock = clock
+        self.lock = threading.Lock()
+        self.instr_ID = instr_ID.value
+        self.calib_ref = byref(calib)
+        self.channels = [None] + [c_int32(i) for i in range(1, 5)]  # indexed by channel number
+        self.value = c_double()
+        self.value_ref = byref(self.value)
+        self.get_press = bind_sdk_function(sdk, 'OB1_Get_Press')
+        self.set_press = bind_sdk_function(sdk, 'OB1_Set_Press')
+        self.get_sens_data = bind_sdk_function(sdk, 'OB1_Get_Sens_Data')
+        if instrumentation is not None:
+            # the channel is the second argument of all three
+            self.get_press = instrumentation.wrap('OB1_Get_Press', self.get_press, 1)
+            self.set_press = instrumentation.wrap('OB1_Set_Press', self.set_press, 1)
+            self.get_sens_data = instrumentation.wrap('OB1_Get_Sens_Data', self.get_sens_data, 1)
+        self.row = np.full(len(ELVEFLOW_DATA_COLUMNS), np.nan)
+        self.read_times = np.full(8, np.nan)  # when each channel was actually read, on the monotonic clock
+        self.errors = np.zeros(8, dtype=np.int32)  # the error code of each channel read
+
+    def read_all(self, row=None, read_times=None):
+        """read all four pressures and all four flow rates into row (by default self.row) and their read times
+        into read_times (by default self.read_times). The time column of row is left alone. Returns row"""
+        if row is None:
+            row = self.row
+        if read_times is None:
+            read_times = self.read_times
+        for i in range(1, 5):
+            self.errors[i-1] = self.get_press(self.instr_ID, self.channels[i], 1, self.calib_ref, self.value_ref, 1000)
+            read_times[i-1] = self.clock.monotonic()
+            row[i] = self.value.value
+        for i in range(1, 5):
+            self.errors[i+3] = self.get_sens_data(self.instr_ID, self.channels[i], 1, self.value_ref)
+            read_times[i+3] = self.clock.monotonic()
+            row[i+4] = self.value.value
+        return row
+
+    def read_pressure(self, channel_number):
+        """returns (error code, pressure) for one channel"""
+        error = self.get_press(self.instr_ID, self.channels[channel_number], 1, self.calib_ref, self.value_ref, 1000)
+        return error, self.value.value
+
+    def read_flowrate(self, channel_number):
+        """returns (error code, flow rate) for one channel"""
+        error = self.get_sens_data(self.instr_ID, self.channels[channel_number], 1, self.value_ref)
+        return error, self.value.value
+
+    def write_pressure(self, channel_number, value):
+        """returns the error code"""
+        return self.set_press(self.instr_ID, self.channels[channel_number], value, self.calib_ref, 1000)
+
+
+class PressureRampGoal:
+    """a control goal: bring one channel's pressure to target, by at most max_step mbar per tick
+    (or all in one go if max_step is None). Its future's result is the pressure reached"""
+
+    def __init__(self, channel_number, target, max_step=None, interrupt_event=None):
+        self.channel_number = channel_number
+        self.target = min(max(target, 0), 8000)
+        self.max_step = max_step
+        self.interrupt_event = interrupt_event  # if this gets set, the ramp stops wherever it is
+        self.future = Future()
+        self.curr_pressure = None
+
+    def step(self, pressure, flowrate, dt):
+        """given this tick's reading of the channel (NaN for failed reads) and the time since the last tick,
+        return (pressure to set or None, whether the goal is done)"""
+        if self.curr_pressure is None:
+            # start from wherever the pressure actually is
+            if math.isnan(pressure):
+                raise RuntimeError('ERROR GETTING PRESSURE %i' % self.channel_number)
+            self.curr_pressure = pressure
+        if self.max_step is None or abs(self.target - self.curr_pressure) <= self.max_step:
+            # if we're close, just set it and hope for the best
+            self.curr_pressure = self.target
+            return self.curr_pressure, True
+        # otherwise, just make one max_step-sized step in the correct direction
+        self.curr_pressure = self.curr_pressure + math.copysign(self.max_step, self.target - self.curr_pressure)
+        return self.curr_pressure, False
+
+    def on_interrupt(self):
+        """what to do once interrupt_event is set: returns a goal to replace this one, or None"""
+        return None
+
+    def result(self):
+        return self.curr_pressure
+
+
+class FlowRateGoal:
+    """a control goal: PID-control one channel's pressure so that its flow rate reaches target.
+
+    If margin is given, the goal is done once the flow rate is steady (see SteadyStateDetector) over a window of
+    stable_time seconds: its mean within +/- margin of target, with less than margin of noise and of drift.
+    It is also done after timeout seconds, if given. Otherwise it runs until cancelled or interrupted, and
+    if ramp_down_step is given, the pressure is then ramped back to zero by that many mbar per tick.
+    Its future's result is the last pressure set"""
+    MIN_STEADY_WINDOW = 0.5  # seconds; anything shorter is just a handful of samples
+
+    def __init__(self, channel_number, target, pid_constants, interrupt_event=None, margin=None, stable_time=0, timeout=None, ramp_down_step=None):
+        self.channel_number = channel_number
+        self.target = target
+        self.pid_constants = pid_constants
+        self.interrupt_event = interrupt_event
+        self.margin = margin
+        self.stable_time = stable_time
+        self.timeout = timeout
+        self.ramp_down_step = ramp_down_step
+        self.future = Future()
+        self.pid = None
+        self.initial_pressure = None
+        self.pressure_to_set = None
+        self.elapsed = 0
+        self.steady_state = None
+        if margin is not None:
+            self.steady_state = SteadyStateDetector(max(stable_time, FlowRateGoal.MIN_STEADY_WINDOW), target, margin)
+
+    def step(self, pressure, flowrate, dt):
+        """see PressureRampGoal.step"""
+        if self.pid is None:
+            if math.isnan(pressure):
+                raise RuntimeError('ERROR GETTING PRESSURE %i' % self.channel_number)
+            # the PID runs on the tick's dt rather than timing itself, so it also works on a simulated clock
+            # limiting the output to the pressures we can actually set stops the integral term from winding up
+            self.pid = PID(*self.pid_constants, setpoint=self.target, sample_time=None, output_limits=(-pressure, 8000 - pressure))
+            self.initial_pressure = pressure
+            self.pressure_to_set = pressure
+            return None, False
+        self.elapsed += dt
+        if self.timeout is not None and self.elapsed > self.timeout:
+            return None, True
+        if math.isnan(flowrate):
+            # if we have an error reading, don't try to set anything
+            return None, False
+        if self.steady_state is not None and self.steady_state.update(self.elapsed, flowrate):
+            # we've reached the end! Just quit.
+            return None, True
+
+        self.pressure_to_set = min(max(self.pid(flowrate, dt=dt) + self.initial_pressure, 0), 8000)
+        return self.pressure_to_set, False
+
+    def on_interrupt(self):
+        if self.ramp_down_step is None:
+            return None
+        return PressureRampGoal(self.channel_number, 0, self.ramp_down_step)
+
+    def result(self):
+        return self.pressure_to_set
+
+    @property
+    def time_to_steady_state(self):
+        """seconds from the start of the loop until the flow rate was steady (None if it never was, or there's no margin)"""
+        if self.steady_state is None or self.steady_state.time_to_steady_state is None:
+            return None
+        return self.steady_state.start_time + self.steady_state.time_to_steady_state
+
+
+# PID constants from the ultimate gain Ku and ultimate period Tu of a relay test, as (Kp, Ti, Td) with times in seconds
+PID_TUNING_RULES = {
+    'tyreus-luyben': lambda Ku, Tu: (Ku / 3.2, 2.2 * Tu, 0),  # PI; gentle, little overshoot
+    'ziegler-nichols': lambda Ku, Tu: (0.6 * Ku, Tu / 2, Tu / 8),
+    'no overshoot': lambda Ku, Tu: (0.2 * Ku, Tu / 2, Tu / 3),
+}
+
+
+def pid_constants_from_relay(ultimate_gain, ultimate_period, rule='tyreus-luyben'):
+    """turn a relay test's result into (kp, ki, kd) for simple_pid"""
+    kp, ti, td = PID_TUNING_RULES[rule](ultimate_gain, ultimate_period)
+    return kp, kp / ti, kp * td
+
+
+def step_response_metrics(times, values, target, margin):
+    """returns (settle time, overshoot) of a step response towards target: the time after which
+    values stay within +/- margin of target (None if they never do), and how far the response
+    went past target, in percent of target"""
+    values = np.asarray(values, dtype=float)
+    times = np.asarray(times, dtype=float)
+    outside = np.flatnonzero(np.abs(values - target) >= margin)
+    if len(values) == 0 or (len(outside) > 0 and outside[-1] == len(values) - 1):
+        settle_time = None
+    elif len(outside) == 0:
+        settle_time = float(times[0])
+    else:
+        settle_time = float(times[outside[-1] + 1])
+    overshoot = 0.0
+    if len(values) and target != 0:
+        overshoot = max(0.0, float(np.max(values * math.copysign(1, target)) - abs(target)) / abs(target) * 100)
+    return settle_time, overshoot
+
+
+class RelayAutotuneGoal:
+    """a control goal for autotuning: switch one channel's pressure between bias +/- amplitude whenever its flow rate
+    crosses target (with +/- hysteresis), and measure the resulting oscillation (Astrom-Hagglund relay test).
+
+    The bias is adjusted every cycle so the high and low halves last equally long. The first cycle is thrown away;
+    after n_cycles more, the goal is done and its future's result is a dict of the ultimate gain and period"""
+    MAX_HALF_PERIOD = 10  # seconds stuck on one side of target before the bias is moved
+
+    def __init__(self, channel_number, target, amplitude, hysteresis=0.2, n_cycles=4, timeout=180, interrupt_event=None):
+        self.channel_number = channel_number
+        self.target = target
+        self.amplitude = amplitude
+        self.hysteresis = hysteresis
+        self.n_cycles = n_cycles
+        self.timeout = timeout
+        self.interrupt_event = interrupt_event
+        self.future = Future()
+        self.bias = None
+        self.high = True
+        self.elapsed = 0
+        self.last_switch = 0
+        self.cycle_start = None
+        self.high_duration = None
+        self.cycle_min = math.inf
+        self.cycle_max = -math.inf
+        self.n_cycles_seen = 0
+        self.periods = []
+        self.amplitudes = []
+
+    def step(self, pressure, flowrate, dt):
+        """see PressureRampGoal.step"""
+        if self.bias is None:
+            if math.isnan(pressure) or math.isnan(flowrate):
+                raise RuntimeError('ERROR GETTING PRESSURE OR FLOW RATE %i' % self.channel_number)
+            # guess the pressure that gives the target flow rate, assuming a linear resistance
+            self.bias = pressure * self.target / flowrate if flowrate > self.hysteresis else pressure
+            return self._pressure(), False
+        self.elapsed += dt
+        if self.elapsed > self.timeout:
+            raise RuntimeError('RELAY TEST TIMED OUT %i' % self.channel_number)
+        if math.isnan(flowrate):
+            return None, False
+        self.cycle_min = min(self.cycle_min, flowrate)
+        self.cycle_max = max(self.cycle_max, flowrate)
+
+        if self.high and flowrate > self.target + self.hysteresis:
+            self.high = False
+            self.high_duration = self.elapsed - self.last_switch
+            self.last_switch = self.elapsed
+        elif not self.high and flowrate < self.target - self.hysteresis:
+            self.high = True
+            if self.cycle_start is not None and self.high_duration is not None:
+                self._end_cycle(self.elapsed - self.last_switch)
+            self.cycle_start = self.elapsed
+            self.last_switch = self.elapsed
+            self.cycle_min = self.cycle_max = flowrate
+        elif self.elapsed - self.last_switch > RelayAutotuneGoal.MAX_HALF_PERIOD:
+            # the relay can't push the flow rate across target from this bias: by now the flow rate has settled,
+            # so guess again from the resistance (or just move by a whole amplitude if there's barely any flow)
+            if flowrate > self.hysteresis:
+                self.bias = self._pressure() * self.target / flowrate
+            else:
+                self.bias += self.amplitude if self.high else -self.amplitude
+            self.last_switch = self.elapsed
+        return self._pressure(), len(self.periods) >= self.n_cycles
+
+    def _end_cycle(self, low_duration):
+        period = self.high_duration + low_duration
+        self.n_cycles_seen += 1
+        if self.n_cycles_seen > 1:
+            # the first cycle still has the start-up transient in it
+            self.periods.append(period)
+            self.amplitudes.append((self.cycle_max - self.cycle_min) / 2)
+        # re-center the relay so that both halves of the cycle are equally long
+        self.bias += self.amplitude * (self.high_duration - low_duration) / period
+
+    def _pressure(self):
+        return min(max(self.bias + (self.amplitude if self.high else -self.amplitude), 0), 8000)
+
+    def on_interrupt(self):
+        return None
+
+    def result(self):
+        amplitude = float(np.mean(self.amplitudes))
+        # describing-function estimate, corrected for the hysteresis
+        ultimate_gain = 4 * self.amplitude / (math.pi * math.sqrt(max(amplitude**2 - self.hysteresis**2, 1e-12)))
+        return {'ultimate gain': ultimate_gain, 'ultimate period': float(np.mean(self.periods)),
+                'oscillation amplitude': amplitude, 'bias': self.bias}
+
+
+class StepTestGoal(FlowRateGoal):
+    """a FlowRateGoal that first vents the channel (by ramp_step mbar per tick) until its flow rate is within margin of zero,
+    then steps to target, recording (time since the step, flow rate) in self.history to measure the step response"""
+
+    def __init__(self, channel_number, target, pid_constants, ramp_step, margin, stable_time, timeout, interrupt_event=None):
+        super().__init__(channel_number, target, pid_constants, interrupt_event=interrupt_event,
+                         margin=margin, stable_time=stable_time, timeout=timeout)
+        self.ramp_step = ramp_step
+        self.venting = True
+        self.vent_pressure = None
+        self.vent_time = 0
+        self.history = []
+
+    def step(self, pressure, flowrate, dt):
+        if self.venting:
+            if self.vent_pressure is None:
+                if math.isnan(pressure):
+                    raise RuntimeError('ERROR GETTING PRESSURE %i' % self.channel_number)
+                self.vent_pressure = pressure
+            self.vent_time += dt
+            if self.vent_time > self.timeout:
+                raise RuntimeError('FLOW RATE DID NOT DROP TO ZERO %i' % self.channel_number)
+            if self.vent_pressure <= 0 and not math.isnan(flowrate) and abs(flowrate) < self.margin:
+                self.venting = False  # vented: hand over to the PID from the next tick
+                return None, False
+            self.vent_pressure = max(self.vent_pressure - self.ramp_step, 0)
+            return self.vent_pressure, False
+        pressure_to_set, done = super().step(pressure, flowrate, dt)
+        if not math.isnan(flowrate):
+            self.history.append((self.elapsed, flowrate))
+        return pressure_to_set, done
+
+
+class ControlEngine:
+    """runs the pressure ramps and flow-rate PID loops of every channel of one OB1 on a single fixed-rate tick,
+    instead of one thread per loop all talking to the instrument at once.
+
+    Each channel has at most one goal (a PressureRampGoal or a FlowRateGoal). submit() hands a goal over from any thread;
+    it replaces the channel's old goal (whose future is cancelled) at the start of the next tick. The owner of the engine
+    calls tick() once per period with that period's batched read of all channels, and the engine makes at most one write
+    per channel. So a command takes effect within one period plus the time a tick takes, which stats() keeps track of."""
+    N_CHANNELS = 4
+    STATS_WINDOW = 600  # how many recent ticks the statistics cover
+
+    def __init__(self, context, errorlogger, period, clock=time):
+        """context is the SDKReadContext to write through; only the thread calling tick() may use it"""
+        self.context = context
+        self.clock = clock
+        self.errorlogger = errorlogger
+        self.period = period
+        self._lock = threading.Lock()
+        self.goals = [None] * ControlEngine.N_CHANNELS
+        self.pending = {}  # channel number -> goal (or None, to cancel) for the next tick
+        self.last_tick = None
+        self.n_ticks = 0
+        self.tick_durations = deque(maxlen=ControlEngine.STATS_WINDOW)
+
+    def submit(self, goal):
+        """replace the goal of goal.channel_number from the next tick on. Returns the goal's future"""
+        with self._lock:
+            replaced = self.pending.get(goal.channel_number)
+            self.pending[goal.channel_number] = goal
+        if replaced is not None:
+            replaced.future.cancel()
+        return goal.future
+
+    def cancel(self, channel_number):
+        """drop the goal of a channel at the next tick, leaving its pressure wherever it is"""
+        with self._lock:
+            replaced = self.pending.get(channel_number)
+            self.pending[channel_number] = None
+        if replaced is not None:
+            replaced.future.cancel()
+
+    def is_idle(self):
+        """whether no channel has a goal"""
+        with self._lock:
+            return not any(self.pending.values()) and all(goal is None for goal in self.goals)
+
+    def close(self):
+        """cancel every goal right away. Only call this from the thread calling tick(), once it's done ticking"""
+        with self._lock:
+            pending = self.pending
+            self.pending = {}
+        for goal in list(pending.values()) + self.goals:
+            if goal is not None:
+                goal.future.cancel()
+        self.goals = [None] * ControlEngine.N_CHANNELS
+
+    def _finish(self, i, goal, follow_up=None):
+        self.goals[i] = follow_up
+        goal.future.set_result(goal.result())
+
+    def tick(self, row, errors, now):
+        """run one control step of every channel that has a goal.
+        row is this tick's reading (laid out like ELVEFLOW_DATA_COLUMNS), errors the error codes of its 8 reads
+        (as in SDKReadContext.errors), and now the monotonic time of the tick"""
+        with self._lock:
+            pending = self.pending
+            self.pending = {}
+        for channel_number, goal in pending.items():
+            old_goal = self.goals[channel_number-1]
+            if old_goal is not None:
+                old_goal.future.cancel()
+            self.goals[channel_number-1] = goal
+        dt = self.period if self.last_tick is None else now - self.last_tick
+        self.last_tick = now
+
+        for i, goal in enumerate(self.goals):
+            if goal is None:
+                continue
+            channel_number = i + 1
+            if goal.future.cancelled():
+                # somebody cancelled the future directly
+                self.goals[i] = None
+                continue
+            if goal.interrupt_event is not None and goal.interrupt_event.is_set():
+                self._finish(i, goal, goal.on_interrupt())
+                continue
+            pressure = row[channel_number] if errors[i] == 0 else math.nan
+            flowrate = row[channel_number + 4] if errors[i + 4] == 0 else math.nan
+            try:
+                pressure_to_set, done = goal.step(pressure, flowrate, dt)
+            except RuntimeError as e:
+                self.errorlogger.warning('%s: %s' % (e, errors[i]))
+                self.goals[i] = None
+                goal.future.set_exception(e)
+                continue
+            if pressure_to_set is not None:
+                error = self.context.write_pressure(channel_number, pressure_to_set)
+                if error != 0:
+                    self.errorlogger.warning('ERROR CODE SETTING PRESSURE %i: %s' % (channel_number, error))
+            if done:
+                self._finish(i, goal)
+
+        self.tick_durations.append(self.clock.monotonic() - now)
+        self.n_ticks += 1
+
+    def stats(self):
+        """returns a dict of statistics over the last STATS_WINDOW ticks (times in seconds). 'max latency' is the worst
+        case between a submit() and its first write: one period plus the longest tick"""
+        durations = np.array(self.tick_durations)
+        max_duration = float(np.max(durations)) if len(durations) else float('nan')
+        return {
+            'ticks': self.n_ticks,
+            'active goals': sum(goal is not None for goal in self.goals),
+            'mean tick duration': float(np.mean(durations)) if len(durations) else float('nan'),
+            'max tick duration': max_duration,
+            'max latency': self.period + max_duration,
+        }
+
+
+def parse_esi_lines(lines, width, numeric_columns=None, delimiter='\t'):
+    """parse a block of tab-separated Elveflow log lines (strings, without the header) into an
+    (n, width) float array in one go. Anything that isn't a number becomes NaN, like before.
+
+    numeric_columns are the columns worth trying to parse (by default, all of them); the rest are left NaN.
+    Elveflow logs end every line with a tab, so the last column (with an empty name) is usually one of those.
+    Other delimiters work too (e.g. ',' for our own CSV recordings)"""
+    if numeric_columns is None:
+        numeric_columns = list(range(width))
+    block = np.full((len(lines), width), np.nan)
+    if len(lines) == 0 or len(numeric_columns) == 0:
+        return block
+    try:
+        # fast path: every line is complete and every field is a number, so numpy can do it all in C
+        block[:, numeric_columns] = np.loadtxt(lines, delimiter=delimiter, usecols=numeric_columns, ndmin=2, comments=None)
+    except ValueError:
+        # slow path: at least one field is bad (or a line is ragged), so go field by field
+        for (i, line) in enumerate(lines):
+            fields = line.rstrip('\r\n').split(delimiter)
+            for j in numeric_columns:
+                try:
+                    block[i, j] = float(fields[j])
+                except (IndexError, ValueError):
+                    pass
+    return block
 
 
 class ElveflowHandler_ESI:
     """a class that handles reading in Elveflow-generated log files"""
     SLEEPTIME = 0.2  # if no line exists, wait this many seconds before trying again
     QUEUE_MAXLEN = 0  # zero means infinite
+    READ_SIZE = 2**22  # read at most this many bytes (4 MiB) of backlog at a time
+    INDEX_SUFFIX = '.index.json'  # the sidecar index lives next to the log, at sourcename + INDEX_SUFFIX
+    INDEX_PERIOD = 1  # write the sidecar index at most once every this many seconds
 
     TESTING_FILENAME = 'Elveflow/temp.txt'
 
@@ -75,50 +576,145 @@ class ElveflowHandler_ESI:
             self.errorlogger = errorlogger
 
         self.header = None
-        self.buffer_queue = Queue(maxsize=ElveflowHandler_ESI.QUEUE_MAXLEN)
+        self.numeric_columns = None
+        self.last_index_write = 0
+        self.last_time = None  # the time column of the last line read
+        self.buffer_queue = Queue(maxsize=ElveflowHandler_ESI.QUEUE_MAXLEN)  # holds 2-D arrays, one per batch of lines
         self.run_flag = threading.Event()
         self.run_flag.set()
 
-    def start(self, getheader_handler=None):
-        """Start actually trying to read in data from an Elveflow log. Do not call this function more than once"""
+    def _set_header(self, header, getheader_handler=None):
+        self.header = header
+        self.numeric_columns = [i for (i, name) in enumerate(self.header) if name.strip()]
+        self.errorlogger.debug("SETTING HEADER %s" % threading.current_thread())
+        if getheader_handler is not None:
+            getheader_handler()
+
+    def _read_index(self):
+        """returns the sidecar index as a dict with keys header, offset and last_time, or None if there isn't a usable one"""
+        try:
+            with open(self.sourcename + ElveflowHandler_ESI.INDEX_SUFFIX, 'r', encoding='utf-8') as f:
+                index = json.load(f)
+            return {'header': list(index['header']), 'offset': int(index['offset']), 'last_time': index.get('last_time')}
+        except (OSError, ValueError, KeyError, TypeError):
+            return None
+
+    def _write_index(self, offset, last_time, force=False):
+        """remember how far into the log we've read, so the next start can pick up from there"""
+        if not force and time.time() - self.last_index_write < ElveflowHandler_ESI.INDEX_PERIOD:
+            return
+        index_filename = self.sourcename + ElveflowHandler_ESI.INDEX_SUFFIX
+        try:
+            # write to a temporary file and swap it in, so a crash never leaves a half-written index
+            with open(index_filename + '.tmp', 'w', encoding='utf-8') as f:
+                json.dump({'header': self.header, 'offset': offset, 'last_time': last_time}, f)
+            os.replace(index_filename + '.tmp', index_filename)
+            self.last_index_write = time.time()
+        except OSError as e:
+            self.errorlogger.warning("Could not write the log index %s: %s" % (index_filename, e))
+
+    def _find_time_offset(self, f, target_time, lo, hi):
+        """returns the byte offset of the first line in the byte range [lo, hi) whose time (the first column)
+        is at least target_time, by bisecting with seeks. lo must be the start of a line"""
+        def line_time(line):
+            try:
+                return float(line.split(b'\t', 1)[0])
+            except ValueError:
+                return float('nan')
+        while hi - lo > 4096:
+            mid = (lo + hi) // 2
+            f.seek(mid)
+            f.readline()  # skip the rest of whatever line we landed in the middle of
+            line_start = f.tell()
+            line = f.readline()
+            if line_start >= hi or not line.endswith(b'\n'):
+                hi = mid
+            elif line_time(line) >= target_time:
+                hi = line_start
+            else:
+                # NaN times also end up here, so unreadable lines never stop the search
+                lo = line_start + len(line)
+        # close enough: walk the last few lines one at a time
+        f.seek(lo)
+        while lo < hi:
+            line = f.readline()
+            if not line.endswith(b'\n') or line_time(line) >= target_time:
+                break
+            lo += len(line)
+        return lo
+
+    def _resume_offset(self, f, backfill_time=None, getheader_handler=None):
+        """figure out where to start reading, using the sidecar index if it still matches the log.
+        Returns 0 (read everything, header included) if there is no usable index"""
+        index = self._read_index()
+        if index is None:
+            return 0
+        f.seek(0)
+        header_line = f.readline()
+        size = f.seek(0, os.SEEK_END)
+        if not header_line.endswith(b'\n'):
+            return 0
+        header = next(csv.reader([header_line.decode("latin-1")], delimiter='\t'))
+        if header != index['header'] or not len(header_line) <= index['offset'] <= size:
+            self.errorlogger.info("Log index for %s does not match the log anymore; reading from the start" % self.sourcename)
+            return 0
+        self._set_header(header, getheader_handler)
+        self.last_time = index['last_time']
+        offset = index['offset']
+        if backfill_time is not None and index['last_time'] is not None:
+            offset = self._find_time_offset(f, index['last_time'] - backfill_time, len(header_line), offset)
+        self.errorlogger.debug("Resuming %s at byte %d of %d" % (self.sourcename, offset, size))
+        return offset
+
+    def start(self, getheader_handler=None, backfill_time=None):
+        """Start actually trying to read in data from an Elveflow log. Do not call this function more than once
+
+        If this log has been read before, start tailing where the last reader stopped instead of from the top.
+        If backfill_time is given, also re-read the last backfill_time seconds (in the log's own time column) before that"""
         def start_thread():
             self.errorlogger.debug("STARTING HANDLER THREAD %s" % threading.current_thread())
 
-            def line_generator():
-                with open(self.sourcename, 'a+', encoding="latin-1", newline='') as f:
+            def batch_generator():
+                with open(self.sourcename, 'a+b') as f:
                     # a+ creates the file if it doesn't exist, or just reads it if not
-                    # we can then jump to the beginning and then continue as though the mode is r
-                    f.seek(0)
+                    # we can then jump to where we left off (or the beginning) and then continue as though the mode is r
+                    f.seek(self._resume_offset(f, backfill_time, getheader_handler))
+                    partial_line = b''
                     # continuously read
                     while self.run_flag.is_set():
-                        line = f.readline()
-                        if not line.strip():
+                        chunk = f.read(ElveflowHandler_ESI.READ_SIZE)
+                        if not chunk:
                             # wait a little before trying to find more lines
                             time.sleep(ElveflowHandler_ESI.SLEEPTIME)
-                        else:
-                            # DANGER: next() can raise a StopIteration. If this does, this entire thread silently exits prematurely
-                            # I think I've avoided this with if statements, but you can't be sure.
-                            if self.header is None:
-                                # the first line should be the header
-                                self.header = next(csv.reader([line], delimiter='\t'))  # get the first (only) row from the iterator
-                                self.errorlogger.debug("SETTING HEADER %s" % threading.current_thread())
-                                if getheader_handler is not None:
-                                    getheader_handler()
-                            else:
-                                # otherwise, we already have a header, so just read in data
-                                parsedline = next(csv.DictReader([line], fieldnames=self.header, delimiter='\t'))
-                                for key in parsedline:
-                                    try:
-                                        parsedline[key] = float(parsedline[key])
-                                    except ValueError:
-                                        parsedline[key] = float('nan')
-                                yield parsedline
+                            continue
+                        # only hand off complete lines; keep the unfinished end for next time
+                        chunk = partial_line + chunk
+                        end_of_last_line = chunk.rfind(b'\n') + 1
+                        partial_line = chunk[end_of_last_line:]
+                        lines = [line for line in chunk[:end_of_last_line].decode("latin-1").splitlines(True) if line.strip()]
+                        if lines and self.header is None:
+                            # the first line should be the header
+                            self._set_header(next(csv.reader([lines.pop(0)], delimiter='\t')), getheader_handler)  # get the first (only) row from the iterator
+                        if lines:
+                            # otherwise, we already have a header, so just read in data
+                            batch = parse_esi_lines(lines, len(self.header), self.numeric_columns)
+                            self.last_time = batch[-1, 0]
+                            # the offset just past the batch, for the index once the batch is in the buffer
+                            yield batch, f.tell() - len(partial_line)
+                    if self.header is not None:
+                        yield None, f.tell() - len(partial_line)
+            read_to, read_time = None, None  # the offset past the last batch that made it into the buffer, and its time
             try:
-                for line in line_generator():
-                    self.buffer_queue.put(line, False)
-                    time.sleep(0.1)
+                for (batch, offset) in batch_generator():
+                    if batch is not None:
+                        self.buffer_queue.put(batch, False)
+                        read_time = batch[-1, 0]
+                    read_to = offset
+                    self._write_index(read_to, self.last_time, force=(batch is None))
             except Queue_Full:
-                pass
+                if read_to is not None:
+                    # resume from the last batch that was buffered, not from the one that wasn't
+                    self._write_index(read_to, read_time, force=True)
             finally:
                 self.errorlogger.debug("ENDING HANDLER THREAD %s, %s" % (threading.current_thread(), threading.enumerate()))
 
@@ -131,18 +727,16 @@ class ElveflowHandler_ESI:
         self.run_flag.clear()
 
     def fetchOne(self):
-        """retrieve the oldest element from the buffer. Afterwards, the element is no longer in the buffer.
-        If nothing is in there, return None. (You cannot tell the difference between the leftmost element of
-        the buffer holding None and the buffer being empty, but in this class, the former case should never happen)"""
+        """retrieve the oldest batch from the buffer (a 2-D array, one row per line of the log and one column
+        per entry of the header). Afterwards, the batch is no longer in the buffer. If nothing is in there, return None."""
         try:
             return self.buffer_queue.get(False)
-        except IndexError:
+        except Queue_Empty:
             return None
 
     def peekOne(self):
-        """looks at the oldest element from the buffer, but does NOT remove it from the buffer.
-        If nothing is in there, return None. (You cannot tell the difference between the leftmost element of
-        the buffer holding None and the buffer being empty, but in this class, the former case should never happen).
+        """looks at the oldest batch in the buffer, but does NOT remove it from the buffer.
+        If nothing is in there, return None.
 
         NOTE that depending on your use-case, you may wish to call this function while holding the mutex"""
         try:
@@ -150,16 +744,25 @@ class ElveflowHandler_ESI:
         except IndexError:
             return None
 
-    def fetchAll(self):
-        """retrieve all elements from the buffer as a list. Afterwards, all elements returned are no longer in the buffer.
-        In this class, the elements of the buffer are all dicts whose keys are the entries of the header"""
+    def fetchBatch(self):
+        """retrieve everything in the buffer as one 2-D array (one row per line of the log, one column per
+        entry of the header). Afterwards, all rows returned are no longer in the buffer."""
         def generateElements():
             try:
                 while True:
                     yield self.buffer_queue.get(False)
             except Queue_Empty:
                 return
-        return [elt for elt in generateElements()]
+        batches = [elt for elt in generateElements()]
+        if len(batches) == 0:
+            return np.empty((0, 0 if self.header is None else len(self.header)))
+        return np.concatenate(batches)
+
+    def fetchAll(self):
+        """retrieve all elements from the buffer as a list. Afterwards, all elements returned are no longer in the buffer.
+        In this class, the elements returned are all dicts whose keys are the entries of the header.
+        Prefer fetchBatch, which skips building a dict for every line"""
+        return [dict(zip(self.header, row)) for row in self.fetchBatch()]
 
     def getHeader(self):
         """returns the header, a list of strings"""
@@ -168,16 +771,20 @@ class ElveflowHandler_ESI:
 
 class ElveflowHandler_SDK:
     """a class that handles interfacing with the Elveflow directly"""
-    SLEEPTIME = 0.1  # how many seconds between each read of the Elveflow output
-    PID_SLEEPTIME = 0.1  # how many seconds between each command of the PID loop
-    QUEUE_MAXLEN = 0  # zero means infinite
+    SLEEPTIME = 0.1  # how many seconds between each read of the Elveflow output (the sampling period)
+    SHUTDOWN_TIMEOUT = 15  # how many seconds to allow for ramping all pressures down before closing anyway
 
-    PRESSURE_MAXSLOPE = 888 * PID_SLEEPTIME     # in mbar per update frame; the 888 is in mbar/s
+    PRESSURE_MAXSLOPE = 888 * SLEEPTIME     # in mbar per control tick; the 888 is in mbar/s
     VOLUME_KP = 50
     VOLUME_KI = 50
     VOLUME_KD = 0
+    DEFAULT_PID_CONSTANTS = (VOLUME_KP, VOLUME_KI, VOLUME_KD)
+    AUTOTUNE_RELAY_AMPLITUDE = 200  # mbar either side of the bias pressure during a relay test
+    RING_SIZE = 4096  # how many samples can pile up between fetches before the oldest are overwritten
 
-    def __init__(self, sourcename=None, errorlogger=None, sensortypes=[]):
+    def __init__(self, sourcename=None, errorlogger=None, sensortypes=[], sdk=None, clock=time):
+        """sdk is the module (or object) with the OB1_* functions, by default Elveflow64.
+        clock has monotonic(), time() and sleep(), like the time module (which is the default)"""
         if sourcename is None or sourcename == '':
             self.sourcename = b'Have you loaded the config file?'
         else:
@@ -197,78 +804,113 @@ class ElveflowHandler_SDK:
             self.errorlogger = errorlogger
         self.errorlogger.debug("Initializing Elveflow at %s" % sourcename)
 
+        if sdk is None and Elveflow_SDK is None:
+            raise OSError("Could not load Elveflow64.dll: %s" % SDK_LOAD_ERROR)
+        self.sdk = Elveflow_SDK if sdk is None else sdk
+        self.clock = clock
+        # every SDK call is timed and its error code counted (see getSDKStats)
+        self.instrumentation = SDKInstrumentation()
+        instrumented = self.instrumentation.wrap
+
         self.instr_ID = c_int32()
         self.calib = (c_double*1000)()  # always define array that way, calibration should have 1000 elements
 
-        err_code = Elveflow_SDK.OB1_Initialization(self.sourcename, 3, 3, 3, 3, byref(self.instr_ID))
+        err_code = instrumented('OB1_Initialization', self.sdk.OB1_Initialization)(self.sourcename, 3, 3, 3, 3, byref(self.instr_ID))
         # pressure sensors are hard-coded to be the 0-8000 mbar type (type 3)
         if err_code != 0:
             self.errorlogger.warning("Initialization error code %i" % err_code)
 
         self.sensortypes = sensortypes
         for i in range(len(sensortypes)):
-            err_code = Elveflow_SDK.OB1_Add_Sens(self.instr_ID.value, i+1, SensorType=sensortypes[i], DigitalAnalog=0,
+            err_code = instrumented('OB1_Add_Sens', self.sdk.OB1_Add_Sens, 1)(self.instr_ID.value, i+1, SensorType=sensortypes[i], DigitalAnalog=0,
                                                  FSens_Digit_Calib=0, FSens_Digit_Resolution=3)   # TODO: what is the resolution? What does that mean?
             if err_code != 0:
                 self.errorlogger.warning("sensor addition error code is %d" % self.instr_ID.value)
 
         # TODO: calibrations?
-        err_code = Elveflow_SDK.Elveflow_Calibration_Default(byref(self.calib), 1000)
+        err_code = instrumented('Elveflow_Calibration_Default', self.sdk.Elveflow_Calibration_Default)(byref(self.calib), 1000)
         if err_code != 0:
             self.errorlogger.warning("Calibration error code %i" % err_code)
         self.errorlogger.debug("Done initializing Elveflow")
 
         self.header = ["time [s]", "Pressure 1 [mbar]", "Pressure 2 [mbar]", "Pressure 3 [mbar]", "Pressure 4 [mbar]",
                        "Volume flow rate 1 [µL/min]", "Volume flow rate 2 [µL/min]", "Volume flow rate 3 [µL/min]", "Volume flow rate 4 [µL/min]"]
-        self.buffer_queue = Queue(maxsize=ElveflowHandler_SDK.QUEUE_MAXLEN)
+        # samples go into a preallocated ring of rows instead of a queue of dicts.
+        # ring_written and ring_read count rows ever written and fetched; the row for sample n is ring[n % RING_SIZE]
+        self.ring = np.full((ElveflowHandler_SDK.RING_SIZE, len(self.header)), np.nan)
+        self.ring_read_times = np.full((ElveflowHandler_SDK.RING_SIZE, 8), np.nan)
+        self.ring_written = 0
+        self.ring_read = 0
+        self.n_dropped = 0
+        self.ring_lock = threading.Lock()
+        # one context for the acquisition thread, and one (shared, so use its lock) for everything else
+        self.acquisition_context = SDKReadContext(self.sdk, self.instr_ID, self.calib, clock, self.instrumentation)
+        self.command_context = SDKReadContext(self.sdk, self.instr_ID, self.calib, clock, self.instrumentation)
+        self.scheduler = FixedRateScheduler(ElveflowHandler_SDK.SLEEPTIME, clock=clock.monotonic, sleep=clock.sleep)
+        # all pressure ramps and flow-rate loops run on the reading thread's tick, writing through its context
+        self.control = ControlEngine(self.acquisition_context, self.errorlogger, ElveflowHandler_SDK.SLEEPTIME, clock)
+        self.reading_thread = None
+        self.time_to_steady_state = {}  # channel number -> seconds the last run_volume took to reach steady state (None if it didn't)
+        self.pid_constants = {}  # channel number -> (kp, ki, kd), e.g. from autotune_volume; otherwise DEFAULT_PID_CONSTANTS
+        self.row_listeners = []  # functions called with each new sample, on the reading thread
         self.run_flag = threading.Event()
         self.run_flag.set()
 
+    def add_row_listener(self, listener):
+        """call listener(row) with every sample as soon as it's read, e.g. AnomalyDetector.feed.
+        It runs on the reading thread, so it must be quick, and row is a row of the ring that gets reused: copy it"""
+        self.row_listeners.append(listener)
+
     def start(self):
         def start_thread():
             print("STARTING HANDLER THREAD %s" % threading.current_thread())
+            # everything is timed on the monotonic clock, which can't jump; this turns it back into wall-clock time
+            wall_clock_offset = self.clock.time() - self.clock.monotonic()
+            self.scheduler.reset()
+            context = self.acquisition_context
             while self.run_flag.is_set():
-                data_sens = c_double()
-                get_pressure = c_double()
-
-                time.sleep(ElveflowHandler_SDK.SLEEPTIME)
-
-                newline = {}
-                for i in range(1, 5):
-                    error = Elveflow_SDK.OB1_Get_Press(self.instr_ID.value, c_int32(i), 1, byref(self.calib), byref(get_pressure), 1000)
-                    if error != 0:
-                        # self.errorlogger.warning('ERROR CODE PRESSURE %i: %s' % (i, error))
-                        pass
-                    newline[self.header[i]] = get_pressure.value
-                for i in range(1, 5):
-                    error = Elveflow_SDK.OB1_Get_Sens_Data(self.instr_ID.value, c_int32(i), 1, byref(data_sens))
-                    if error != 0:
-                        self.errorlogger.warning('ERROR CODE FLOW SENSOR %i: %s' % (i, error))
-                    newline[self.header[i+4]] = data_sens.value
-
-                newline[self.header[0]] = time.time()
-
-                try:
-                    self.buffer_queue.put(newline, False)
-                except Queue_Full:
-                    pass
+                tick = self.scheduler.wait()
+
+                # read straight into the next free row of the ring; it isn't visible to fetches until ring_written moves
+                slot = self.ring_written % ElveflowHandler_SDK.RING_SIZE
+                row = self.ring[slot]
+                context.read_all(row, self.ring_read_times[slot])
+                for i in np.flatnonzero(context.errors[4:]):
+                    self.errorlogger.warning('ERROR CODE FLOW SENSOR %i: %s' % (i+1, context.errors[4+i]))
+                # the same read drives every pressure ramp and flow-rate loop
+                self.control.tick(row, context.errors, tick)
+                # stamp the sample with the tick time so samples are evenly spaced even if the reads aren't
+                row[0] = tick + wall_clock_offset
+
+                with self.ring_lock:
+                    self.ring_written += 1
+                    if self.ring_written - self.ring_read >= ElveflowHandler_SDK.RING_SIZE:
+                        # nobody has fetched in a long time: drop the oldest sample so we never write over a row being fetched
+                        self.ring_read += 1
+                        self.n_dropped += 1
+                for listener in self.row_listeners:
+                    try:
+                        listener(row)
+                    except Exception:
+                        self.errorlogger.exception("Elveflow row listener %s failed" % listener)
 
             # Cleanup code:
+            self.errorlogger.debug("Acquisition timing: %s" % self.scheduler.stats())
+            self.errorlogger.debug("Control timing: %s" % self.control.stats())
+            self.errorlogger.debug("SDK calls:\n%s" % '\n'.join(self.instrumentation.summary()))
             try:
-                self.run_flag.set() # set this back on again to let the pressure loops run
-                def closing_function(i):
-                    if i == 4:
-                        def on_finish():
-                            print("Closing Elveflow connection")
-                            print("Elveflow closing error code (zero means good): %s" % Elveflow_SDK.OB1_Destructor(self.instr_ID.value))
-                            self.run_flag.clear() # turn it off, just in case
-                    else:
-                        def on_finish():
-                            closing_function(i+1)
-
-                    self.set_pressure_loop(i, 0, on_finish=on_finish)
-
-                closing_function(1)
+                # ramp every channel down to zero, all on the same tick, then close the connection
+                for channel_number in range(1, ControlEngine.N_CHANNELS + 1):
+                    if not self._channel_is_off(channel_number):
+                        self.control.submit(PressureRampGoal(channel_number, 0, ElveflowHandler_SDK.PRESSURE_MAXSLOPE))
+                deadline = self.clock.monotonic() + ElveflowHandler_SDK.SHUTDOWN_TIMEOUT
+                while not self.control.is_idle() and self.clock.monotonic() < deadline:
+                    tick = self.scheduler.wait()
+                    context.read_all()
+                    self.control.tick(context.row, context.errors, tick)
+                self.control.close()
+                print("Closing Elveflow connection")
+                print("Elveflow closing error code (zero means good): %s" % self.instrumentation.wrap('OB1_Destructor', self.sdk.OB1_Destructor)(self.instr_ID.value))
             except RuntimeError:
                 print("Runtime error detected in IO handler thread %s while trying to close. Ignoring." % threading.current_thread())
             finally:
@@ -278,234 +920,184 @@ class ElveflowHandler_SDK:
         self.reading_thread.start()
 
     def stop(self):
-        """Stops the reading thread."""
+        """Stops the reading thread, which ramps all pressures down to zero on its way out."""
         self.run_flag.clear()
 
+    def _channel_is_off(self, channel_number):
+        return channel_number > len(self.sensortypes) or self.sensortypes[channel_number-1] == SDK_SENSOR_TYPES["none"]
+
+    def _submit(self, goal):
+        """hand a goal to the control engine, which only ticks while the reading thread runs"""
+        if self.reading_thread is None or not self.reading_thread.is_alive():
+            self.errorlogger.warning("Elveflow is not running; channel %i goal will wait until it starts" % goal.channel_number)
+        return self.control.submit(goal)
+
+    def fetchBatch(self, with_read_times=False):
+        """retrieve everything in the buffer as one 2-D array (one row per sample, columns as in the header).
+        Afterwards, all rows returned are no longer in the buffer.
+        If with_read_times, return (rows, read_times), where read_times has the monotonic time of each of the 8 channel reads"""
+        with self.ring_lock:
+            indices = np.arange(self.ring_read, self.ring_written) % ElveflowHandler_SDK.RING_SIZE
+            rows = self.ring[indices]
+            read_times = self.ring_read_times[indices]
+            self.ring_read = self.ring_written
+        if with_read_times:
+            return rows, read_times
+        return rows
+
     def fetchOne(self):
         """retrieve the oldest element from the buffer. Afterwards, the element is no longer in the buffer.
-        If nothing is in there, return None. (You cannot tell the difference between the leftmost element of
-        the buffer holding None and the buffer being empty, but in this class, the former case should never happen)"""
-        try:
-            return self.buffer_queue.get(False)
-        except IndexError:
-            return None
+        If nothing is in there, return None. In this class, elements are dicts whose keys are the entries of the header"""
+        with self.ring_lock:
+            if self.ring_read == self.ring_written:
+                return None
+            row = self.ring[self.ring_read % ElveflowHandler_SDK.RING_SIZE].copy()
+            self.ring_read += 1
+        return dict(zip(self.header, row))
 
     def peekOne(self):
         """looks at the oldest element from the buffer, but does NOT remove it from the buffer.
-        If nothing is in there, return None. (You cannot tell the difference between the leftmost element of
-        the buffer holding None and the buffer being empty, but in this class, the former case should never happen).
-
-        NOTE that depending on your use-case, you may wish to call this function while holding the mutex"""
-        try:
-            return self.buffer_queue.queue[0]
-        except IndexError:
-            return None
+        If nothing is in there, return None."""
+        with self.ring_lock:
+            if self.ring_read == self.ring_written:
+                return None
+            row = self.ring[self.ring_read % ElveflowHandler_SDK.RING_SIZE].copy()
+        return dict(zip(self.header, row))
 
     def fetchAll(self):
         """retrieve all elements from the buffer as a list. Afterwards, all elements returned are no longer in the buffer.
-        In this class, the elements of the buffer are all dicts whose keys are the entries of the header"""
-        def generateElements():
-            try:
-                while True:
-                    yield self.buffer_queue.get(False)
-            except Queue_Empty:
-                return
-        return [elt for elt in generateElements()]
+        In this class, the elements of the buffer are all dicts whose keys are the entries of the header.
+        Prefer fetchBatch, which skips building a dict for every sample"""
+        return [dict(zip(self.header, row)) for row in self.fetchBatch()]
 
     def getHeader(self):
         """returns the header, a list of strings"""
         return self.header
 
+    def getTimingStats(self):
+        """returns live statistics about the acquisition loop's sample period, jitter and overruns (see FixedRateScheduler.stats)"""
+        return self.scheduler.stats()
+
+    def getControlStats(self):
+        """returns live statistics about the control engine's ticks and worst-case command latency (see ControlEngine.stats)"""
+        return self.control.stats()
+
+    def getSDKStats(self):
+        """returns the SDK call latency histograms, error counts and slow calls so far (see SDKInstrumentation.dump)"""
+        return self.instrumentation.dump()
+
     def setPressure(self, channel_number=4, value=300):
-        """tells the Elveflow to set the pressure directly"""
-        error = Elveflow_SDK.OB1_Set_Press(self.instr_ID.value, channel_number, value, byref(self.calib), 1000)
+        """tells the Elveflow to set the pressure directly (at the next control tick). Returns a future"""
         self.errorlogger.info('Set pressure of Channel %i to %s' % (channel_number, value))
-        if error != 0:
-            self.errorlogger.warning('ERROR CODE SET PRESSURE CHANNEL %i: %s' % (channel_number, error))
+        return self._submit(PressureRampGoal(channel_number, value))
 
     def getPressure(self, channel_number=4):
         """ask the Elveflow to tell us the pressure directly"""
-        get_pressure = c_double()
-        error = Elveflow_SDK.OB1_Get_Press(self.instr_ID.value, c_int32(channel_number), 1, byref(self.calib), byref(get_pressure), 1000)
-        if error != 0:
-            # self.errorlogger.warning('ERROR CODE PRESSURE %i: %s' % (channel_number, error))
-            pass
-        return get_pressure.value
+        with self.command_context.lock:
+            error, pressure = self.command_context.read_pressure(channel_number)
+        # a non-zero error is counted by self.instrumentation (see getSDKStats) rather than logged every time
+        return pressure
 
     def getVolume(self, channel_number=4):
         """ask the Elveflow to tell us the volume sensor reading directly"""
-        get_flowrate = c_double()
-        error = Elveflow_SDK.OB1_Get_Sens_Data(self.instr_ID.value, c_int32(channel_number), 1, byref(get_flowrate))
-
-        if error != 0:
-            # self.errorlogger.warning('ERROR CODE VOLUME %i: %s' % (channel_number, error))
-            pass
-        return get_flowrate.value
+        with self.command_context.lock:
+            error, flowrate = self.command_context.read_flowrate(channel_number)
+        # a non-zero error is counted by self.instrumentation (see getSDKStats) rather than logged every time
+        return flowrate
 
     def set_pressure_loop(self, channel_number, value, interrupt_event=None, on_finish=None):
-        """starts a thread that raises the Elveflow pressure without a big spike"""
-        if interrupt_event is None:
-            # if there isn't one already, create a dummy one
-            interrupt_event = threading.Event()
-            interrupt_event.clear()
-        def start_thread(channel_number, target, interrupt_event):
-            if self.sensortypes[channel_number-1] == SDK_SENSOR_TYPES["none"]:
-                self.errorlogger.info("Channel %s is set to \"none\" (%s); ignoring command to set pressure to %s." % (channel_number, self.sensortypes[channel_number-1], target))
-            else:
-                self.errorlogger.debug("Channel %s: starting to set pressure to %s THREAD %s." % (channel_number, target, threading.current_thread()))
-                if target > 8000:
-                    target = 8000
-                if target < 0:
-                    target = 0
-
-                get_pressure = c_double()
-                error = Elveflow_SDK.OB1_Get_Press(self.instr_ID.value, c_int32(channel_number), 1, byref(self.calib), byref(get_pressure), 1000)
-                if error != 0:
-                    self.errorlogger.warning('ERROR CODE GETTING PRESSURE %i: %s' % (channel_number, error))
-                    if on_finish is not None:
-                        on_finish()
-                    return
-
-                curr_pressure = get_pressure.value
-
-                while self.run_flag.is_set() and not interrupt_event.is_set():
-                    # if we have an error reading, don't try to set anything
-                    # self.errorlogger.debug('max slope is %s' % ElveflowHandler_SDK.PRESSURE_MAXSLOPE)
-                    # self.errorlogger.debug('requested slope is %s, and max slope is %s' % (abs(target - curr_pressure)))
-                    if abs(target - curr_pressure) <= ElveflowHandler_SDK.PRESSURE_MAXSLOPE:
-                        # if we're close, just set it and hope for the best
-                        curr_pressure = target
-                        interrupt_event.set()
-                        self.errorlogger.info("Channel %i pressure now set to %s" % (channel_number, curr_pressure))
-                    else:
-                        # otherwise, just make one PRESSURE_MAXSLOPE-sized step in the correct direction
-                        curr_pressure = curr_pressure + math.copysign(ElveflowHandler_SDK.PRESSURE_MAXSLOPE, target - curr_pressure)
-
-                    error = Elveflow_SDK.OB1_Set_Press(self.instr_ID.value, channel_number, curr_pressure, byref(self.calib), 1000)
-                    if error != 0:
-                        self.errorlogger.warning('ERROR CODE SETTING PRESSURE %i: %s' % (channel_number, error))
-                    # self.errorlogger.debug("setting pressure to %s", curr_pressure)
-
-                    time.sleep(ElveflowHandler_SDK.SLEEPTIME)
-
-                self.errorlogger.debug("Channel %s: finished setting pressure THREAD %s." % (channel_number, threading.current_thread()))
-
-            try:
-                if on_finish is not None:
-                    on_finish()
-            except RuntimeError:
-                print("Runtime error detected in pressure loop channel %s thread %s while trying to close. Ignoring." % (channel_number, threading.current_thread()))
-
-        self.command_thread = threading.Thread(target=start_thread, args=(channel_number, value, interrupt_event))
-        self.command_thread.start()
-        return self.command_thread
+        """raises the Elveflow pressure without a big spike, one step per control tick.
+        Returns a future that is done when the ramp is over (or stopped by interrupt_event); on_finish is called then too"""
+        if self._channel_is_off(channel_number):
+            self.errorlogger.info("Channel %s is set to \"none\"; ignoring command to set pressure to %s." % (channel_number, value))
+            future = Future()
+            future.set_result(None)
+        else:
+            self.errorlogger.debug("Channel %s: starting to set pressure to %s." % (channel_number, value))
+            goal = PressureRampGoal(channel_number, value, ElveflowHandler_SDK.PRESSURE_MAXSLOPE, interrupt_event)
+            future = self._submit(goal)
+
+            def log_finish(future):
+                if not future.cancelled() and future.exception() is None:
+                    self.errorlogger.info("Channel %i pressure now set to %s" % (channel_number, future.result()))
+            future.add_done_callback(log_finish)
+        if on_finish is not None:
+            future.add_done_callback(lambda future: on_finish())
+        return future
 
     def set_volume_loop(self, channel_number, value, interrupt_event=None, pid_constants=None):
-        """starts a thread that sets the Elveflow flow rate"""
-        if interrupt_event is None:
-            # if there isn't one already, create a dummy one
-            interrupt_event = threading.Event()
-            interrupt_event.clear()
+        """runs a PID loop on the control tick that sets the Elveflow flow rate, until interrupt_event is set;
+        then the pressure is ramped back to zero. Returns a future"""
         if pid_constants is None:
-            pid_constants = (ElveflowHandler_SDK.VOLUME_KP, ElveflowHandler_SDK.VOLUME_KI, ElveflowHandler_SDK.VOLUME_KD)
-
-        def start_thread(channel_number, target, interrupt_event, pid_constants):
-            self.errorlogger.debug("STARTING PRESSURE LOOP CHANNEL %s THREAD %s." % (channel_number, threading.current_thread()))
-            pid = PID(*pid_constants, setpoint=target)
-            initial_pressure = c_double()
-            error = Elveflow_SDK.OB1_Get_Press(self.instr_ID.value, c_int32(channel_number), 1, byref(self.calib), byref(initial_pressure), 1000)
-            if error != 0:
-                self.errorlogger.warning('ERROR CODE GETTING PRESSURE %i: %s' % (channel_number, error))
-            # self.errorlogger.debug("INITIAL PRESSURE IS %f" % initial_pressure.value)
-
-            while self.run_flag.is_set() and not interrupt_event.is_set():
-                time.sleep(ElveflowHandler_SDK.PID_SLEEPTIME)
-                get_flowrate = c_double()
-                error = Elveflow_SDK.OB1_Get_Sens_Data(self.instr_ID.value, c_int32(channel_number), 1, byref(get_flowrate))
-                if error != 0:
-                    self.errorlogger.warning('ERROR CODE GETTING FLOW RATE %i: %s' % (channel_number, error))
-                else:
-                    # if we have an error reading, don't try to set anything
-                    pressure_to_set = pid(get_flowrate.value) + initial_pressure.value
-
-                    if pressure_to_set > 8000:
-                        pressure_to_set = 8000
-                    elif pressure_to_set < 0:
-                        pressure_to_set = 0
-
-                    error = Elveflow_SDK.OB1_Set_Press(self.instr_ID.value, channel_number, pressure_to_set, byref(self.calib), 1000)
-                    if error != 0:
-                        self.errorlogger.warning('ERROR CODE SETTING PRESSURE %i: %s' % (channel_number, error))
-                    # self.errorlogger.debug(pressure_to_set)
-                    # self.errorlogger.debug(pid.components)
-
-            try:
-                self.errorlogger.debug("DONE WITH FLOW RATE LOOP CHANNEL %s THREAD %s; setting pressure to zero." % (channel_number, threading.current_thread()))
-                a = self.set_pressure_loop(channel_number, 0)
-                a.join()
-                self.errorlogger.debug("ENDING FLOW RATE LOOP CHANNEL %s THREAD %s." % (channel_number, threading.current_thread()))
-            except RuntimeError:
-                print("Runtime error detected in flow rate loop channel %s thread %s while trying to close. Ignoring." % (channel_number, threading.current_thread()))
-
-        self.reading_thread = threading.Thread(target=start_thread, args=(channel_number, value, interrupt_event, pid_constants))
-        self.reading_thread.start()
+            pid_constants = self.pid_constants.get(channel_number, ElveflowHandler_SDK.DEFAULT_PID_CONSTANTS)
+        self.errorlogger.debug("STARTING FLOW RATE LOOP CHANNEL %s." % channel_number)
+        return self._submit(FlowRateGoal(channel_number, value, pid_constants, interrupt_event=interrupt_event,
+                                         ramp_down_step=ElveflowHandler_SDK.PRESSURE_MAXSLOPE))
 
     def run_volume(self, channel_number, value, interrupt_event=None, pid_constants=None, margin=0.5, stable_time=0.5, timeout=60):
         """in the calling thread (i.e. this function is blocking), set the Elveflow flow rate
-        Run a volume PID loop until you are within +/- margin of the target value
-        for at least stable_time amout of seconds OR until timeout amount of seconds has passed
+        Run a volume PID loop until the flow rate is steady within +/- margin of the target value
+        over a window of stable_time seconds OR until timeout amount of seconds has passed.
+        How long it took to get steady ends up in self.time_to_steady_state[channel_number]
 
         Return the last pressure reading"""
-        if interrupt_event is None:
-            # if there isn't one already, create a dummy one
-            interrupt_event = threading.Event()
-            interrupt_event.clear()
         if pid_constants is None:
-            pid_constants = (ElveflowHandler_SDK.VOLUME_KP, ElveflowHandler_SDK.VOLUME_KI, ElveflowHandler_SDK.VOLUME_KD)
-
-        self.errorlogger.debug("STARTING PRESSURE LOOP CHANNEL %s THREAD %s." % (channel_number, threading.current_thread()))
-        pid = PID(*pid_constants, setpoint=value)
-        initial_pressure = c_double()
-        error = Elveflow_SDK.OB1_Get_Press(self.instr_ID.value, c_int32(channel_number), 1, byref(self.calib), byref(initial_pressure), 1000)
-        if error != 0:
-            self.errorlogger.warning('ERROR CODE GETTING PRESSURE %i: %s' % (channel_number, error))
-        # self.errorlogger.debug("INITIAL PRESSURE IS %f" % initial_pressure.value)
-
-        pressure_to_set = value
-        amount_of_time_stable = 0
-        init_time = time.time()
-        while self.run_flag.is_set() and not interrupt_event.is_set():
-            if time.time() - init_time > timeout:
-                break
-            time.sleep(ElveflowHandler_SDK.PID_SLEEPTIME)
-            get_flowrate = c_double()
-            error = Elveflow_SDK.OB1_Get_Sens_Data(self.instr_ID.value, c_int32(channel_number), 1, byref(get_flowrate))
-            if error != 0:
-                self.errorlogger.warning('ERROR CODE GETTING FLOW RATE %i: %s' % (channel_number, error))
-                # if we have an error reading, don't try to set anything
-            else:
-                if get_flowrate.value > (value - margin) and get_flowrate.value < (value + margin):
-                    #we've reached the end! Just quit.
-                    amount_of_time_stable += ElveflowHandler_SDK.PID_SLEEPTIME
-                    if amount_of_time_stable > stable_time:
-                        break
-                else:
-                    # We're no longer in the final range. Reset counter
-                    amount_of_time_stable = 0
-
-
-                pressure_to_set = pid(get_flowrate.value) + initial_pressure.value
-
-                if pressure_to_set > 8000:
-                    pressure_to_set = 8000
-                elif pressure_to_set < 0:
-                    pressure_to_set = 0
-
-                error = Elveflow_SDK.OB1_Set_Press(self.instr_ID.value, channel_number, pressure_to_set, byref(self.calib), 1000)
-                if error != 0:
-                    self.errorlogger.warning('ERROR CODE SETTING PRESSURE %i: %s' % (channel_number, error))
+            pid_constants = self.pid_constants.get(channel_number, ElveflowHandler_SDK.DEFAULT_PID_CONSTANTS)
+
+        self.errorlogger.debug("STARTING FLOW RATE LOOP CHANNEL %s THREAD %s." % (channel_number, threading.current_thread()))
+        goal = FlowRateGoal(channel_number, value, pid_constants, interrupt_event=interrupt_event,
+                            margin=margin, stable_time=stable_time, timeout=timeout)
+        finished = self._run_goal(goal, timeout)
+        self.time_to_steady_state[channel_number] = goal.time_to_steady_state
+        if goal.time_to_steady_state is None:
+            self.errorlogger.info("Channel %i flow rate did not reach a steady %s µL/min" % (channel_number, value))
+        else:
+            self.errorlogger.info("Channel %i flow rate steady at %s µL/min after %.1f s" % (channel_number, value, goal.time_to_steady_state))
+        if finished:
+            return goal.future.result()
+        return value if goal.pressure_to_set is None else goal.pressure_to_set
+
+    def _run_goal(self, goal, timeout):
+        """submit a goal and block until it's done. Returns whether it finished successfully"""
+        future = self._submit(goal)
+        # goals time themselves out, but only while the control tick runs
+        wait_for_futures([future], timeout=timeout + ElveflowHandler_SDK.SHUTDOWN_TIMEOUT)
+        if not future.done():
+            self.control.cancel(goal.channel_number)
+            return False
+        return not future.cancelled() and future.exception() is None
+
+    def autotune_volume(self, channel_number, value, amplitude=None, rule='tyreus-luyben', margin=0.5, stable_time=2, timeout=180, interrupt_event=None):
+        """in the calling thread (i.e. this function is blocking), work out PID constants for the flow rate loop of a channel.
+
+        A relay test around a flow rate of value gives the ultimate gain and period, which PID_TUNING_RULES[rule] turns into
+        constants. Then the channel is vented and stepped back up to value with the new constants, to see how they do.
+        Returns a dict with 'pid constants', 'settle time' (in seconds, None if it never settled within +/- margin),
+        'overshoot' (in percent), and the relay test results; returns None if it was interrupted or failed.
+        On success, the constants are kept in self.pid_constants for later flow rate loops on this channel"""
+        if amplitude is None:
+            amplitude = ElveflowHandler_SDK.AUTOTUNE_RELAY_AMPLITUDE
+        self.errorlogger.info("Autotuning channel %i around %s µL/min" % (channel_number, value))
+        relay = RelayAutotuneGoal(channel_number, value, amplitude, hysteresis=margin/2, timeout=timeout, interrupt_event=interrupt_event)
+        if not self._run_goal(relay, timeout):
+            self.errorlogger.warning("Autotune relay test on channel %i did not finish" % channel_number)
+            return None
+        result = relay.future.result()
+        pid_constants = pid_constants_from_relay(result['ultimate gain'], result['ultimate period'], rule)
 
-        return pressure_to_set
+        step_test = StepTestGoal(channel_number, value, pid_constants, ElveflowHandler_SDK.PRESSURE_MAXSLOPE,
+                                 margin=margin, stable_time=stable_time, timeout=timeout, interrupt_event=interrupt_event)
+        if not self._run_goal(step_test, 2 * timeout):
+            self.errorlogger.warning("Autotune step test on channel %i did not finish" % channel_number)
+            return None
+        times, values = zip(*step_test.history) if step_test.history else ((), ())
+        settle_time, overshoot = step_response_metrics(times, values, value, margin)
+
+        result.update({'pid constants': pid_constants, 'settle time': settle_time, 'overshoot': overshoot})
+        self.pid_constants[channel_number] = pid_constants
+        self.errorlogger.info("Autotuned channel %i: P, I, D = %.4g, %.4g, %.4g; settle time %s s, overshoot %.1f%%" %
+                              (channel_number, *pid_constants, settle_time, overshoot))
+        return result
 
 
 if USE_SDK:
@@ -0,0 +1,121 @@
+"""Continuous supervision of the sheath flow during runs.
+
+The sheath flow used to be checked once, just before a buffer/sample/buffer
+run, and then nobody looked at it again: if it drifted off (the pressure that
+run_volume settled on stops giving the right flow rate as things warm up or
+the sheath reservoir empties), the run carried on and the data was wasted.
+
+SheathFlowSupervisor looks at the last few seconds of the sheath flow sensor
+in the live store every second (no extra SDK calls: the samples are the ones
+the acquisition thread took anyway), and classifies the flow as
+
+    steady       the mean is within tolerance of the setpoint, with no drift or excessive noise
+    unsteady     the mean is on target, but noisy or drifting (e.g. still settling)
+    off target   the mean is more than tolerance away from the setpoint
+    no data      no recent samples (Elveflow not running, or the channel isn't set up)
+
+Listeners get called whenever the status changes, and correct() re-runs the
+flow-rate loop if the flow is off target, for use between the steps of a run.
+"""
+import math
+import threading
+import time
+import logging
+from hardware.SteadyState import SteadyStateDetector
+
+NO_DATA = 'no data'
+STEADY = 'steady'
+UNSTEADY = 'unsteady'
+OFF_TARGET = 'off target'
+
+
+class SheathFlowSupervisor:
+    """keeps an eye on one flow sensor channel of the store returned by get_store (a TimeSeriesStore laid out like
+    FileIO.ELVEFLOW_DATA_COLUMNS, whose times are clock.time(), i.e. straight from the Elveflow)"""
+    PERIOD = 1  # seconds between checks
+    STALE_AFTER = 2  # seconds without a new sample before the status is NO_DATA
+
+    def __init__(self, get_store, channel=None, target=None, tolerance=1, window=5, errorlogger=None, clock=time):
+        self.get_store = get_store
+        self.channel = channel
+        self.target = target
+        self.tolerance = tolerance
+        self.window = window
+        self.errorlogger = logging.getLogger("python") if errorlogger is None else errorlogger
+        self.clock = clock
+        self.status = NO_DATA
+        self.flow_stats = (float('nan'),) * 3  # (mean, standard deviation, slope) over the last window
+        self.listeners = []  # called with (supervisor, old status, new status) whenever the status changes
+        self.n_corrections = 0
+        self._lock = threading.Lock()
+        self.run_flag = threading.Event()
+        self.thread = None
+
+    def set_setpoint(self, channel, target, tolerance=None):
+        with self._lock:
+            self.channel = channel
+            self.target = target
+            if tolerance is not None:
+                self.tolerance = tolerance
+
+    def add_listener(self, listener):
+        self.listeners.append(listener)
+
+    def check(self):
+        """classify the flow over the last window seconds, update status (calling the listeners if it changed)
+        and return it"""
+        with self._lock:
+            channel, target, tolerance = self.channel, self.target, self.tolerance
+        now = self.clock.time()
+        status, flow_stats = NO_DATA, (float('nan'),) * 3
+        if channel is not None and target is not None:
+            try:
+                _, (times, flowrates) = self.get_store().window(now - self.window - self.STALE_AFTER, None,
+                                                               'time [s]', 'Volume flow rate %i [µL/min]' % channel)
+            except KeyError:
+                times = flowrates = ()
+            if len(times) > 1 and now - times[-1] <= self.STALE_AFTER:
+                # the same criteria as the pre-run check (SteadyState.is_steady)
+                detector = SteadyStateDetector(self.window, target, tolerance)
+                steady = detector.extend(times, flowrates)
+                flow_stats = detector.stats()
+                if math.isnan(flow_stats[0]):
+                    status = NO_DATA  # the sensor only gave failed reads
+                elif abs(flow_stats[0] - target) >= tolerance:
+                    status = OFF_TARGET
+                else:
+                    status = STEADY if steady else UNSTEADY
+        with self._lock:
+            old_status, self.status, self.flow_stats = self.status, status, flow_stats
+        if status != old_status:
+            for listener in self.listeners:
+                try:
+                    listener(self, old_status, status)
+                except Exception:
+                    self.errorlogger.exception("Sheath flow listener %s failed" % listener)
+        return status
+
+    def correct(self, run_volume):
+        """if the flow is off target, call run_volume(channel, target) (e.g. ElveflowDisplay.run_volume, which blocks
+        until the flow is back at the target) and return True; otherwise do nothing and return False"""
+        if self.check() != OFF_TARGET:
+            return False
+        self.errorlogger.warning("Sheath flow is %.2f µL/min instead of %s µL/min; correcting it" % (self.flow_stats[0], self.target))
+        self.n_corrections += 1
+        run_volume(self.channel, self.target)
+        return True
+
+    def start(self):
+        def run():
+            while self.run_flag.is_set():
+                try:
+                    self.check()
+                except Exception:
+                    self.errorlogger.exception("Sheath flow check failed")
+                self.clock.sleep(SheathFlowSupervisor.PERIOD)
+        self.run_flag.set()
+        self.thread = threading.Thread(target=run, name="SheathFlowSupervisor", daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.run_flag.clear()
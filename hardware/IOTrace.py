@@ -0,0 +1,168 @@
+"""A trace of everything sent to and read from a serial device, kept off the serial hot path.
+
+The microcontroller trace used to write, flush and fsync a line for every byte
+read, so polling a pump through the controller spent most of its time waiting
+for the disk. IOTrace hands records to a thread of its own through a bounded
+queue (record() never blocks; if the disk stalls for long enough that the
+queue fills up, records are dropped and counted), and that thread writes them
+in batches, fsyncing every fsync_interval seconds, or right away after an
+error record, so that whatever led up to a failure is on disk.
+
+The trace is JSON lines, one record per line:
+
+    {"t": 1571234567.123456, "dir": "tx", "device": "COM3", "hex": "2d3152554e0a0d"}
+
+with dir one of tx (written), rx (read) and error (then "message" instead of "hex").
+When the file gets bigger than max_bytes it's rotated like logging's
+RotatingFileHandler: filename.1 is the newest old one, up to filename.<backup_count>.
+"""
+import json
+import os
+import time
+import threading
+import logging
+from queue import Queue, Empty as Queue_Empty, Full as Queue_Full
+
+TX = 'tx'
+RX = 'rx'
+ERROR = 'error'
+
+
+def read_trace(filename):
+    """the records of a trace file, as dicts, with the bytes of tx and rx records under "data" """
+    records = []
+    with open(filename, encoding='utf-8') as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                continue  # a partial last line, after a crash
+            if 'hex' in record:
+                record['data'] = bytes.fromhex(record['hex'])
+            records.append(record)
+    return records
+
+
+class IOTrace:
+    """writes trace records to filename (see the top of this file) from its own thread.
+    The file is opened when the first record comes in, so a trace that's never used leaves nothing behind"""
+    MAX_QUEUE = 10000  # records
+    BATCH_SIZE = 500  # records written with one call
+    FSYNC_INTERVAL = 5.0  # seconds
+    MAX_BYTES = 10 * 2**20
+    BACKUP_COUNT = 5
+
+    def __init__(self, filename, errorlogger=None, fsync_interval=None, max_bytes=None, backup_count=None, max_queue=None, clock=time):
+        self.filename = filename
+        self.errorlogger = logging.getLogger("python") if errorlogger is None else errorlogger
+        self.fsync_interval = IOTrace.FSYNC_INTERVAL if fsync_interval is None else fsync_interval
+        self.max_bytes = IOTrace.MAX_BYTES if max_bytes is None else max_bytes
+        self.backup_count = IOTrace.BACKUP_COUNT if backup_count is None else backup_count
+        self.clock = clock
+        self.queue = Queue(maxsize=IOTrace.MAX_QUEUE if max_queue is None else max_queue)
+        self.file = None
+        self.n_written = 0
+        self.n_dropped = 0
+        self.n_fsyncs = 0
+        self.n_rotations = 0
+        self.thread = threading.Thread(target=self._run, name="IOTrace", daemon=True)
+        self.thread.start()
+
+    def record(self, direction, device, data):
+        """queue up a record of data (bytes) going in direction (TX or RX) to or from device. Never blocks"""
+        self._put((self.clock.time(), direction, str(device), bytes(data)))
+
+    def error(self, device, message):
+        """queue up an error record; the trace gets fsynced as soon as it's written"""
+        self._put((self.clock.time(), ERROR, str(device), str(message)))
+
+    def _put(self, item):
+        try:
+            self.queue.put_nowait(item)
+        except Queue_Full:
+            self.n_dropped += 1
+            if self.n_dropped == 1:
+                self.errorlogger.error("I/O trace %s can't keep up: dropping records" % self.filename)
+
+    def close(self, timeout=None):
+        """write everything queued up, fsync, close the file and stop the thread"""
+        self.queue.put(None)
+        self.thread.join(timeout)
+
+    def _run(self):
+        next_fsync = None  # when the next fsync is due, if anything has been written since the last one
+        running = True
+        while running:
+            timeout = 0.5 if next_fsync is None else max(next_fsync - time.monotonic(), 0)
+            try:
+                items = [self.queue.get(timeout=timeout)]
+            except Queue_Empty:
+                items = []
+            while len(items) < IOTrace.BATCH_SIZE:
+                try:
+                    items.append(self.queue.get_nowait())
+                except Queue_Empty:
+                    break
+            if None in items:
+                running = False
+                items = items[:items.index(None)]
+            if items and self._write(items):
+                if next_fsync is None:
+                    next_fsync = time.monotonic() + self.fsync_interval
+                if any(item[1] == ERROR for item in items):
+                    next_fsync = time.monotonic()
+            if next_fsync is not None and (time.monotonic() >= next_fsync or not running):
+                self._fsync()
+                next_fsync = None
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+    def _write(self, items):
+        lines = []
+        for (t, direction, device, data) in items:
+            record = {'t': t, 'dir': direction, 'device': device}
+            if direction == ERROR:
+                record['message'] = data
+            else:
+                record['hex'] = data.hex()
+            lines.append(json.dumps(record) + "\n")
+        try:
+            if self.file is None:
+                self.file = open(self.filename, 'a', encoding='utf-8')
+            self.file.writelines(lines)
+            self.file.flush()
+            self.n_written += len(items)
+            if self.file.tell() >= self.max_bytes:
+                self._rotate()
+            return True
+        except OSError as e:
+            self.n_dropped += len(items)
+            self.errorlogger.error("Can't write the I/O trace %s: %s" % (self.filename, e))
+            return False
+
+    def _fsync(self):
+        if self.file is None:
+            return
+        try:
+            os.fsync(self.file.fileno())
+            self.n_fsyncs += 1
+        except OSError as e:
+            self.errorlogger.error("Can't sync the I/O trace %s: %s" % (self.filename, e))
+
+    def _rotate(self):
+        self._fsync()
+        self.file.close()
+        self.file = None
+        for i in range(self.backup_count - 1, 0, -1):
+            if os.path.exists("%s.%d" % (self.filename, i)):
+                os.replace("%s.%d" % (self.filename, i), "%s.%d" % (self.filename, i + 1))
+        if self.backup_count > 0:
+            os.replace(self.filename, self.filename + ".1")
+        else:
+            os.remove(self.filename)
+        self.n_rotations += 1
+
+    def stats(self):
+        return {'records written': self.n_written, 'records dropped': self.n_dropped, 'fsyncs': self.n_fsyncs,
+                'rotations': self.n_rotations, 'backlog': self.queue.qsize()}
@@ -0,0 +1,131 @@
+"""Knowing when a pump is done, without asking it ten times a second.
+
+Waiting for a pump used to mean calling is_running() every 0.1 s: a locked
+serial transaction each time, so during a three-minute infusion the bus (and
+the lock shared with the valves on the same controller) was busy with status
+queries. But a pump started for a volume at a rate is going to stop at a
+predictable time, so PumpCompletionTracker, a single thread for all the pumps:
+
+    sleeps until shortly before the predicted end, apart from a check every SANITY_PERIOD seconds
+    (in case the pump stopped early, e.g. it stalled or someone pressed stop)
+    then polls faster and faster as the end approaches, down to MIN_POLL
+    and if the pump is still running after the predicted end (a slow pump clock, a paused pump),
+    backs off again, up to MAX_POLL
+
+watch() returns a concurrent.futures.Future per pump run, which gets the time
+(time.time()) at which the pump was seen stopped, or the exception if asking
+it failed. If the rate changes halfway, repredict() moves the predicted end.
+A three-minute infusion costs about a dozen polls instead of ~1800.
+"""
+import heapq
+import itertools
+import threading
+import time
+import logging
+from concurrent.futures import Future, InvalidStateError
+
+
+def resolve(future, result):
+    """set the result of future, unless it's been resolved (or cancelled) already"""
+    try:
+        future.set_result(result)
+    except InvalidStateError:
+        pass
+
+
+def next_poll_time(now, predicted_end, early, min_poll, max_poll, sanity_period):
+    """when to next ask a pump that's expected to stop at predicted_end (all in seconds, on the same clock)"""
+    remaining = predicted_end - now
+    if remaining > early:
+        return min(predicted_end - early, now + sanity_period)
+    if remaining > 0:
+        return now + max(min_poll, remaining / 2)  # closing in on the end
+    return now + min(max_poll, max(min_poll, -remaining / 2))  # late: back off
+
+
+class PumpCompletionTracker:
+    """watches pumps (anything with is_running()) until they stop, from a thread of its own"""
+    EARLY = 0.5  # seconds before the predicted end to start polling
+    MIN_POLL = 0.05  # seconds
+    MAX_POLL = 1.0  # seconds
+    SANITY_PERIOD = 30.0  # seconds between checks while the end is still far off
+
+    def __init__(self, errorlogger=None):
+        self.errorlogger = logging.getLogger("python") if errorlogger is None else errorlogger
+        self._condition = threading.Condition()
+        self._heap = []  # (next poll time, tie-breaker, pump, future, predicted end)
+        self._predictions = {}  # future -> its latest predicted end; heap entries with an older one are stale
+        self._counter = itertools.count()
+        self.n_polls = 0
+        self.thread = None
+
+    def watch(self, pump, duration):
+        """start watching pump, which should stop in about duration seconds from now. Returns a Future"""
+        future = Future()
+        self._schedule(pump, future, duration)
+        return future
+
+    def repredict(self, pump, future, duration):
+        """the pump watched for future should now stop in about duration seconds from now"""
+        if not future.done():
+            self._schedule(pump, future, duration)
+
+    def _schedule(self, pump, future, duration):
+        now = time.monotonic()
+        predicted_end = now + duration
+        first_poll = next_poll_time(now, predicted_end, self.EARLY, self.MIN_POLL, self.MAX_POLL, self.SANITY_PERIOD)
+        with self._condition:
+            self._predictions[future] = predicted_end
+            heapq.heappush(self._heap, (first_poll, next(self._counter), pump, future, predicted_end))
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._run, name="PumpCompletionTracker", daemon=True)
+                self.thread.start()
+            self._condition.notify()
+
+    def _is_stale(self, item):
+        if item[3].done():
+            self._predictions.pop(item[3], None)
+            return True
+        return self._predictions.get(item[3]) != item[4]
+
+    def _run(self):
+        while True:
+            with self._condition:
+                while True:
+                    # forget about anything resolved meanwhile (e.g. the pump was stopped), or repredicted
+                    while self._heap and self._is_stale(self._heap[0]):
+                        heapq.heappop(self._heap)
+                    if not self._heap:
+                        self._condition.wait()
+                        continue
+                    wait = self._heap[0][0] - time.monotonic()
+                    if wait <= 0:
+                        break
+                    self._condition.wait(wait)
+                _, _, pump, future, predicted_end = heapq.heappop(self._heap)
+            try:
+                running = pump.is_running()
+            except Exception as e:
+                self.errorlogger.debug("Can't tell whether %s is still running: %s" % (getattr(pump, 'name', pump), e))
+                try:
+                    future.set_exception(e)
+                except InvalidStateError:
+                    pass
+                with self._condition:
+                    self._predictions.pop(future, None)
+                continue
+            self.n_polls += 1
+            if not running:
+                resolve(future, time.time())
+                with self._condition:
+                    self._predictions.pop(future, None)
+                continue
+            now = time.monotonic()
+            poll = next_poll_time(now, predicted_end, self.EARLY, self.MIN_POLL, self.MAX_POLL, self.SANITY_PERIOD)
+            with self._condition:
+                heapq.heappush(self._heap, (poll, next(self._counter), pump, future, predicted_end))
+
+    def stats(self):
+        with self._condition:
+            watching = sum(1 for future in self._predictions if not future.done())
+        return {'polls': self.n_polls, 'watching': watching}
@@ -0,0 +1,438 @@
+"""Recording Elveflow samples to disk without holding up acquisition.
+
+RecordingWriter is a pipeline stage with its own thread: the polling thread
+hands it batches of rows through a bounded queue (which never blocks), and
+the writer thread formats and writes them in batches, flushes them every
+flush_interval seconds and fsyncs according to the fsync policy. Each run
+segment (from start_saving to stop_saving) goes to its own file, and
+rotating files goes through the same queue as the data, so no row ends up
+in the wrong file.
+
+If the disk can't keep up for long enough that the queue fills up, new
+batches are dropped (and counted, and logged) rather than stalling the
+polling thread and the plot.
+
+Recordings are either CSV (CSVSegment, as always) or a compact binary format
+(BinarySegment) that is much smaller and faster to reload for analysis:
+
+    8 bytes     BINARY_MAGIC
+    8 bytes     the length of the header block (little-endian unsigned)
+    header      JSON: {"columns": [...], "created": ..., "index stride": ...}, padded with spaces to a multiple of 8 bytes
+    rows        fixed-width little-endian float64 rows, one value per column, appended as they come in
+
+plus a sidecar file (filename + BINARY_INDEX_SUFFIX) of float64 (time, row) pairs for every
+`index stride`th row, so BinaryRecording can find any time window by looking at only a few pages
+of a numpy.memmap of the rows. The time is the first column. A crash can at worst leave a partial
+last row, which the loader ignores. The converters at the end translate to and from CSV and ESI logs.
+"""
+import csv
+import json
+import os
+import time
+import threading
+import logging
+from collections import deque
+from queue import Queue, Empty as Queue_Empty, Full as Queue_Full
+import numpy as np
+from hardware.FileIO import parse_esi_lines
+
+FSYNC_NEVER = 'never'  # leave it to the OS (fastest, but a power cut can lose the last few seconds)
+FSYNC_ON_FLUSH = 'flush'  # fsync after every periodic flush
+FSYNC_ON_CLOSE = 'close'  # fsync only when a segment's file is closed
+FSYNC_POLICIES = (FSYNC_NEVER, FSYNC_ON_FLUSH, FSYNC_ON_CLOSE)
+
+BINARY_MAGIC = b'ELVFREC1'
+BINARY_SUFFIX = '.elvbin'
+BINARY_INDEX_SUFFIX = '.tidx'
+BINARY_INDEX_STRIDE = 1024  # rows between time index entries
+CONVERT_CHUNK_ROWS = 2**16  # how many rows the converters handle at a time
+
+
+class CSVSegment:
+    """one recording file, in the same CSV format as always (a header line, then one line per sample)"""
+
+    def __init__(self, filename, header):
+        self.filename = filename
+        self.file = open(filename, 'a', encoding="utf-8", newline='')
+        self.writer = csv.writer(self.file)
+        self.writer.writerow(header)
+
+    def write(self, rows):
+        # str() of a Python float is the same as what csv.writer writes for it
+        self.writer.writerows(rows.tolist() if isinstance(rows, np.ndarray) else rows)
+
+    def flush(self, fsync=False):
+        self.file.flush()
+        if fsync:
+            os.fsync(self.file.fileno())
+
+    def close(self, fsync=False):
+        self.flush(fsync)
+        self.file.close()
+
+
+class BinarySegment:
+    """one recording file in the binary format (see the top of this file). Appending to an existing
+    recording only works if it has the same columns"""
+
+    def __init__(self, filename, header, index_stride=BINARY_INDEX_STRIDE):
+        self.filename = filename
+        self.width = len(header)
+        if os.path.exists(filename) and os.path.getsize(filename) > 0:
+            existing = BinaryRecording(filename)
+            if existing.columns != list(header):
+                raise ValueError("%s already holds a recording with other columns" % filename)
+            self.index_stride = existing.index_stride
+            self.n_rows = len(existing)
+            existing.close()
+            with open(filename, 'r+b') as f:
+                # cut off a partial row left over from a crash
+                f.truncate(existing.data_offset + self.n_rows * 8 * self.width)
+            self.file = open(filename, 'ab')
+        else:
+            self.index_stride = index_stride
+            self.n_rows = 0
+            self.file = open(filename, 'wb')
+            header_block = json.dumps({'columns': list(header), 'created': time.time(), 'index stride': index_stride}).encode('utf-8')
+            header_block += b' ' * (-len(header_block) % 8)
+            self.file.write(BINARY_MAGIC + np.uint64(len(header_block)).astype('<u8').tobytes() + header_block)
+        self.index_file = open(filename + BINARY_INDEX_SUFFIX, 'ab')
+
+    def write(self, rows):
+        rows = np.ascontiguousarray(rows, dtype='<f8').reshape(-1, self.width)
+        if len(rows) == 0:
+            return
+        self.file.write(rows.tobytes())
+        # index every row whose number is a multiple of the stride
+        first = -(-self.n_rows // self.index_stride) * self.index_stride
+        indexed = np.arange(first, self.n_rows + len(rows), self.index_stride)
+        if len(indexed) > 0:
+            entries = np.column_stack((rows[indexed - self.n_rows, 0], indexed)).astype('<f8')
+            self.index_file.write(entries.tobytes())
+        self.n_rows += len(rows)
+
+    def flush(self, fsync=False):
+        self.file.flush()
+        self.index_file.flush()
+        if fsync:
+            os.fsync(self.file.fileno())
+            os.fsync(self.index_file.fileno())
+
+    def close(self, fsync=False):
+        self.flush(fsync)
+        self.file.close()
+        self.index_file.close()
+
+
+class BinaryRecording:
+    """reads a binary recording through a numpy.memmap, so even a multi-GB run opens instantly
+    and only the parts actually looked at are read from disk"""
+
+    def __init__(self, filename):
+        self.filename = filename
+        with open(filename, 'rb') as f:
+            if f.read(len(BINARY_MAGIC)) != BINARY_MAGIC:
+                raise ValueError("%s is not a binary Elveflow recording" % filename)
+            header_size = int(np.frombuffer(f.read(8), dtype='<u8')[0])
+            header = json.loads(f.read(header_size).decode('utf-8'))
+        self.columns = list(header['columns'])
+        self.column_map = {name: i for (i, name) in enumerate(self.columns)}
+        self.created = header.get('created')
+        self.index_stride = int(header.get('index stride', BINARY_INDEX_STRIDE))
+        self.width = len(self.columns)
+        self.data_offset = len(BINARY_MAGIC) + 8 + header_size
+        n_rows = max(os.path.getsize(filename) - self.data_offset, 0) // (8 * self.width) if self.width else 0
+        if n_rows > 0:
+            self.data = np.memmap(filename, dtype='<f8', mode='r', offset=self.data_offset, shape=(n_rows, self.width))
+        else:
+            self.data = np.empty((0, self.width))
+        self.index_times, self.index_rows = self._load_index()
+
+    def _load_index(self):
+        try:
+            entries = np.fromfile(self.filename + BINARY_INDEX_SUFFIX, dtype='<f8')
+            entries = entries[:len(entries) // 2 * 2].reshape(-1, 2)
+            entries = entries[entries[:, 1] < len(self)]
+        except OSError:
+            entries = np.empty((0, 2))
+        expected = -(-len(self) // self.index_stride)
+        if len(entries) != expected:
+            # no index, or one that doesn't match (e.g. it was lost in a crash): rebuild it from every stride-th row
+            rows = np.arange(0, len(self), self.index_stride)
+            return np.array(self.data[rows, 0]), rows
+        return entries[:, 0].copy(), entries[:, 1].astype(np.int64)
+
+    def __len__(self):
+        return len(self.data)
+
+    def close(self):
+        """let go of the memmap (the views handed out keep it open until they're gone too)"""
+        self.data = np.empty((0, self.width))
+
+    def _index(self, key):
+        if isinstance(key, (int, np.integer)):
+            return int(key)
+        return self.column_map[key]
+
+    def column(self, key):
+        """a view of one column (by name or index) of the whole recording"""
+        return self.data[:, self._index(key)]
+
+    def _find_row(self, t, side):
+        """the row where t would go in the time column (like numpy.searchsorted), looking at only about one
+        index stride of rows. The time index narrows it down to between two indexed rows"""
+        i = int(np.searchsorted(self.index_times, t, side=side))
+        lo = self.index_rows[i - 1] if i > 0 else 0
+        hi = self.index_rows[i] if i < len(self.index_rows) else len(self)
+        return lo + int(np.searchsorted(self.data[lo:hi, 0], t, side=side))
+
+    def window(self, start_time, end_time, *keys):
+        """views of several columns, of the rows with start_time <= time <= end_time (end_time None means up
+        to the end). Returns (the index of the first row returned, list of views), like TimeSeriesStore.window"""
+        first = self._find_row(start_time, 'left')
+        last = len(self) if end_time is None else max(self._find_row(end_time, 'right'), first)
+        return first, [self.data[first:last, self._index(key)] for key in keys]
+
+
+def _read_delimited(filename, delimiter, chunk_rows=CONVERT_CHUNK_ROWS):
+    """yields the header of a delimited text file, then its rows as float arrays of up to chunk_rows rows"""
+    with open(filename, 'r', encoding='latin-1' if delimiter == '\t' else 'utf-8', newline='') as f:
+        header = next(csv.reader([f.readline()], delimiter=delimiter))
+        yield header
+        numeric_columns = [i for (i, name) in enumerate(header) if name.strip()]
+        lines = []
+        for line in f:
+            if line.strip():
+                lines.append(line)
+            if len(lines) == chunk_rows:
+                yield parse_esi_lines(lines, len(header), numeric_columns, delimiter)
+                lines = []
+        if lines:
+            yield parse_esi_lines(lines, len(header), numeric_columns, delimiter)
+
+
+def _text_to_binary(text_filename, binary_filename, delimiter):
+    chunks = _read_delimited(text_filename, delimiter)
+    header = next(chunks)
+    if os.path.exists(binary_filename):
+        raise FileExistsError(binary_filename)
+    segment = BinarySegment(binary_filename, header)
+    try:
+        for chunk in chunks:
+            segment.write(chunk)
+    finally:
+        segment.close()
+
+
+def csv_to_binary(csv_filename, binary_filename):
+    """convert a CSV recording (see CSVSegment) into a new binary recording"""
+    _text_to_binary(csv_filename, binary_filename, ',')
+
+
+def esi_to_binary(esi_filename, binary_filename):
+    """convert a tab-separated log written by the Elveflow software (ESI) into a new binary recording"""
+    _text_to_binary(esi_filename, binary_filename, '\t')
+
+
+def binary_to_csv(binary_filename, csv_filename, chunk_rows=CONVERT_CHUNK_ROWS):
+    """convert a binary recording into a CSV one, in the same format RecordingWriter writes"""
+    recording = BinaryRecording(binary_filename)
+    with open(csv_filename, 'x', encoding="utf-8", newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(recording.columns)
+        for start in range(0, len(recording), chunk_rows):
+            writer.writerows(recording.data[start:start + chunk_rows].tolist())
+
+
+def binary_to_esi(binary_filename, esi_filename, chunk_rows=CONVERT_CHUNK_ROWS):
+    """convert a binary recording into a tab-separated log like the Elveflow software writes (which
+    ElveflowHandler_ESI can read). Columns without a name (like the one after the trailing tab) stay empty"""
+    recording = BinaryRecording(binary_filename)
+    named = [bool(name.strip()) for name in recording.columns]
+    with open(esi_filename, 'x', encoding='latin-1', newline='') as f:
+        f.write('\t'.join(recording.columns) + '\n')
+        for start in range(0, len(recording), chunk_rows):
+            f.writelines('\t'.join(repr(x) if is_named else '' for (x, is_named) in zip(row, named)) + '\n'
+                         for row in recording.data[start:start + chunk_rows].tolist())
+
+
+class RecordingWriter:
+    """writes batches of rows to a sequence of files (one per run segment) from its own thread
+
+    Call open_segment(filename, header) to start a file, write(rows) as often as you like, and close_segment() at
+    the end of the segment. All three only queue up work and return immediately. close() finishes writing everything
+    queued up and stops the thread."""
+    MAX_QUEUE = 1000  # batches; at 10 polls per second, that's more than a minute and a half of a stalled disk
+    BATCH_SIZE = 50  # how many queued batches get written with one call
+    FLUSH_INTERVAL = 1.0  # seconds
+    STATS_WINDOW = 600  # how many recent writes the latency statistics cover
+
+    def __init__(self, errorlogger=None, fsync=FSYNC_ON_FLUSH, flush_interval=None, max_queue=None, segment_class=CSVSegment):
+        if fsync not in FSYNC_POLICIES:
+            raise ValueError("fsync must be one of %s" % (FSYNC_POLICIES,))
+        self.errorlogger = logging.getLogger("python") if errorlogger is None else errorlogger
+        self.fsync = fsync
+        self.flush_interval = RecordingWriter.FLUSH_INTERVAL if flush_interval is None else flush_interval
+        self.segment_class = segment_class
+        self.queue = Queue(maxsize=RecordingWriter.MAX_QUEUE if max_queue is None else max_queue)
+        self.segment = None
+        self._lock = threading.Lock()
+        self.queued_rows = 0  # rows in the queue right now
+        self.max_queued_rows = 0
+        self.rows_written = 0
+        self.rows_dropped = 0
+        self.n_writes = 0
+        self.latencies = deque(maxlen=RecordingWriter.STATS_WINDOW)  # seconds from write() until the rows hit the file
+        self.write_durations = deque(maxlen=RecordingWriter.STATS_WINDOW)  # seconds spent in each batched write
+        self.last_flush = None
+        self.filenames = []  # every file opened so far
+        self.thread = threading.Thread(target=self._run, name="RecordingWriter")
+        self.thread.start()
+
+    def open_segment(self, filename, header):
+        """start writing to a new file (closing the current one, if any)"""
+        self.queue.put(('open', filename, list(header)))
+
+    def close_segment(self):
+        """close the current file, once everything written to it so far is in it"""
+        self.queue.put(('close',))
+
+    def write(self, rows):
+        """queue up rows (a 2-D array, or a list of sequences) to be written to the current file. Never blocks"""
+        n = len(rows)
+        if n == 0:
+            return
+        try:
+            self.queue.put_nowait(('write', rows, time.monotonic()))
+        except Queue_Full:
+            with self._lock:
+                self.rows_dropped += n
+                first_drop = (self.rows_dropped == n)
+            if first_drop:
+                self.errorlogger.error("Recording can't keep up: dropping rows instead of holding up acquisition")
+            return
+        with self._lock:
+            self.queued_rows += n
+            self.max_queued_rows = max(self.max_queued_rows, self.queued_rows)
+
+    def close(self, timeout=None):
+        """write everything queued up, close the current file and stop the thread"""
+        self.queue.put(None)
+        self.thread.join(timeout)
+
+    def _run(self):
+        next_flush = time.monotonic() + self.flush_interval
+        running = True
+        while running:
+            try:
+                items = [self.queue.get(timeout=max(next_flush - time.monotonic(), 0))]
+            except Queue_Empty:
+                items = []
+            while len(items) < RecordingWriter.BATCH_SIZE:
+                try:
+                    items.append(self.queue.get_nowait())
+                except Queue_Empty:
+                    break
+            pending = []  # consecutive write items, written with one call
+            for item in items:
+                if item is not None and item[0] == 'write':
+                    pending.append(item)
+                    continue
+                self._write(pending)
+                pending = []
+                if item is None:
+                    running = False
+                    break
+                elif item[0] == 'open':
+                    self._close_segment()
+                    self._open_segment(*item[1:])
+                elif item[0] == 'close':
+                    self._close_segment()
+            self._write(pending)
+            if time.monotonic() >= next_flush:
+                self._flush()
+                next_flush = time.monotonic() + self.flush_interval
+        self._close_segment()
+
+    def _open_segment(self, filename, header):
+        try:
+            self.segment = self.segment_class(filename, header)
+            self.filenames.append(filename)
+        except (OSError, ValueError) as e:
+            self.errorlogger.error("Can't record to %s: %s" % (filename, e))
+            self.segment = None
+
+    def _close_segment(self):
+        if self.segment is None:
+            return
+        try:
+            self.segment.close(fsync=(self.fsync != FSYNC_NEVER))
+        except OSError as e:
+            self.errorlogger.error("Error closing %s: %s" % (self.segment.filename, e))
+        self.segment = None
+
+    def _write(self, items):
+        if not items:
+            return
+        n = sum(len(item[1]) for item in items)
+        with self._lock:
+            self.queued_rows -= n
+        if self.segment is None:
+            # nowhere to write to (not saving, or the file couldn't be opened)
+            with self._lock:
+                self.rows_dropped += n
+            return
+        start = time.monotonic()
+        try:
+            for item in items:
+                self.segment.write(item[1])
+        except OSError as e:
+            self.errorlogger.error("Error writing to %s: %s" % (self.segment.filename, e))
+            with self._lock:
+                self.rows_dropped += n
+            return
+        end = time.monotonic()
+        with self._lock:
+            self.rows_written += n
+            self.n_writes += 1
+            self.write_durations.append(end - start)
+            self.latencies.extend(end - item[2] for item in items)
+
+    def _flush(self):
+        if self.segment is None:
+            return
+        try:
+            self.segment.flush(fsync=(self.fsync == FSYNC_ON_FLUSH))
+            self.last_flush = time.time()
+        except OSError as e:
+            self.errorlogger.error("Error flushing %s: %s" % (self.segment.filename, e))
+
+    def stats(self):
+        """returns a dict of statistics about the writes so far (times in seconds)"""
+        with self._lock:
+            latencies = np.array(self.latencies)
+            durations = np.array(self.write_durations)
+            return {
+                'rows written': self.rows_written,
+                'rows dropped': self.rows_dropped,
+                'batched writes': self.n_writes,
+                'backlog rows': self.queued_rows,
+                'max backlog rows': self.max_queued_rows,
+                'mean latency': float(np.mean(latencies)) if len(latencies) else float('nan'),
+                'max latency': float(np.max(latencies)) if len(latencies) else float('nan'),
+                'mean write time': float(np.mean(durations)) if len(durations) else float('nan'),
+                'last flush': self.last_flush,
+                'files': list(self.filenames),
+            }
+
+
+if __name__ == '__main__':
+    # convert between recording formats, e.g. python -m hardware.Recording Elveflow/run_1573849123.csv run.elvbin
+    import sys
+    source, destination = sys.argv[1:3]
+    if source.endswith(BINARY_SUFFIX):
+        (binary_to_csv if destination.endswith('.csv') else binary_to_esi)(source, destination)
+    elif destination.endswith(BINARY_SUFFIX):
+        (csv_to_binary if source.endswith('.csv') else esi_to_binary)(source, destination)
+    else:
+        sys.exit("one of the files has to be a binary recording (%s)" % BINARY_SUFFIX)
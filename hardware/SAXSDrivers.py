@@ -10,7 +10,11 @@ Josue San Emeterio
 """
 import serial
 import serial.tools.list_ports
-import time, os
+import math
+import time
+from concurrent.futures import TimeoutError as FutureTimeout, CancelledError
+from hardware.IOTrace import IOTrace, TX, RX
+from hardware.PumpCompletion import PumpCompletionTracker, resolve
 
 
 def list_available_ports(optional_list=[]):   # Does the optional list input do anything? Should we just initialize an empty list for the output?
@@ -28,16 +32,81 @@ def InstrumentTerminateFunction(instrument_list):
             instrument.stop()
 
 
+# a Harvard pump ends every reply with a prompt: its address and one of these (stopped, refilling, infusing, paused/stalled)
+PUMP_PROMPTS = b":<>*"
+PUMP_POLL_INTERVAL = 0.002  # seconds between checks for more of a reply
+# how a pump shows the units of a rate, and the units to set it in
+PUMP_RATE_UNITS = {b"ul/m": "UM", b"ml/m": "MM", b"ul/h": "UH", b"ml/h": "MH"}
+PUMP_RATE_ML_PER_S = {"UM": 1 / 60000, "MM": 1 / 60, "UH": 1 / 3600000, "MH": 1 / 3600}  # ml/s per unit of rate
+
+
+class PumpTimeout(RuntimeError):
+    """a pump didn't finish replying in time"""
+
+
+class PumpReplyReader:
+    """reads the replies of the pump at address off port, one at a time. Each reply ends with the pump's prompt, and
+    whatever comes after it is kept for the next reply, so several commands can be sent before reading any replies"""
+
+    def __init__(self, port, address, log=None):
+        self.port = port
+        self.address = address
+        self.prompt_address = address.encode().lstrip(b"0")  # address 0 may or may not be printed
+        self.log = log  # gets the raw bytes of every reply
+        self.buffer = b""
+
+    def _split(self):
+        """take the first complete reply off the buffer, or return None if there isn't one yet"""
+        start = 0
+        while True:
+            end = self.buffer.find(b"\n", start)
+            line_end = len(self.buffer) if end < 0 else end
+            line = self.buffer[start:line_end].strip()
+            if line[-1:] and line[-1:] in PUMP_PROMPTS and line[:-1].lstrip(b"0") == self.prompt_address:
+                reply, self.buffer = self.buffer[:line_end], self.buffer[line_end:]
+                if self.log is not None:
+                    self.log(reply)
+                lines = [line.strip() for line in reply.splitlines()[:-1]]
+                return [line for line in lines if line], line[-1:].decode()
+            if end < 0:
+                return None
+            start = end + 1
+
+    def next(self, timeout):
+        """the next reply: (the non-empty lines before the prompt, as bytes, the prompt character as a string), as soon
+        as the prompt has arrived. Raises PumpTimeout if it isn't complete within timeout seconds"""
+        deadline = time.monotonic() + timeout
+        while True:
+            reply = self._split()
+            if reply is not None:
+                return reply
+            waiting = self.port.in_waiting
+            if waiting > 0:
+                self.buffer += self.port.read(waiting)
+            elif time.monotonic() > deadline:
+                if self.log is not None:
+                    self.log(self.buffer)
+                raise PumpTimeout("no complete reply from pump %s within %.1f s (got %r)" % (self.address, timeout, self.buffer))
+            else:
+                time.sleep(PUMP_POLL_INTERVAL)
+
+
+def read_pump_reply(port, address, timeout, log=None):
+    """read the reply of the pump at address to a command, up to and including its prompt, and return as soon as the
+    prompt has arrived. Returns (the non-empty lines before the prompt, as bytes, the prompt character as a string).
+    Raises PumpTimeout if the reply isn't complete within timeout seconds. log, if given, gets the raw reply"""
+    return PumpReplyReader(port, address, log).next(timeout)
+
+
 class SAXSController(serial.Serial):
     """Class for communication with devices using the USB box."""
 
-    def __init__(self, logger=[], **kwargs):
+    def __init__(self, logger=[], trace_fsync_interval=None, **kwargs):
         """Initialize class."""
+        self.trace = IOTrace('log/pump_%d.jsonl' % time.time(), fsync_interval=trace_fsync_interval)
         super().__init__(**kwargs)
         self.logger = logger
         self.enabled = False
-        self.temp_logger = open('log/pump_%d.log' % time.time(), 'w+')
-        # TODO: close properly
 
     def set_port(self, port, instrument_list=[]):
         """Set the serial port."""
@@ -74,18 +143,26 @@ class SAXSController(serial.Serial):
         while self.in_waiting > 0:
             self.logger.info(self.readline().decode())
 
+    def write(self, data):
+        self.trace.record(TX, self.port, data)
+        return super().write(data)
+
+    def log_read(self, value):
+        """add what was read from the controller to the trace"""
+        self.trace.record(RX, self.port, value)
+
+    def log_error(self, message):
+        """add an error to the trace (which gets it on disk right away, with everything before it)"""
+        self.trace.error(self.port, message)
+
     def read_check(self):
         value = self.read()
-        self.temp_logger.write("%d:   "%time.time() + repr(value) + "\n")
-        self.temp_logger.flush()
-        os.fsync(self.temp_logger.fileno())
+        self.log_read(value)
         return value
 
     def readline_check(self):
         value = self.readline()
-        self.temp_logger.write("%d:   "%time.time() + repr(value) + "\n")
-        self.temp_logger.flush()
-        os.fsync(self.temp_logger.fileno())
+        self.log_read(value)
         return value
 
 
@@ -104,6 +181,8 @@ class HPump:
 
     # Variable to keep track if pump has a valid port-> Avoids crashing when not set up
     enabled = False
+    REPLY_TIMEOUT = 1.0  # seconds for a pump to finish replying to a command
+    completion_tracker = None  # shared by all the pumps, so they're all polled from one thread; see _track
 
     def __init__(self, address=0, pc_connect=True, running=False, infusing=True, name="Pump", logger=[], hardware_configuration="", lock=None):
         """Initialize HPump."""
@@ -116,6 +195,12 @@ class HPump:
         self.instrument_type = "Pump"
         self.hardware_configuration = hardware_configuration
         self._lock = lock
+        # what the pump was last set to (and confirmed), so it isn't sent again: 'direction', 'mode', 'target volume',
+        # and 'infuse rate'/'refill rate' as (rate, units). Forgotten after errors, stops and reconnects; see resync
+        self.settings = {}
+        # when the current volume program should end (time.time()), and a Future that's resolved when it has
+        self.predicted_end = None
+        self.completion = None
         # add init for syringe dismeter,flowrate, Direction etc
 
     # function to initialize ports
@@ -125,6 +210,7 @@ class HPump:
             resource.close()
         resource.port = port
         self.pc_connect = True
+        self.invalidate_settings()
         HPump.enabled = True
         self.logger.info(self.name+" port set to "+port)
 
@@ -137,6 +223,7 @@ class HPump:
         self.pc_connect = False
         self.controller = controller
         HPump.enabled = controller.enabled
+        self.invalidate_settings()
         self.logger.info(self.name+" set to Microntroller")
 
     def change_values(self, address, name):
@@ -147,162 +234,162 @@ class HPump:
         if self.address != address:
             self.logger.info("Setting "+self.name+" address: "+ str(address))
             self.address = str(address)
+            self.invalidate_settings()  # a different pump
+
+    def invalidate_settings(self):
+        """forget what the pump was set to, so that everything gets sent again"""
+        self.settings = {}
+
+    def resync(self, resource=pumpserial):
+        """read all the settings back from the pump (e.g. after someone used its keypad) and remember them"""
+        with self._lock:
+            self.invalidate_settings()
+            settings = {
+                'direction': self.check_direction(None, resource),
+                'mode': self.check_mode(None, resource),
+                'target volume': self.check_target_volume(resource),
+                'infuse rate': self.check_infuse_rate(resource, with_units=True),
+                'refill rate': self.check_refill_rate(resource, with_units=True),
+            }
+            self.settings = settings
+            self.infusing = settings['direction'] == "INFUSE"
+            self.infuserate = settings['infuse rate'][0]
+            self.fillrate = settings['refill rate'][0]
+            self.logger.info(self.name+" settings: "+", ".join("%s %s" % item for item in settings.items()))
+            return settings
 
 # Pump action commands
-# To do in all. Read in confirmstion from pump.
+# Every command gets a reply from the pump, ending in its prompt; _transact waits for exactly that
+
+    def _port(self, resource):
+        """the serial port this pump is on (opened if need be), and the prefix that routes a command to it"""
+        if self.pc_connect:
+            port, prefix = resource, ""
+        else:
+            port, prefix = self.controller, "-"
+        if not port.is_open:
+            port.open()
+        return port, prefix
+
+    def _transact(self, command, resource=pumpserial, timeout=None):
+        """send command (without the address) to this pump and read its reply. Returns (the lines of the reply before
+        the prompt, the prompt character); raises PumpTimeout if the reply isn't complete within timeout seconds"""
+        return self._pipeline([command], resource, timeout)[0]
+
+    def _pipeline(self, commands, resource=pumpserial, timeout=None):
+        """send all of commands to this pump in one go, then read their replies in order (the pump handles one
+        command after the other, replying to each). Returns a list of (lines, prompt), one per command; raises
+        PumpTimeout if any reply isn't complete within timeout seconds of the one before"""
+        if not HPump.enabled:
+            self.logger.info(self.name+" not enabled")
+            raise ValueError
+        port, prefix = self._port(resource)
+        port.reset_input_buffer()  # anything left over from before isn't the reply to these
+        port.write("".join(prefix+self.address+command+"\n\r" for command in commands).encode())
+        reader = PumpReplyReader(port, self.address, log=None if self.pc_connect else self.controller.log_read)
+        timeout = HPump.REPLY_TIMEOUT if timeout is None else timeout
+        try:
+            return [reader.next(timeout) for _ in commands]
+        except PumpTimeout as e:
+            self.logger.debug("%s: %s" % (self.name, e))
+            self.invalidate_settings()  # who knows which of the commands it got
+            if not self.pc_connect:
+                self.controller.log_error("%s: %s" % (self.name, e))
+            raise
+
+    def _query(self, command, accept, resource=pumpserial, retry=True):
+        """ask the pump something, and return the first line of its reply for which accept(line) is true.
+        Tries once more if there's no such line"""
+        try:
+            lines, _ = self._transact(command, resource)
+            for line in lines:
+                if accept(line):
+                    return line
+        except PumpTimeout:
+            pass
+        if retry:
+            self.logger.debug("Error connecting: retrying")
+            return self._query(command, accept, resource, retry=False)
+        self.logger.info("Failure Connecting to Pump")
+        self.invalidate_settings()
+        raise RuntimeError
 
     def start_pump(self, resource=pumpserial):
         """Send a start command to the pump."""
         with self._lock:
-            responceflag = False
-            if not HPump.enabled:
-                self.logger.info(self.name+" not enabled")
-                raise ValueError
-            if self.pc_connect:
-                if not resource.is_open:
-                    resource.open()
-                while resource.in_waiting > 0:  # Clear Buffer
-                    resource.readline()
-                resource.write((self.address+"RUN\n\r").encode())
-                time.sleep(0.2)
-                if resource.in_waiting == 0:  # give extra time if it hasn't responded
-                    self.logger.debug("No responce: Waiting")
-
-                    time.sleep(0.4)
-                while resource.in_waiting > 0:
-                    pumpanswer = resource.readline()
-                    if (self.address+"<").encode() in pumpanswer:
-                        self.running = True
-                        self.logger.info("Refilling " + self.name)
-                        responceflag = True
-                    elif (self.address+">").encode() in pumpanswer:
-                        self.running = True
-                        self.logger.info("Infusing " + self.name)
-                        responceflag = True
+            self._forget_completion()
+            try:
+                _, prompt = self._transact("RUN", resource)
+            except PumpTimeout:
+                prompt = None
+            if prompt == "<":
+                self.running = True
+                self.logger.info("Refilling " + self.name)
+            elif prompt == ">":
+                self.running = True
+                self.logger.info("Infusing " + self.name)
             else:
-                if not self.controller.is_open:
-                    self.controller.open()
-                while self.controller.in_waiting > 0:  # Clear Buffer
-                    self.controller.readline_check()
-                self.controller.write(("-"+self.address+"RUN\n\r").encode())
-                time.sleep(0.2)
-                if self.controller.in_waiting == 0:  # give more time if it hasn't finished
-                    self.logger.debug("No responce: Waiting")
-                    time.sleep(0.2)
-                while self.controller.in_waiting > 0:
-                    pumpanswer = self.controller.readline_check()
-                    if (self.address+"<").encode() in pumpanswer:
-                        self.running = True
-                        self.logger.info("Refilling " + self.name)
-                        responceflag = True
-                    elif (self.address+">").encode() in pumpanswer:
-                        self.running = True
-                        self.logger.info("Infusing " + self.name)
-                        responceflag = True
-            if not responceflag:
                 self.logger.info("Error starting pump")
+                self.invalidate_settings()
                 raise RuntimeError
 
     def stop_pump(self, resource=pumpserial):
         with self._lock:
-            responceflag = False
-            if not HPump.enabled:
-                self.logger.info(self.name+" not enabled")
-                raise ValueError
-            if self.pc_connect:
-                if not resource.is_open:
-                    resource.open()
-                while resource.in_waiting > 0:  # Clear Buffer
-                    resource.readline()
-                resource.write((self.address+"STP\n\r").encode())
-                time.sleep(0.2)
-                if resource.in_waiting == 0:  # give extra time if it hasn't responded
-                    time.sleep(0.2)
-                while resource.in_waiting > 0:  # Clear Buffer
-                    pumpanswer = resource.readline()
-                    if (self.address+"*").encode() in pumpanswer:
-                        self.running = False
-                        self.logger.info("Paused " + self.name)
-                        responceflag = True
-                    elif (self.address+":").encode() in pumpanswer:
-                        self.running = False
-                        self.logger.info("Stopped " + self.name)
-                        responceflag = True
+            try:
+                _, prompt = self._transact("STP", resource)
+            except PumpTimeout:
+                prompt = None
+            if prompt == "*":
+                self.running = False
+                self.logger.info("Paused " + self.name)
+                self._forget_completion(stopped=True)
+            elif prompt == ":":
+                self.running = False
+                self.logger.info("Stopped " + self.name)
+                self._forget_completion(stopped=True)
             else:
-                if not self.controller.is_open:
-                    self.controller.open()
-                while self.controller.in_waiting > 0:  # Clear Buffer
-                    self.controller.readline_check()
-                self.controller.write(("-"+self.address+"STP\n\r").encode())
-                time.sleep(0.2)
-                if self.controller.in_waiting == 0:  # give more time if it hasn't finished
-                    self.logger.debug("No responce: Waiting")
-                    time.sleep(0.4)
-                while self.controller.in_waiting > 0:
-                    pumpanswer = self.controller.readline_check()
-                    if (self.address+":").encode() in pumpanswer:
-                        self.running = False
-                        self.logger.info("Paused " + self.name)
-                        responceflag = True
-                    elif (self.address+"*").encode() in pumpanswer:
-                        self.running = False
-                        self.logger.info("Stopped " + self.name)
-                        responceflag = True
-            if not responceflag:
                 self.logger.info("Error Stopping Pump")
+                self.invalidate_settings()
                 raise RuntimeError
 
     def set_infuse_rate(self, rate, units="UM", resource=pumpserial):
         # consider moving to after checking with pump
         with self._lock:
-            if not HPump.enabled:
-                self.logger.info(self.name+" not enabled")
-                raise ValueError
+            if self.settings.get('infuse rate') == (rate, units):
+                self.infuserate = rate
+                return
             ratestr = str(rate).zfill(5)
-            if self.pc_connect:
-                if not resource.is_open:
-                    resource.open()
-                resource.write((self.address+"RAT"+ratestr+units+"\n\r").encode())
-                # val = resource.read(4)
-                # TODO: add possibillity to change units
-
-            else:
-                if not self.controller.is_open:
-                    self.controller.open()
-                self.controller.write(("-"+self.address+"RAT"+ratestr+units+"\n\r").encode())
-            time.sleep(0.2)
+            # TODO: add possibillity to change units
+            self._transact("RAT"+ratestr+units, resource)
             if rate == self.check_infuse_rate():
                 self.logger.info(self.name+" infuse Rate set to "+str(rate))
                 self.infuserate = rate
+                self.settings['infuse rate'] = (rate, units)
+                if self.infusing:
+                    self._repredict(rate, units, resource)
             else:
                 self.logger.info("Error setting infuse rate for "+self.name)
+                self.invalidate_settings()
                 raise RuntimeError
 
     def set_refill_rate(self, rate, units="UM", resource=pumpserial):
         # consider moving to after checking with pump
         with self._lock:
-            if not HPump.enabled:
-                self.logger.info(self.name+" not enabled")
-                raise ValueError
-
+            if self.settings.get('refill rate') == (rate, units):
+                self.fillrate = rate
+                return
             ratestr = str(rate).zfill(5)
-            if self.pc_connect:
-                if not resource.is_open:
-                    resource.open()
-                resource.write((self.address+"RFR"+ratestr+units+"\n\r").encode())
-
-            else:
-                if not self.controller.is_open:
-                    self.controller.open()
-                self.controller.write(("-"+self.address+"RFR"+ratestr+units+"\n\r").encode())
-
             # TODO: add possibillity to change units
-            time.sleep(0.2)
+            self._transact("RFR"+ratestr+units, resource)
             if rate == self.check_refill_rate():
                 self.logger.info(self.name+" refill rate set to "+str(rate))
                 self.fillrate = rate
+                self.settings['refill rate'] = (rate, units)
+                if not self.infusing:
+                    self._repredict(rate, units, resource)
             else:
                 self.logger.info("Error setting refill rate for "+self.name)
+                self.invalidate_settings()
                 raise RuntimeError
 
     def set_flow_rate(self, rate, units="UM", resource=pumpserial):
@@ -329,195 +416,134 @@ class HPump:
 
     def infuse(self, resource=pumpserial):
         with self._lock:
-            if not HPump.enabled:
-                self.logger.info(self.name+" not enabled")
-                raise ValueError
             self.infusing = True
-            if self.pc_connect:
-                if not resource.is_open:
-                    resource.open()
-                resource.write((self.address+'DIRINF'+"\n\r").encode())
-
-            else:
-                if not self.controller.is_open:
-                    self.controller.open()
-                self.controller.write(("-"+self.address+"DIRINF"+"\n\r").encode())
-            time.sleep(0.2)
-            self.check_direction("INFUSE")
+            if self.settings.get('direction') == "INFUSE":
+                return
+            self._transact("DIRINF", resource)
+            self.check_direction("INFUSE", resource)
+            self.settings['direction'] = "INFUSE"
             self.logger.info(self.name+" set to infuse")
 
     def refill(self, resource=pumpserial):
         with self._lock:
-            if not HPump.enabled:
-                self.logger.info(self.name+" not enabled")
-                raise ValueError
             self.infusing = False
-            if self.pc_connect:
-                if not resource.is_open:
-                    resource.open()
-                resource.write((self.address+'DIRREF'+"\n\r").encode())
-
-            else:
-                if not self.controller.is_open:
-                    self.controller.open()
-                self.controller.write(("-"+self.address+"DIRREF"+"\n\r").encode())
-            time.sleep(0.2)
-            self.check_direction("REFILL")
+            if self.settings.get('direction') == "REFILL":
+                return
+            self._transact("DIRREF", resource)
+            self.check_direction("REFILL", resource)
+            self.settings['direction'] = "REFILL"
             self.logger.info(self.name+" set to refill")
 
     def reverse(self, resource=pumpserial):
         with self._lock:
-            if not HPump.enabled:
-                self.logger.info(self.name+" not enabled")
-                raise ValueError
+            self._transact("DIRREV", resource)
             self.infusing = not self.infusing
-            if self.pc_connect:
-                if not resource.is_open:
-                    resource.open()
-                resource.write((self.address+'DIRREV'+"\n\r").encode())
-
-            else:
-                if not self.controller.is_open:
-                    self.controller.open()
-                self.controller.write(("-"+self.address+"DIRREV"+"\n\r").encode())
+            self.settings.pop('direction', None)
 
     def set_mode_pump(self,  resource=pumpserial):
         with self._lock:
             if not HPump.enabled:
                 self.logger.info(self.name+" not enabled")
                 return
-            if self.pc_connect:
-                if not resource.is_open:
-                    resource.open()
-                resource.write((self.address+'MOD PMP'+"\n\r").encode())
-
-            else:
-                if not self.controller.is_open:
-                    self.controller.open()
-                self.controller.write(("-"+self.address+"MOD PMP"+"\n\r").encode())
-            time.sleep(0.2)
-            self.check_mode("PUMP")
+            if self.settings.get('mode') == "PUMP":
+                return
+            self._transact("MOD PMP", resource)
+            self.check_mode("PUMP", resource)
+            self.settings['mode'] = "PUMP"
             self.logger.info(self.name+" mode set to PUMP")
 
     def set_mode_vol(self,  resource=pumpserial):
         with self._lock:
-            if not HPump.enabled:
-                self.logger.info(self.name+" not enabled")
-                raise ValueError
-            if self.pc_connect:
-                if not resource.is_open:
-                    resource.open()
-                resource.write((self.address+'MOD VOL'+"\n\r").encode())
-
-            else:
-                if not self.controller.is_open:
-                    self.controller.open()
-                self.controller.write(("-"+self.address+"MOD VOL"+"\n\r").encode())
-            time.sleep(0.2)
-            self.check_mode("VOL")
+            if self.settings.get('mode') == "VOL":
+                return
+            self._transact("MOD VOL", resource)
+            self.check_mode("VOL", resource)
+            self.settings['mode'] = "VOL"
             self.logger.info(self.name+" mode set to VOL")
 
     def set_mode_progam(self,  resource=pumpserial):
         with self._lock:
-            if not HPump.enabled:
-                self.logger.info(self.name+" not enabled")
-                raise ValueError
-            if self.pc_connect:
-                if not resource.is_open:
-                    resource.open()
-                resource.write((self.address+'MOD PGM'+"\n\r").encode())
-
-            else:
-                if not self.controller.is_open:
-                    self.controller.open()
-                self.controller.write(("-"+self.address+"MOD PGM"+"\n\r").encode())
-            time.sleep(0.2)
-            self.check_mode("PROG")
+            if self.settings.get('mode') == "PROG":
+                return
+            self._transact("MOD PGM", resource)
+            self.check_mode("PROG", resource)
+            self.settings['mode'] = "PROG"
             self.logger.info(self.name+" Mode set to program")
 
     def set_target_vol(self, vol, resource=pumpserial):
         with self._lock:
-            if not HPump.enabled:
-                self.logger.info(self.name+" not enabled")
-                raise ValueError
+            if self._target_is(vol):
+                return
             volstr = str(vol).zfill(5)
-            if self.pc_connect:
-                if not resource.is_open:
-                    resource.open()
-                resource.write((self.address+'TGT'+volstr+"\n\r").encode())
-
-            else:
-                if not self.controller.is_open:
-                    self.controller.open()
-                self.controller.write(("-"+self.address+'TGT'+volstr+"\n\r").encode())
+            self._transact("TGT"+volstr, resource)
+            target = self.check_target_volume(resource)
+            self.logger.info(self.name+" Target Vol is "+str(target)+" ml")
+            if math.isclose(target, float(vol), rel_tol=1e-3):
+                self.settings['target volume'] = target
 
-            time.sleep(0.2)
-            self.logger.info(self.name+" Target Vol is "+str(self.check_target_volume())+" ml")
+    def _target_is(self, vol):
+        target = self.settings.get('target volume')
+        return target is not None and math.isclose(target, float(vol), rel_tol=1e-3)
 
     def is_running(self, resource=pumpserial):
         with self._lock:
-            running = False
-            success = False
-            if not HPump.enabled:
-                self.logger.info(self.name+" not enabled")
-                raise ValueError
-            if self.pc_connect:
-                if not resource.is_open:
-                    resource.open()
-                while resource.in_waiting > 0:  # Clear Buffer
-                    resource.readline().decode()
-                resource.write((self.address+"\n\r").encode())  # Query Pump
-                time.sleep(0.2)
-                while resource.in_waiting > 0:
-                    answer = resource.readline().decode()
-                    if self.address in answer:
-                        if "<" in answer:
-                            running = True
-                            success = True
-                        elif ">" in answer:
-                            running = True
-                            success = True
-                        elif ":" in answer:
-                            running = False
-                            success = True
-                        elif "*" in answer:
-                            running = False
-                            success = True
-                if success:
-                    return running
-                else:
-                    self.logger.debug("Failure Connecting to Pump")
-                    return True
+            try:
+                _, prompt = self._transact("", resource)  # Query Pump
+            except PumpTimeout:
+                self.logger.debug("Failure Connecting to Pump")
+                return True  # Not raising so that if one fails queue isnt dumped
+            return prompt in "<>"
+
+    def _track(self, duration):
+        """have the completion tracker watch this pump, which should stop in about duration seconds"""
+        if HPump.completion_tracker is None:
+            HPump.completion_tracker = PumpCompletionTracker(self.logger)
+        self.predicted_end = time.time() + duration
+        self.completion = HPump.completion_tracker.watch(self, duration)
+
+    def _repredict(self, rate, units, resource=pumpserial):
+        """the rate changed while the pump may be running for a volume: move the predicted end"""
+        target = self.settings.get('target volume')
+        if self.completion is None or self.completion.done() or target is None or rate <= 0 or units not in PUMP_RATE_ML_PER_S:
+            return
+        try:
+            remaining = max(target - self.get_delivered_volume(resource), 0)
+        except RuntimeError:
+            return  # keep the old prediction; the tracker copes with being wrong, it just asks more often
+        duration = remaining / (rate * PUMP_RATE_ML_PER_S[units])
+        self.predicted_end = time.time() + duration
+        HPump.completion_tracker.repredict(self, self.completion, duration)
+
+    def _forget_completion(self, stopped=False):
+        """the pump was started again or stopped, so whatever it was doing before is over"""
+        if self.completion is not None:
+            if stopped:
+                resolve(self.completion, time.time())
             else:
-                if not self.controller.is_open:
-                    self.controller.open()
-                while self.controller.in_waiting > 0:   # Clear Buffer
-                    self.controller.read_check()
-                self.controller.write(("-"+self.address+"\n\r").encode())
-                time.sleep(0.2)
-                while self.controller.in_waiting > 0:
-                    if self.controller.read_check() == self.address.encode():
-                        answer = self.controller.read_check()
-                        if b"<" == answer:
-                            running = True
-                            success = True
-                        elif b">" == answer:
-                            running = True
-                            success = True
-                        elif b":" == answer:
-                            running = False
-                            success = True
-                        elif b"*" == answer:
-                            running = False
-                            success = True
-                if success:
-                    return running
-                else:
-                    self.logger.debug("Failure Connecting to Pump")
-                    return True
-                    # raise RuntimeError Not raising so that if one fails queue isnt dumped
+                self.completion.cancel()
+            self.completion = None
+            self.predicted_end = None
+
+    def _wait_for_completion(self, completion, wait_time, command_while_waiting):
+        """wait up to wait_time seconds for completion, calling command_while_waiting every 0.1 s meanwhile.
+        Returns whether it completed"""
+        endtime = time.time() + wait_time
+        while not completion.done() and time.time() < endtime:
+            try:
+                completion.result(timeout=min(0.1, max(endtime - time.time(), 0)))
+            except CancelledError:
+                break  # the pump was started again
+            except FutureTimeout:
+                command_while_waiting()
+        if completion.done() and not completion.cancelled():
+            completion.result()  # raises whatever went wrong asking the pump
+        return completion.done()
 
     def wait_until_time(self, wait_time, command_while_waiting=lambda *_: None):
+        completion = self.completion
+        if completion is not None:
+            self._wait_for_completion(completion, wait_time, command_while_waiting)
+            return
         currenttime = time.time()
         endtime = currenttime + wait_time
         while self.is_running() and time.time() < endtime:
@@ -526,6 +552,13 @@ class HPump:
 
 
     def wait_until_stopped(self, timeout=60, command_while_waiting=lambda *_: None):
+        completion = self.completion
+        if completion is not None:
+            # the tracker asks the pump, only around when it should be done
+            if not self._wait_for_completion(completion, timeout, command_while_waiting):
+                self.logger.info("Pump wait timeout")
+                raise RuntimeError
+            return
         currenttime = 0
         while self.is_running() and currenttime < timeout:
             time.sleep(0.1)
@@ -535,277 +568,99 @@ class HPump:
             self.logger.info("Pump wait timeout")
             raise RuntimeError
 
+    def run_volume_program(self, volume, rate, infuse=True, units="UM", resource=pumpserial):
+        """set the pump up to pump volume (ml) at rate, in the given direction, and start it, as one transaction:
+        the settings that aren't in place already and the queries to check them go out together, and the replies
+        are checked together, before the pump is started. Returns the time it took, in seconds"""
+        started = time.perf_counter()
+        direction = "INFUSE" if infuse else "REFILL"
+        rate_command, rate_key = ("RAT", 'infuse rate') if infuse else ("RFR", 'refill rate')
+        with self._lock:
+            steps = []  # (setting, value, the command to set it, the query to read it back, test of a line of the reply)
+            if self.settings.get('direction') != direction:
+                steps.append(('direction', direction, "DIRINF" if infuse else "DIRREF", "DIR", lambda line: direction.encode() in line))
+            if self.settings.get('mode') != "VOL":
+                steps.append(('mode', "VOL", "MOD VOL", "MOD", lambda line: b"VOL" in line))
+            if not self._target_is(volume):
+                steps.append(('target volume', float(volume), "TGT"+str(volume).zfill(5), "TGT",
+                              lambda line: math.isclose(float(line), float(volume), rel_tol=1e-3)))
+            if self.settings.get(rate_key) != (rate, units):
+                steps.append((rate_key, (rate, units), rate_command+str(rate).zfill(5)+units, rate_command,
+                              lambda line: float(line.split()[0]) == rate))
+            if steps:
+                try:
+                    replies = self._pipeline([step[2] for step in steps] + [step[3] for step in steps], resource)
+                except PumpTimeout:
+                    replies = None
+                if replies is not None and self._program_took(steps, replies[len(steps):]):
+                    for step in steps:
+                        self.settings[step[0]] = step[1]
+                else:
+                    # e.g. the pump missed a character; fall back to one command at a time, which checks each step
+                    self.logger.info(self.name+" didn't take the volume program in one go; setting it up step by step")
+                    self.invalidate_settings()
+                    (self.infuse if infuse else self.refill)(resource)
+                    self.set_mode_vol(resource)
+                    self.set_target_vol(volume, resource)
+                    (self.set_infuse_rate if infuse else self.set_refill_rate)(rate, units, resource)
+            self.infusing = infuse
+            if infuse:
+                self.infuserate = rate
+            else:
+                self.fillrate = rate
+            self.start_pump(resource)
+            if rate > 0 and units in PUMP_RATE_ML_PER_S:
+                self._track(volume / (rate * PUMP_RATE_ML_PER_S[units]))
+        self.last_setup_time = time.perf_counter() - started
+        self.logger.info("%s set to %s %s ml at %s (set up in %.1f ms, %d of 4 settings sent)" % (
+            self.name, direction.lower(), volume, rate, self.last_setup_time * 1000, len(steps)))
+        return self.last_setup_time
+
+    @staticmethod
+    def _program_took(steps, replies):
+        """whether the replies to the queries of steps show the pump set up as intended"""
+        def accepts(accept, line):
+            try:
+                return accept(line)
+            except (ValueError, IndexError):
+                return False
+        return all(any(accepts(step[4], line) for line in lines) for (step, (lines, _)) in zip(steps, replies))
+
     def infuse_volume(self, volume, rate):
-        self.infuse()
-        time.sleep(0.1)
-        self.set_mode_vol()
-        time.sleep(0.1)
-        self.set_target_vol(volume)
-        time.sleep(0.1)
-        self.set_infuse_rate(rate)
-        time.sleep(0.1)
-        self.start_pump()
-        # self.wait_until_stopped(2*volume*1000/rate)  # wait for it to stop
+        return self.run_volume_program(volume, rate, infuse=True)
 
     def refill_volume(self, volume, rate):
-        self.refill()
-        time.sleep(0.1)
-        self.set_mode_vol()
-        time.sleep(0.1)
-        self.set_target_vol(volume)
-        time.sleep(0.1)
-        self.set_refill_rate(rate)
-        time.sleep(0.1)
-        self.start_pump()
-        # self.wait_until_stopped(2*volume*1000/rate)  # wait for it to stop
-
-    def check_direction(self, dirstr="k", resource=pumpserial, retry=True):
-        success = False
-        if not HPump.enabled:
-            self.logger.info(self.name+" not enabled")
-            raise ValueError
-        if self.pc_connect:
-            if not resource.is_open:
-                resource.open()
-            while resource.in_waiting > 0:  # Clear Buffer
-                resource.readline()
-            resource.write((self.address+"DIR"+"\n\r").encode())  # Query Pump
-            time.sleep(0.2)
-            while resource.in_waiting > 0:
-                if dirstr.encode() in resource.readline():
-                    success = True
-            if not success:
-                self.logger.info("Failure Connecting to Pump")
-                raise RuntimeError
-        else:
-            if not self.controller.is_open:
-                self.controller.open()
-            while self.controller.in_waiting > 0:   # Clear Buffer
-                self.controller.read_check()
-            self.controller.write(("-"+self.address+"DIR"+"\n\r").encode())
-            time.sleep(0.2)
-            if self.controller.in_waiting == 0:
-                self.logger.debug("No responce: waiting")
-                time.sleep(0.4)
-            while self.controller.in_waiting > 0:
-                if dirstr.encode() in self.controller.readline_check():
-                    success = True
-            if not success:
-                if retry:
-                    self.logger.debug("Error connecting: retrying")
-                    time.sleep(0.2)
-                    self.check_direction(dirstr, retry=False)
-                else:
-                    self.logger.info("Failure Connecting to Pump")
-                    raise RuntimeError
-
-    def check_mode(self, modestr="k", resource=pumpserial, retry=True):
-        success = False
-        if not HPump.enabled:
-            self.logger.info(self.name+" not enabled")
-            raise ValueError
-        if self.pc_connect:
-            if not resource.is_open:
-                resource.open()
-            while resource.in_waiting > 0:  # Clear Buffer
-                resource.readline()
-            resource.write((self.address+"MOD"+"\n\r").encode())  # Query Pump
-            time.sleep(0.2)
-            while resource.in_waiting > 0:
-                if modestr.encode() in resource.readline():
-                    success = True
-            if not success:
-                self.logger.info("Failure Connecting to Pump")
-                raise RuntimeError
-        else:
-            if not self.controller.is_open:
-                self.controller.open()
-            while self.controller.in_waiting > 0:   # Clear Buffer
-                self.controller.read_check()
-            self.controller.write(("-"+self.address+"MOD"+"\n\r").encode())
-            time.sleep(0.2)
-            if self.controller.in_waiting == 0:
-                self.logger.debug("No responce: waiting")
-                time.sleep(0.4)
-            while self.controller.in_waiting > 0:
-                if modestr.encode() in self.controller.readline_check():
-                    success = True
-            if not success:
-                if retry:
-                    self.logger.debug("Error connecting: retrying")
-                    time.sleep(0.2)
-                    self.check_mode(modestr, retry=False)
-                else:
-                    self.logger.info("Failure Connecting to Pump")
-                    raise RuntimeError
+        return self.run_volume_program(volume, rate, infuse=False)
 
-    def check_target_volume(self, resource=pumpserial, retry=True):
-        success = False
-        if not HPump.enabled:
-            self.logger.info(self.name+" not enabled")
-            raise ValueError
-        if self.pc_connect:
-            if not resource.is_open:
-                resource.open()
-            while resource.in_waiting > 0:  # Clear Buffer
-                resource.readline().decode()
-            resource.write((self.address+"TGT"+"\n\r").encode())  # Query Pump
-            time.sleep(0.2)
-            while resource.in_waiting > 0:
-                answer = (resource.readline())
-                if b"." in answer:
-                    value = float(answer)
-                    success = True
+    def check_direction(self, dirstr=None, resource=pumpserial, retry=True):
+        """the direction the pump is set to, INFUSE or REFILL; raises RuntimeError if it isn't dirstr (if given)"""
+        directions = ["INFUSE", "REFILL"] if dirstr is None else [dirstr]
+        line = self._query("DIR", lambda line: any(direction.encode() in line for direction in directions), resource, retry)
+        return next(direction for direction in directions if direction.encode() in line)
 
-        else:
-            if not self.controller.is_open:
-                self.controller.open()
-            while self.controller.in_waiting > 0:   # Clear Buffer
-                self.controller.read_check()
-            self.controller.write(("-"+self.address+"TGT"+"\n\r").encode())
-            time.sleep(0.2)
-            if self.controller.in_waiting == 0:
-                self.logger.debug("No responce: waiting")
-                time.sleep(0.4)
-            while self.controller.in_waiting > 0:
-                answer = (self.controller.readline_check())
-                if b"." in answer:
-                    value = float(answer)
-                    success = True
-        if not success:
-            if retry:
-                self.logger.debug("Error connecting: retrying")
-                time.sleep(0.2)
-                value = self.check_target_volume(retry=False)
-            else:
-                self.logger.info("Failure Connecting to Pump")
-                raise RuntimeError
+    def check_mode(self, modestr=None, resource=pumpserial, retry=True):
+        """the mode the pump is in, PUMP, VOL or PROG; raises RuntimeError if it isn't modestr (if given)"""
+        modes = ["PUMP", "VOL", "PROG"] if modestr is None else [modestr]
+        line = self._query("MOD", lambda line: any(mode.encode() in line for mode in modes), resource, retry)
+        return next(mode for mode in modes if mode.encode() in line)
 
-        return value
+    def check_target_volume(self, resource=pumpserial, retry=True):
+        return float(self._query("TGT", lambda line: b"." in line, resource, retry))
 
-    def check_infuse_rate(self, resource=pumpserial, retry=True):
-        success = False
-        if not HPump.enabled:
-            self.logger.info(self.name+" not enabled")
-            raise ValueError
-        if self.pc_connect:
-            if not resource.is_open:
-                resource.open()
-            while resource.in_waiting > 0:  # Clear Buffer
-                resource.readline()
-            resource.write((self.address+"RAT"+"\n\r").encode())  # Query Pump
-            time.sleep(0.2)
-            while resource.in_waiting > 0:
-                answer = (resource.readline())
-                if b"." in answer:
-                    value = float(answer[0:-7])
-                    success = True
+    def _check_rate(self, command, resource, retry, with_units):
+        # the rate comes with its units, e.g. b"10.000 ul/m"
+        line = self._query(command, lambda line: b"." in line, resource, retry).split()
+        rate = float(line[0])
+        return (rate, PUMP_RATE_UNITS.get(line[1] if len(line) > 1 else None)) if with_units else rate
 
-        else:
-            if not self.controller.is_open:
-                self.controller.open()
-            while self.controller.in_waiting > 0:   # Clear Buffer
-                self.controller.read_check()
-            self.controller.write(("-"+self.address+"RAT"+"\n\r").encode())
-            time.sleep(0.2)
-            if self.controller.in_waiting == 0:
-                self.logger.debug("No responce: waiting")
-                time.sleep(0.4)
-            while self.controller.in_waiting > 0:
-                answer = (self.controller.readline_check())
-                if b"." in answer:
-                    value = float(answer[0:-7])
-                    success = True
-        if not success:
-            if retry:
-                value = self.check_infuse_rate(retry= False)
-            else:
-                self.logger.info("Failure Connecting to Pump")
-                raise RuntimeError
-        return value
+    def check_infuse_rate(self, resource=pumpserial, retry=True, with_units=False):
+        return self._check_rate("RAT", resource, retry, with_units)
 
-    def check_refill_rate(self, resource=pumpserial, retry=True):
-        success = False
-        if not HPump.enabled:
-            self.logger.info(self.name+" not enabled")
-            raise ValueError
-        if self.pc_connect:
-            if not resource.is_open:
-                resource.open()
-            while resource.in_waiting > 0:  # Clear Buffer
-                resource.readline()
-            resource.write((self.address+"RFR"+"\n\r").encode())  # Query Pump
-            time.sleep(0.2)
-            while resource.in_waiting > 0:
-                answer = (resource.readline())
-                if b"." in answer:
-                    value = float(answer[0:-7])
-                    success = True
-        else:
-            if not self.controller.is_open:
-                self.controller.open()
-            while self.controller.in_waiting > 0:   # Clear Buffer
-                self.controller.read_check()
-            self.controller.write(("-"+self.address+"RFR"+"\n\r").encode())
-            time.sleep(0.2)
-            if self.controller.in_waiting == 0:
-                self.logger.debug("No responce: waiting")
-                time.sleep(0.4)
-            while self.controller.in_waiting > 0:
-                answer = (self.controller.readline_check())
-                if b"." in answer:
-                    value = float(answer[0:-7])
-                    success = True
-        if not success:
-            if retry:
-                self.logger.debug("Error connecting: retrying")
-                time.sleep(0.2)
-                value = self.check_refill_rate(retry=False)
-            else:
-                self.logger.info("Failure Connecting to Pump")
-                raise RuntimeError
-        return value
+    def check_refill_rate(self, resource=pumpserial, retry=True, with_units=False):
+        return self._check_rate("RFR", resource, retry, with_units)
 
     def get_delivered_volume(self, resource=pumpserial, retry=True):
-        success = False
-        if not HPump.enabled:
-            self.logger.info(self.name+" not enabled")
-            raise ValueError
-        if self.pc_connect:
-            if not resource.is_open:
-                resource.open()
-            while resource.in_waiting > 0:  # Clear Buffer
-                resource.readline().decode()
-            resource.write((self.address+"DEL"+"\n\r").encode())  # Query Pump
-            time.sleep(0.2)
-            while resource.in_waiting > 0:
-                answer = (resource.readline())
-                if b"." in answer:
-                    value = float(answer)
-                    success = True
-        else:
-            if not self.controller.is_open:
-                self.controller.open()
-            while self.controller.in_waiting > 0:   # Clear Buffer
-                self.controller.read_check()
-            self.controller.write(("-"+self.address+"DEL"+"\n\r").encode())
-            time.sleep(0.2)
-            if self.controller.in_waiting == 0:
-                self.logger.debug("No responce: waiting")
-                time.sleep(0.4)
-            while self.controller.in_waiting > 0:
-                answer = (self.controller.readline_check())
-                if b"." in answer:
-                    value = float(answer)
-                    success = True
-        if not success:
-            if retry:
-                self.logger.debug("Error connecting: retrying")
-                time.sleep(0.2)
-                value = self.get_delivered_volume(retry=False)
-            else:
-                self.logger.info("Failure Connecting to Pump")
-                raise RuntimeError
+        value = float(self._query("DEL", lambda line: b"." in line, resource, retry))
         self.logger.info("Delivered "+str(value))
         return value
 
@@ -814,6 +669,8 @@ class HPump:
             if not HPump.enabled:
                 self.logger.info(self.name+" not enabled")
                 return  # not raising error so that the remaining of the stop function isnt dumped
+            self.invalidate_settings()
+            self._forget_completion(stopped=True)
             if self.pc_connect:
                 if not resource.is_open:
                     resource.open()
@@ -0,0 +1,149 @@
+"""Timing and error counting of every call into the Elveflow SDK.
+
+How long OB1_Get_Press, OB1_Get_Sens_Data and OB1_Set_Press take over USB
+decides how fast the Elveflow can be polled, and a stalling USB connection
+shows up as the odd call taking hundreds of milliseconds. SDKInstrumentation
+wraps the SDK functions (see SDKReadContext) and keeps, per function and per
+channel:
+
+    a latency histogram (fixed, logarithmically spaced buckets, so recording a call is cheap and the
+    histograms can be compared between runs)
+    the count, total and maximum of the call durations
+    how many times each non-zero error code came back
+
+plus a log of the most recent slow calls. summary() is for showing in the GUI,
+dump() is JSON-serializable, for the log folder and for offline analysis.
+"""
+import bisect
+import json
+import threading
+import time
+from collections import deque, Counter
+
+# upper edges of the latency histogram buckets, in seconds: 10 µs to 10 s, 4 buckets per decade (and one more for anything slower)
+BUCKET_EDGES = [10 ** (exponent / 4) for exponent in range(-20, 5)]
+
+
+class CallStats:
+    """the statistics of one SDK function on one channel"""
+
+    def __init__(self):
+        self.n_calls = 0
+        self.total_time = 0.0
+        self.max_time = 0.0
+        self.histogram = [0] * (len(BUCKET_EDGES) + 1)
+        self.errors = Counter()  # error code -> how many times it came back
+
+    def add(self, duration, error):
+        self.n_calls += 1
+        self.total_time += duration
+        if duration > self.max_time:
+            self.max_time = duration
+        self.histogram[bisect.bisect_left(BUCKET_EDGES, duration)] += 1
+        if error:
+            self.errors[error] += 1
+
+    def percentile(self, fraction):
+        """the upper edge of the histogram bucket holding the given fraction of the calls (the slowest call for the last bucket)"""
+        if self.n_calls == 0:
+            return float('nan')
+        count = 0
+        for i, n in enumerate(self.histogram):
+            count += n
+            if count >= fraction * self.n_calls:
+                return BUCKET_EDGES[i] if i < len(BUCKET_EDGES) else self.max_time
+
+    def as_dict(self):
+        return {
+            'calls': self.n_calls,
+            'errors': sum(self.errors.values()),
+            'error codes': {str(code): n for (code, n) in sorted(self.errors.items())},
+            'mean time': self.total_time / self.n_calls if self.n_calls else float('nan'),
+            'max time': self.max_time,
+            'p50': self.percentile(0.5),
+            'p99': self.percentile(0.99),
+            'histogram': list(self.histogram),
+        }
+
+
+class SDKInstrumentation:
+    """collects CallStats for every (function name, channel) called through wrap().
+    Calls taking at least slow_threshold seconds go in the slow-call log (the last slow_log_size of them)"""
+    SLOW_THRESHOLD = 0.05  # seconds; half the default Elveflow sample period
+    SLOW_LOG_SIZE = 200
+
+    def __init__(self, slow_threshold=None, slow_log_size=None, timer=time.perf_counter, clock=time):
+        self.slow_threshold = SDKInstrumentation.SLOW_THRESHOLD if slow_threshold is None else slow_threshold
+        self.timer = timer
+        self.clock = clock
+        self._lock = threading.Lock()
+        self.calls = {}  # (function name, channel or None) -> CallStats
+        self.slow_calls = deque(maxlen=SDKInstrumentation.SLOW_LOG_SIZE if slow_log_size is None else slow_log_size)
+        self.started = clock.time()
+
+    def wrap(self, name, function, channel_argument=None):
+        """returns function, timed. channel_argument is the position of the channel number among its arguments
+        (an int or a ctypes c_int32), if it has one. The function must return an error code (0 for success)"""
+        timer = self.timer
+
+        def timed(*args, **kwargs):
+            start = timer()
+            error = function(*args, **kwargs)
+            duration = timer() - start
+            channel = None
+            if channel_argument is not None:
+                channel = getattr(args[channel_argument], 'value', args[channel_argument])
+            self.record(name, channel, duration, error)
+            return error
+        timed.__name__ = name
+        return timed
+
+    def record(self, name, channel, duration, error=0):
+        with self._lock:
+            key = (name, channel)
+            stats = self.calls.get(key)
+            if stats is None:
+                stats = self.calls[key] = CallStats()
+            stats.add(duration, error)
+            if duration >= self.slow_threshold:
+                self.slow_calls.append((self.clock.time(), name, channel, duration, error))
+
+    def reset(self):
+        with self._lock:
+            self.calls = {}
+            self.slow_calls.clear()
+            self.started = self.clock.time()
+
+    def summary(self):
+        """one line per function and channel, for people"""
+        with self._lock:
+            items = sorted(self.calls.items(), key=lambda item: (item[0][0], -1 if item[0][1] is None else item[0][1]))
+            lines = []
+            for ((name, channel), stats) in items:
+                stats = stats.as_dict()
+                line = "%s%s: %d calls, mean %.2f ms, p99 < %.2f ms, max %.2f ms, %d errors" % (
+                    name, '' if channel is None else ' channel %s' % channel, stats['calls'],
+                    stats['mean time'] * 1000, stats['p99'] * 1000, stats['max time'] * 1000, stats['errors'])
+                if stats['errors']:
+                    line += " (codes: %s)" % ', '.join('%s x%d' % item for item in stats['error codes'].items())
+                lines.append(line)
+            lines.append("%d slow calls (at least %.0f ms)" % (len(self.slow_calls), self.slow_threshold * 1000))
+        return lines
+
+    def dump(self):
+        """everything, as a JSON-serializable dict"""
+        with self._lock:
+            return {
+                'started': self.started,
+                'dumped': self.clock.time(),
+                'bucket edges': BUCKET_EDGES,
+                'slow threshold': self.slow_threshold,
+                'calls': [dict(function=name, channel=channel, **stats.as_dict())
+                          for ((name, channel), stats) in self.calls.items()],
+                'slow calls': [{'time': t, 'function': name, 'channel': channel, 'duration': duration, 'error': error}
+                               for (t, name, channel, duration, error) in self.slow_calls],
+            }
+
+    def write_dump(self, filename):
+        with open(filename, 'w', encoding='utf-8') as f:
+            json.dump(self.dump(), f, indent=1)
@@ -0,0 +1,77 @@
+"""Fixed-rate timing for acquisition and control loops.
+
+Sleeping a fixed amount between iterations makes the real period
+(sleep + however long the work took), which drifts with I/O latency.
+FixedRateScheduler instead aims every tick at an absolute deadline on a
+fixed grid (start + n * period) of the monotonic clock, and keeps statistics
+about how well it managed.
+"""
+import time
+import threading
+from collections import deque
+import numpy as np
+
+
+class FixedRateScheduler:
+    """ticks at a fixed period against absolute deadlines, and keeps jitter/overrun/period statistics
+
+    Call wait() once per loop iteration. If the work in an iteration takes longer than a period,
+    the missed deadlines are counted as overruns and skipped (we don't try to catch up with a burst)."""
+    STATS_WINDOW = 600  # how many recent ticks the live statistics cover
+
+    def __init__(self, period, clock=time.monotonic, sleep=time.sleep):
+        self.period = period
+        self.clock = clock
+        self.sleep = sleep
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        """forget all statistics and start a new grid of deadlines at the next wait()"""
+        with self._lock:
+            self.next_deadline = None
+            self.last_tick = None
+            self.n_ticks = 0
+            self.n_overruns = 0
+            self.jitters = deque(maxlen=FixedRateScheduler.STATS_WINDOW)  # how late each tick woke up, in seconds
+            self.periods = deque(maxlen=FixedRateScheduler.STATS_WINDOW)  # actual time between consecutive ticks
+
+    def wait(self):
+        """sleep until the next deadline and return the (monotonic) time actually woken up at"""
+        now = self.clock()
+        if self.next_deadline is None:
+            self.next_deadline = now
+        elif now > self.next_deadline + self.period:
+            # we missed at least one whole deadline: count them and rejoin the grid at the next one
+            missed = int((now - self.next_deadline) // self.period)
+            with self._lock:
+                self.n_overruns += missed
+            self.next_deadline += missed * self.period
+        if self.next_deadline > now:
+            self.sleep(self.next_deadline - now)
+        tick = self.clock()
+        with self._lock:
+            self.jitters.append(tick - self.next_deadline)
+            if self.last_tick is not None:
+                self.periods.append(tick - self.last_tick)
+            self.n_ticks += 1
+            self.last_tick = tick
+        self.next_deadline += self.period
+        return tick
+
+    def stats(self):
+        """returns a dict of live timing statistics over the last STATS_WINDOW ticks (times in seconds)"""
+        with self._lock:
+            jitters = np.array(self.jitters)
+            periods = np.array(self.periods)
+            n_ticks = self.n_ticks
+            n_overruns = self.n_overruns
+        return {
+            'target period': self.period,
+            'ticks': n_ticks,
+            'overruns': n_overruns,
+            'mean period': float(np.mean(periods)) if len(periods) else float('nan'),
+            'period std': float(np.std(periods)) if len(periods) else float('nan'),
+            'mean jitter': float(np.mean(jitters)) if len(jitters) else float('nan'),
+            'max jitter': float(np.max(jitters)) if len(jitters) else float('nan'),
+        }
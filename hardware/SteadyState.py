@@ -0,0 +1,121 @@
+"""Streaming steady-state detection for flow rates (or any other noisy signal).
+
+A reading is "steady" when, over a sliding window of recent samples, the mean
+is close enough to the target, the scatter is small and the least-squares
+slope shows no drift. Checking the statistics of the whole window instead of
+every single sample means one noisy reading doesn't reset everything, and a
+slow drift that stays inside the margin is still caught.
+"""
+import math
+from collections import deque
+import numpy as np
+
+
+class SteadyStateDetector:
+    """sliding-window mean, standard deviation and slope of a stream of (time, value) samples
+
+    update() is O(1): the window keeps running sums, relative to the first sample's time so they don't lose precision.
+    The signal counts as steady once the window spans at least `window` seconds and
+        |mean - target| < margin    (skipped if target is None)
+        std < max_std               (by default margin)
+        |slope| < max_slope         (by default margin / window: less than one margin of drift per window)"""
+
+    def __init__(self, window, target=None, margin=None, max_std=None, max_slope=None):
+        if margin is None and (max_std is None or max_slope is None):
+            raise ValueError("give either a margin or both max_std and max_slope")
+        self.window = window
+        self.target = target
+        self.margin = margin
+        self.max_std = margin if max_std is None else max_std
+        self.max_slope = margin / window if max_slope is None else max_slope
+        self.reset()
+
+    def reset(self):
+        """forget every sample, e.g. when the target changes"""
+        self.samples = deque()
+        self.t0 = None
+        self.start_time = None
+        self.steady_since = None
+        self.time_to_steady_state = None  # seconds from the first sample until it first became steady
+        self._n = 0
+        self._sum_t = self._sum_v = self._sum_tt = self._sum_tv = self._sum_vv = 0.0
+
+    def _add(self, t, v, sign):
+        self._n += sign
+        self._sum_t += sign * t
+        self._sum_v += sign * v
+        self._sum_tt += sign * t * t
+        self._sum_tv += sign * t * v
+        self._sum_vv += sign * v * v
+
+    def update(self, t, value):
+        """add a sample taken at time t (in seconds, any origin) and return whether the signal is now steady.
+        NaN values (failed reads) are skipped"""
+        if math.isnan(value):
+            return self.steady_since is not None
+        if self.t0 is None:
+            self.t0 = t
+            self.start_time = t
+        t = t - self.t0
+        self.samples.append((t, value))
+        self._add(t, value, 1)
+        # drop samples older than the window, but always keep enough to span it
+        while len(self.samples) > 2 and t - self.samples[1][0] >= self.window:
+            self._add(*self.samples.popleft(), -1)
+        return self._check(t)
+
+    def extend(self, times, values):
+        """add many samples at once; returns whether the signal is steady after the last one"""
+        steady = self.steady_since is not None
+        for t, value in zip(times, values):
+            steady = self.update(float(t), float(value))
+        return steady
+
+    def span(self):
+        """how many seconds the window currently covers"""
+        if len(self.samples) < 2:
+            return 0.0
+        return self.samples[-1][0] - self.samples[0][0]
+
+    def stats(self):
+        """returns (mean, standard deviation, slope per second) of the samples in the window (NaN if too few)"""
+        n = self._n
+        if n < 2:
+            return math.nan, math.nan, math.nan
+        mean = self._sum_v / n
+        variance = max(self._sum_vv / n - mean * mean, 0.0)
+        mean_t = self._sum_t / n
+        var_t = self._sum_tt / n - mean_t * mean_t
+        slope = (self._sum_tv / n - mean_t * mean) / var_t if var_t > 0 else math.nan
+        return mean, math.sqrt(variance), slope
+
+    def _check(self, t):
+        steady = False
+        if self.span() >= self.window:
+            mean, std, slope = self.stats()
+            steady = (std < self.max_std and abs(slope) < self.max_slope and
+                      (self.target is None or abs(mean - self.target) < self.margin))
+        if steady:
+            if self.steady_since is None:
+                self.steady_since = t + self.t0
+                if self.time_to_steady_state is None:
+                    self.time_to_steady_state = t
+        else:
+            self.steady_since = None
+        return steady
+
+    @property
+    def is_steady(self):
+        return self.steady_since is not None
+
+
+def is_steady(times, values, window, target=None, margin=None, max_std=None, max_slope=None):
+    """one-shot check of whether the last `window` seconds of a recorded signal are steady"""
+    times = np.asarray(times, dtype=float)
+    values = np.asarray(values, dtype=float)
+    if len(times) == 0:
+        return False
+    # start from the last sample at or before the beginning of the window, so a full window gets checked
+    first = max(int(np.searchsorted(times, times[-1] - window, side='right')) - 1, 0)
+    detector = SteadyStateDetector(window, target, margin, max_std, max_slope)
+    return detector.extend(times[first:], values[first:])
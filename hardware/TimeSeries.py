@@ -0,0 +1,197 @@
+"""A columnar, NumPy-backed time-series store for Elveflow samples.
+
+Samples are kept in one preallocated 2-D float64 array (one row per sample,
+one column per entry of the column map, e.g. FileIO.ELVEFLOW_DATA_COLUMNS)
+instead of a list of dicts. The array grows by doubling up to max_rows; after
+that, the oldest half is appended to a raw float64 spill file on disk and
+dropped from memory.
+"""
+import os.path
+import threading
+import numpy as np
+
+
+class TimeSeriesStore:
+    """a growable, bounded, columnar store of samples
+
+    Appending is amortized O(1). column() hands out zero-copy views of the rows
+    currently in memory. The visible rows are never modified in place: growing
+    or spilling copies into a fresh array, so views that a reader is still
+    holding stay valid (they just stop seeing newer samples)."""
+    INITIAL_CAPACITY = 4096
+    MAX_ROWS = 2**19  # about 14.5 hours at 10 Hz, or about 38 MB of 9 columns
+
+    def __init__(self, columns, initial_capacity=None, max_rows=None, spill_filename=None):
+        """columns maps column names to column indices.
+        If spill_filename is None, rows pushed out of memory are dropped instead of saved."""
+        self.max_rows = TimeSeriesStore.MAX_ROWS if max_rows is None else int(max_rows)
+        self.initial_capacity = min(TimeSeriesStore.INITIAL_CAPACITY if initial_capacity is None else int(initial_capacity), self.max_rows)
+        self.spill_filename = spill_filename
+        self._lock = threading.RLock()
+        self._spill_file = None
+        self.reset(columns)
+
+    def reset(self, columns=None):
+        """throw away all in-memory samples (and optionally change the column map).
+        Anything already spilled to disk stays there."""
+        with self._lock:
+            if columns is not None:
+                self.column_map = dict(columns)
+                self.width = max(self.column_map.values()) + 1 if self.column_map else 0
+            self._data = np.empty((self.initial_capacity, self.width))
+            self._length = 0
+            self._first_index = 0  # how many rows have ever been pushed out of memory (so the index of the first row in memory)
+
+    def __len__(self):
+        return self._length
+
+    @property
+    def first_index(self):
+        """the overall index of the oldest row still in memory. Rows are numbered from 0 in the order they were
+        added, and keep their number when older rows get pushed out"""
+        return self._first_index
+
+    @property
+    def total_rows(self):
+        """how many rows have been added since the last reset (the overall index of the next row)"""
+        with self._lock:
+            return self._first_index + self._length
+
+    @property
+    def n_spilled(self):
+        """how many rows have been written out to the spill file"""
+        if self.spill_filename is None or not os.path.exists(self.spill_filename):
+            return 0
+        return os.path.getsize(self.spill_filename) // (8 * self.width)
+
+    def _row_from_dict(self, row):
+        new_row = np.full(self.width, np.nan)
+        for key, value in row.items():
+            index = self.column_map.get(key)
+            if index is not None:
+                new_row[index] = value
+        return new_row
+
+    def _make_room(self, n_new):
+        """make sure there are at least n_new free rows at the end of the buffer.
+        Must be called with the lock held."""
+        needed = self._length + n_new
+        if needed <= len(self._data):
+            return
+        if needed <= self.max_rows:
+            new_capacity = len(self._data)
+            while new_capacity < needed:
+                new_capacity *= 2
+            new_capacity = min(new_capacity, self.max_rows)
+            new_data = np.empty((new_capacity, self.width))
+            new_data[:self._length] = self._data[:self._length]
+            self._data = new_data
+            return
+        # out of room: push the oldest rows out so that half of the window is free afterwards
+        n_keep = max(min(self._length, self.max_rows // 2, self.max_rows - n_new), 0)
+        n_drop = self._length - n_keep
+        self._spill(self._data[:n_drop])
+        new_data = np.empty((max(self.max_rows, n_new), self.width))
+        new_data[:n_keep] = self._data[n_drop:self._length]
+        self._data = new_data
+        self._length = n_keep
+        self._first_index += n_drop
+
+    def _spill(self, rows):
+        if self.spill_filename is None or len(rows) == 0:
+            return
+        if self._spill_file is None:
+            self._spill_file = open(self.spill_filename, 'ab')
+        np.ascontiguousarray(rows, dtype=np.float64).tofile(self._spill_file)
+        self._spill_file.flush()
+
+    def append(self, row):
+        """add one sample. row is either a dict (keyed like the column map; missing columns become NaN)
+        or a sequence of length self.width in column order"""
+        if isinstance(row, dict):
+            row = self._row_from_dict(row)
+        with self._lock:
+            self._make_room(1)
+            self._data[self._length] = row
+            self._length += 1
+
+    def extend(self, rows):
+        """add many samples: a list of dicts or a 2-D array with self.width columns"""
+        if isinstance(rows, np.ndarray):
+            rows = np.atleast_2d(rows)
+        else:
+            rows = [self._row_from_dict(row) if isinstance(row, dict) else row for row in rows]
+            if len(rows) == 0:
+                return
+            rows = np.array(rows, dtype=np.float64).reshape(len(rows), self.width)
+        if len(rows) == 0:
+            return
+        with self._lock:
+            self._make_room(len(rows))
+            self._data[self._length:self._length + len(rows)] = rows
+            self._length += len(rows)
+
+    def _index(self, key):
+        if isinstance(key, (int, np.integer)):
+            return int(key)
+        return self.column_map[key]  # raises KeyError for unknown columns, like the old list of dicts
+
+    def column(self, key):
+        """a zero-copy view of one column (given by name or index) of every in-memory sample.
+        Do NOT modify the result in place"""
+        index = self._index(key)
+        with self._lock:
+            return self._data[:self._length, index]
+
+    def columns(self, *keys):
+        """zero-copy views of several columns, all taken at the same instant (so they have the same length)"""
+        indices = [self._index(key) for key in keys]
+        with self._lock:
+            return [self._data[:self._length, index] for index in indices]
+
+    def tail(self, start, *keys):
+        """zero-copy views of several columns, of the in-memory rows with overall index start or more
+        (see first_index). Returns (the overall index of the first row returned, list of views)"""
+        indices = [self._index(key) for key in keys]
+        with self._lock:
+            first = min(max(start - self._first_index, 0), self._length)
+            return self._first_index + first, [self._data[first:self._length, index] for index in indices]
+
+    def window(self, start_time, end_time, *keys, time_key=0):
+        """zero-copy views of several columns, of the in-memory rows with start_time <= time <= end_time
+        (end_time None means up to the newest row). The rows are found by binary search on the time column
+        (time_key), which must be increasing. Returns (the overall index of the first row returned, list of views)"""
+        indices = [self._index(key) for key in keys]
+        time_index = self._index(time_key)
+        with self._lock:
+            times = self._data[:self._length, time_index]
+            first = int(np.searchsorted(times, start_time, side='left'))
+            last = self._length if end_time is None else int(np.searchsorted(times, end_time, side='right'))
+            last = max(first, last)
+            return self._first_index + first, [self._data[first:last, index] for index in indices]
+
+    def last_row(self):
+        """the most recent sample as a dict keyed like the column map. Raises IndexError if there is none"""
+        with self._lock:
+            if self._length == 0:
+                raise IndexError("no samples in the store")
+            row = self._data[self._length - 1].copy()
+        return {key: row[index] for (key, index) in self.column_map.items()}
+
+    def read_spilled(self):
+        """a read-only memory map of everything spilled to disk so far, as an (n, width) array"""
+        if self._spill_file is not None:
+            self._spill_file.flush()
+        n = self.n_spilled
+        if n == 0:
+            return np.empty((0, self.width))
+        return np.memmap(self.spill_filename, dtype=np.float64, mode='r', shape=(n, self.width))
+
+    def close(self, delete=False):
+        """close the spill file, if there is one, and if delete, delete it too"""
+        with self._lock:
+            if self._spill_file is not None:
+                self._spill_file.close()
+                self._spill_file = None
+            if delete and self.spill_filename is not None and os.path.exists(self.spill_filename):
+                os.remove(self.spill_filename)
@@ -94,6 +94,8 @@ class SpecCommThread(threading.Thread):
         self.exposure = False
         self.LEDOn = False
         self.connected = False
+        self.spec_filename = None  # the last file name sent to SPEC with newfile
+        self.exposure_listener = None  # told about the start and end of each rgseries (see ExposureLog)
 
     def run(self):
 
@@ -129,14 +131,20 @@ class SpecCommThread(threading.Thread):
                     try:
                         self.specCommand.ClearReply()
                         self.specCommand.executeCommand(eachCommand)
+                        if eachCommand.split()[0] == 'newfile':
+                            self.spec_filename = eachCommand.split()[1]
                         if eachCommand.split()[0] == 'rgseries':
                             controlQueue.put([('G', 'A STARTWATCH')])
                             self.exposure = True
+                            if self.exposure_listener is not None:
+                                self.exposure_listener.exposure_started(self.spec_filename)
                         if len(eachCommand.split())>1:
                             if eachCommand.split()[1] == 'mkdir':
                                 self.LEDOn = True
                         answer = self.waitForAnswerFromSpec()
                         print('Received Answer From SPEC :', str(answer))
+                        if eachCommand.split()[0] == 'rgseries' and self.exposure_listener is not None:
+                            self.exposure_listener.exposure_finished(self.spec_filename, aborted=(answer == 'Aborted'))
                     except (AttributeError, SpecClient.SpecClientError.SpecClientNotConnectedError):
                         controlQueue.put([('G', 'A LED_ERROR')])
                         controlQueue.put([('G', 'A CONNECT_ERROR')])
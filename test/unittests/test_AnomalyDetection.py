@@ -0,0 +1,100 @@
+import threading
+import unittest
+
+import numpy as np
+
+from hardware.AnomalyDetection import AnomalyDetector, ZScoreRule, DerivativeRule, ThresholdRule, elveflow_rules
+from hardware.FileIO import ELVEFLOW_DATA_COLUMNS
+
+
+def elveflow_rows(times, pressure=1500.0, flowrate=25.0):
+    rows = np.full((len(times), len(ELVEFLOW_DATA_COLUMNS)), np.nan)
+    rows[:, 0] = times
+    rows[:, 1] = pressure
+    rows[:, 5] = flowrate
+    return rows
+
+
+class TestRules(unittest.TestCase):
+
+    def test_zscore_across_batches(self):
+        rng = np.random.default_rng(0)
+        values = 25 + rng.normal(0, 0.2, 300)
+        values[200] = 15  # a bubble
+        times = np.arange(300) * 0.1
+        rule = ZScoreRule(window=50, threshold=6, direction=-1)
+        flagged = []
+        for start in range(0, 300, 7):  # batches that don't line up with anything
+            mask, _ = rule.check(times[start:start + 7], values[start:start + 7])
+            flagged.extend(start + np.flatnonzero(mask))
+        self.assertEqual(flagged, [200])
+
+    def test_derivative(self):
+        rule = DerivativeRule(max_rate=1000)
+        times = np.arange(10) * 0.1
+        pressures = np.full(10, 1500.0)
+        pressures[6:] = 1800  # 3000 mbar/s
+        mask, _ = rule.check(times[:5], pressures[:5])
+        self.assertFalse(mask.any())
+        mask, rates = rule.check(times[5:], pressures[5:])
+        np.testing.assert_array_equal(np.flatnonzero(mask), [1])
+        self.assertAlmostEqual(rates[1], 3000)
+
+    def test_threshold_duration_across_batches(self):
+        rule = ThresholdRule(low=10, duration=0.5)
+        times = np.arange(20) * 0.1
+        flowrates = np.full(20, 25.0)
+        flowrates[3:5] = 0  # too short to count
+        flowrates[10:] = 0
+        mask = np.concatenate([rule.check(times[i:i + 4], flowrates[i:i + 4])[0] for i in range(0, 20, 4)])
+        np.testing.assert_array_equal(np.flatnonzero(mask), np.arange(15, 20))
+
+
+class TestAnomalyDetector(unittest.TestCase):
+
+    def test_clog_fires_once_per_cooldown(self):
+        detector = AnomalyDetector(ELVEFLOW_DATA_COLUMNS, elveflow_rules(expected_flowrates={1: 25}, clog_duration=1), cooldown=5)
+        detector.set_armed('Volume flow rate 1 [µL/min]', True)
+        times = np.arange(100) * 0.1
+        rows = elveflow_rows(times)
+        rows[30:, 5] = 2
+        anomalies = detector.process(rows)
+        self.assertEqual([(anomaly.kind, anomaly.time) for anomaly in anomalies], [('clog', times[40]), ('clog', times[90])])
+
+    def test_no_clog_while_idle(self):
+        flowing = [False]
+        detector = AnomalyDetector(ELVEFLOW_DATA_COLUMNS, elveflow_rules(expected_flowrates={1: 25}, clog_duration=1), cooldown=5)
+        detector.set_armed('Volume flow rate 1 [µL/min]', lambda: flowing[0])
+        self.assertEqual(detector.process(elveflow_rows(np.arange(100) * 0.1, flowrate=0.0)), [])  # the pump is idle
+        flowing[0] = True
+        # only counts from when it's armed, not from when the flow stopped
+        self.assertEqual(detector.process(elveflow_rows(10 + np.arange(5) * 0.1, flowrate=0.0)), [])
+        anomalies = detector.process(elveflow_rows(10.5 + np.arange(10) * 0.1, flowrate=0.0))
+        self.assertEqual([(anomaly.kind, round(anomaly.time, 1)) for anomaly in anomalies], [('clog', 11.0)])
+
+    def test_feed_and_callbacks(self):
+        fired = threading.Event()
+        anomalies = []
+        detector = AnomalyDetector(ELVEFLOW_DATA_COLUMNS, elveflow_rules(pressure_channels=[1], max_pressure_rate=1000))
+        detector.add_callback(lambda anomaly: 1 / 0)  # a broken callback doesn't stop the others
+        detector.add_callback(lambda anomaly: (anomalies.append(anomaly), fired.set()))
+        detector.start()
+        try:
+            rows = elveflow_rows(np.arange(20) * 0.1)
+            rows[15, 1] = 2500
+            for row in rows:
+                detector.feed(row)
+                row[:] = np.nan  # feed copies the row, so it can be reused right away
+            self.assertTrue(fired.wait(5))
+        finally:
+            detector.stop()
+        self.assertEqual(anomalies[0].kind, 'pressure spike')
+        self.assertAlmostEqual(anomalies[0].time, 1.5)
+
+    def test_unknown_column(self):
+        with self.assertRaises(KeyError):
+            AnomalyDetector(ELVEFLOW_DATA_COLUMNS, [('Volume flow rate 9 [µL/min]', ThresholdRule(low=1))])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,53 @@
+import unittest
+
+import numpy as np
+
+from hardware.Decimation import MinMaxPyramid, DecimationCache, minmax_indices
+from hardware.TimeSeries import TimeSeriesStore
+
+
+class TestMinMaxPyramid(unittest.TestCase):
+
+    def setUp(self):
+        rng = np.random.default_rng(0)
+        self.values = rng.normal(0, 1, 100003)
+        self.values[12345] = 50  # a pressure spike
+        self.values[67891] = -50  # a bubble
+        self.values[500:600] = np.nan
+
+    def test_keeps_extremes(self):
+        pyramid = MinMaxPyramid()
+        # feed it in uneven pieces, like the acquisition thread would
+        for stop in range(0, len(self.values), 7777):
+            pyramid.extend(self.values[:stop])
+        pyramid.extend(self.values)
+        for start, stop in ((0, len(self.values)), (1000, 90000), (12000, 13000), (99000, len(self.values))):
+            indices = pyramid.indices(start, stop, 500)
+            self.assertLess(len(indices), 2 * 4 * 500 + 100)
+            self.assertTrue(np.all(np.diff(indices) > 0))
+            self.assertEqual(np.nanmax(self.values[indices]), np.nanmax(self.values[start:stop]))
+            self.assertEqual(np.nanmin(self.values[indices]), np.nanmin(self.values[start:stop]))
+            self.assertGreaterEqual(indices[0], start)
+            self.assertLess(indices[-1], stop)
+
+    def test_one_off(self):
+        indices = minmax_indices(self.values, 1000)
+        self.assertEqual(np.nanmax(self.values[indices]), 50)
+        self.assertEqual(np.nanmin(self.values[indices]), -50)
+        np.testing.assert_array_equal(minmax_indices(self.values[:10], 1000), np.arange(10))
+
+    def test_cache_follows_store(self):
+        store = TimeSeriesStore({'time [s]': 0, 'Pressure 1 [mbar]': 1}, max_rows=20000)
+        times = np.arange(len(self.values)) * 0.1
+        for i in range(0, len(self.values), 1000):
+            store.extend(np.column_stack((times[i:i+1000], self.values[i:i+1000])))
+        cache = DecimationCache(store)
+        x, y = cache.view('time [s]', 'Pressure 1 [mbar]', (times[-5000], times[-1]), n_buckets=200)
+        self.assertLessEqual(x[0], times[-5000])
+        self.assertEqual(x[-1], times[-1])
+        self.assertEqual(y.min(), self.values[-5000:].min())
+        self.assertEqual(y.max(), self.values[-5000:].max())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,79 @@
+import unittest
+from ctypes import c_double, c_int32, byref
+
+from hardware import FileIO
+from hardware.ElveflowSimulator import ChannelModel, OB1Simulator, VirtualClock, ERROR_INVALID_CHANNEL
+
+
+class TestOB1Simulator(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = VirtualClock()
+        models = [ChannelModel(resistance=100, pressure_lag=0.1, flow_lag=1, noise=0) for _ in range(4)]
+        self.simulator = OB1Simulator(models, clock=self.clock, seed=0)
+        self.simulator.OB1_Add_Sens(1, 1, SensorType=4, DigitalAnalog=0, FSens_Digit_Calib=0, FSens_Digit_Resolution=3)
+
+    def test_steady_state(self):
+        calib = (c_double*1000)()
+        self.simulator.OB1_Set_Press(1, c_int32(1), 1000, byref(calib), 1000)
+        self.clock.sleep(30)
+        pressure = c_double()
+        flowrate = c_double()
+        self.assertEqual(self.simulator.OB1_Get_Press(1, c_int32(1), 1, byref(calib), byref(pressure), 1000), 0)
+        self.assertEqual(self.simulator.OB1_Get_Sens_Data(1, c_int32(1), 1, byref(flowrate)), 0)
+        self.assertAlmostEqual(pressure.value, 1000)
+        self.assertAlmostEqual(flowrate.value, 10)
+
+    def test_lag(self):
+        calib = (c_double*1000)()
+        flowrate = c_double()
+        self.simulator.OB1_Set_Press(1, 1, 1000, byref(calib), 1000)
+        self.clock.sleep(1)
+        self.simulator.OB1_Get_Sens_Data(1, 1, 1, byref(flowrate))
+        self.assertGreater(flowrate.value, 0)
+        self.assertLess(flowrate.value, 10)
+
+    def test_invalid_channel(self):
+        flowrate = c_double()
+        self.assertEqual(self.simulator.OB1_Get_Sens_Data(1, 5, 1, byref(flowrate)), ERROR_INVALID_CHANNEL)
+
+
+class TestSimulatedHandler(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = VirtualClock()
+        self.simulator = OB1Simulator(clock=self.clock, seed=0)
+        self.handler = FileIO.ElveflowHandler_SDK(sourcename='simulator', sensortypes=[4, 0, 4, 4], sdk=self.simulator, clock=self.clock)
+        self.handler.start()
+
+    def tearDown(self):
+        self.handler.stop()
+        self.handler.reading_thread.join()
+
+    def test_pressure_ramp(self):
+        future = self.handler.set_pressure_loop(1, 500)
+        self.assertEqual(future.result(timeout=10), 500)
+        self.clock.sleep(1)
+        self.assertAlmostEqual(self.handler.getPressure(1), 500, delta=1)
+
+    def test_run_volume(self):
+        self.handler.run_volume(4, 25, margin=0.5, stable_time=2, timeout=120)
+        self.assertAlmostEqual(self.handler.getVolume(4), 25, delta=1)
+
+    def test_autotune(self):
+        result = self.handler.autotune_volume(4, 25, margin=0.5, stable_time=2)
+        self.assertIsNotNone(result)
+        self.assertTrue(all(k >= 0 for k in result['pid constants']))
+        self.assertGreater(result['pid constants'][0], 0)
+        self.assertIsNotNone(result['settle time'])
+        self.assertEqual(self.handler.pid_constants[4], result['pid constants'])
+
+    def test_shutdown_ramps_down(self):
+        self.handler.set_pressure_loop(3, 1000).result(timeout=10)
+        self.handler.stop()
+        self.handler.reading_thread.join()
+        self.assertEqual(self.simulator.channels[2].setpoint, 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
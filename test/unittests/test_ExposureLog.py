@@ -0,0 +1,45 @@
+import csv
+import os
+import tempfile
+import unittest
+
+import numpy as np
+
+from hardware.ElveflowSimulator import VirtualClock
+from hardware.ExposureLog import ExposureSummaryLog
+from hardware.TimeSeries import TimeSeriesStore
+
+COLUMNS = {'time [s]': 0, 'Pressure 1 [mbar]': 1, 'Volume flow rate 1 [µL/min]': 2}
+
+
+class TestExposureSummaryLog(unittest.TestCase):
+
+    def test_summary_row(self):
+        clock = VirtualClock(start_time=1000)
+        store = TimeSeriesStore(COLUMNS)
+        times = 1000 + np.arange(0, 30, 0.1)
+        flowrates = np.full(len(times), 25.0)
+        flowrates[(times > 1010) & (times < 1011)] = 5  # a bubble during the exposure
+        store.extend(np.column_stack((times, np.full(len(times), 1500.0), flowrates)))
+        with tempfile.TemporaryDirectory() as tmpdir:
+            log = ExposureSummaryLog(lambda: store, os.path.join(tmpdir, 'exposures.csv'), clock=clock)
+            log.plan('sample_12_sample', frames=10, exposure_time=1)
+            clock.sleep(5)
+            log.exposure_started('sample_12_sample')
+            clock.sleep(10)
+            row = log.summarize('sample_12_sample', log.started.pop('sample_12_sample'), clock.time())
+            self.assertEqual(row['frames'], 10)
+            self.assertAlmostEqual(row['duration [s]'], 10)
+            self.assertEqual(row['samples'], 101)
+            self.assertEqual(row['Pressure 1 [mbar] std'], 0)
+            self.assertEqual(row['Volume flow rate 1 [µL/min] min'], 5)
+            self.assertEqual(row['Volume flow rate 1 [µL/min] max'], 25)
+            with open(os.path.join(tmpdir, 'exposures.csv'), encoding='utf-8', newline='') as f:
+                rows = list(csv.DictReader(f))
+            self.assertEqual(len(rows), 1)
+            self.assertEqual(rows[0]['SPEC file'], 'sample_12_sample')
+            self.assertEqual(float(rows[0]['Volume flow rate 1 [µL/min] min']), 5)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,52 @@
+import os
+import tempfile
+import unittest
+
+import numpy as np
+
+from hardware.FileIO import ElveflowHandler_ESI, parse_esi_lines
+
+
+class TestParseESILines(unittest.TestCase):
+
+    def test_clean_lines(self):
+        lines = ['0.0\t1500.0\t\n', '0.1\t1501.5\t\n']
+        block = parse_esi_lines(lines, 3, numeric_columns=[0, 1])
+        np.testing.assert_array_equal(block, [[0.0, 1500.0, np.nan], [0.1, 1501.5, np.nan]])
+
+    def test_ragged_and_non_numeric(self):
+        # a short line (e.g. half-written) and a bad field push it onto the field by field path
+        lines = ['0.0\t1500.0\t7\n', '0.1\n', '0.2\tnope\t8\n']
+        block = parse_esi_lines(lines, 3, numeric_columns=[0, 1])
+        np.testing.assert_array_equal(block, [[0.0, 1500.0, np.nan], [0.1, np.nan, np.nan], [0.2, np.nan, np.nan]])
+
+    def test_empty(self):
+        self.assertEqual(parse_esi_lines([], 2).shape, (0, 2))
+
+
+class TestESIResume(unittest.TestCase):
+
+    def test_full_buffer_does_not_skip(self):
+        with tempfile.TemporaryDirectory() as directory:
+            filename = os.path.join(directory, 'log.txt')
+            lines = [b'time [s]\tPressure 1 [mbar]\n'] + [b'%d.0\t1500.0\n' % i for i in range(3)]
+            with open(filename, 'wb') as f:
+                f.writelines(lines)
+            handler = ElveflowHandler_ESI(filename)
+            handler.buffer_queue = handler.buffer_queue.__class__(maxsize=1)
+            read_size, index_period = ElveflowHandler_ESI.READ_SIZE, ElveflowHandler_ESI.INDEX_PERIOD
+            ElveflowHandler_ESI.READ_SIZE = len(lines[0]) + len(lines[1])  # the header and one line at a time
+            ElveflowHandler_ESI.INDEX_PERIOD = 0
+            try:
+                handler.start()
+                handler.reading_thread.join(5)
+            finally:
+                ElveflowHandler_ESI.READ_SIZE, ElveflowHandler_ESI.INDEX_PERIOD = read_size, index_period
+            # the second batch didn't fit, so the index says only the first one was read
+            index = handler._read_index()
+            self.assertEqual(index['offset'], len(lines[0]) + len(lines[1]))
+            self.assertEqual(index['last_time'], 0.0)
+
+
+if __name__ == '__main__':
+    unittest.main()
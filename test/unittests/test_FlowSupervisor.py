@@ -0,0 +1,54 @@
+import unittest
+
+import numpy as np
+
+from hardware.ElveflowSimulator import VirtualClock
+from hardware.FileIO import ELVEFLOW_DATA_COLUMNS
+from hardware.FlowSupervisor import SheathFlowSupervisor, NO_DATA, STEADY, UNSTEADY, OFF_TARGET
+from hardware.TimeSeries import TimeSeriesStore
+
+
+class TestSheathFlowSupervisor(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = VirtualClock(start_time=1000)
+        self.store = TimeSeriesStore(ELVEFLOW_DATA_COLUMNS)
+        self.supervisor = SheathFlowSupervisor(lambda: self.store, channel=2, target=25, tolerance=1, window=5, clock=self.clock)
+        self.changes = []
+        self.supervisor.add_listener(lambda supervisor, old, new: self.changes.append((old, new)))
+
+    def run_flow(self, duration, flowrate):
+        """add duration seconds of samples at 10 Hz, with flowrate a function of the time since the start"""
+        times = self.clock.time() + np.arange(0, duration, 0.1)
+        rows = np.full((len(times), len(ELVEFLOW_DATA_COLUMNS)), np.nan)
+        rows[:, 0] = times
+        rows[:, 6] = flowrate(times - times[0])
+        self.store.extend(rows)
+        self.clock.sleep(duration)
+
+    def test_statuses(self):
+        self.assertEqual(self.supervisor.check(), NO_DATA)
+        self.run_flow(10, lambda t: 25 + 0.05 * np.sin(t))
+        self.assertEqual(self.supervisor.check(), STEADY)
+        self.assertAlmostEqual(self.supervisor.flow_stats[0], 25, places=1)
+        self.run_flow(10, lambda t: 25 - 0.15 * t)  # drifting down, slowly at first
+        self.assertEqual(self.supervisor.check(), OFF_TARGET)
+        self.clock.sleep(10)  # the Elveflow stopped
+        self.assertEqual(self.supervisor.check(), NO_DATA)
+        self.assertEqual(self.changes, [(NO_DATA, STEADY), (STEADY, OFF_TARGET), (OFF_TARGET, NO_DATA)])
+
+    def test_settling_is_unsteady(self):
+        self.run_flow(5, lambda t: 24.5 + 0.2 * t)
+        self.assertEqual(self.supervisor.check(), UNSTEADY)
+
+    def test_correct_only_when_off_target(self):
+        calls = []
+        self.run_flow(10, lambda t: np.full(len(t), 25.2))
+        self.assertFalse(self.supervisor.correct(lambda channel, target: calls.append((channel, target))))
+        self.run_flow(10, lambda t: np.full(len(t), 22.0))
+        self.assertTrue(self.supervisor.correct(lambda channel, target: calls.append((channel, target))))
+        self.assertEqual(calls, [(2, 25)])
+
+
+if __name__ == '__main__':
+    unittest.main()
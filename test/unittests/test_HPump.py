@@ -0,0 +1,144 @@
+import logging
+import threading
+import time
+import unittest
+
+import serial
+
+from hardware.SAXSDrivers import read_pump_reply, PumpReplyReader, PumpTimeout, HPump
+
+
+class TestPumpReplies(unittest.TestCase):
+
+    def setUp(self):
+        # whatever is written to a loop:// port comes back when reading, so it plays the pump
+        self.port = serial.serial_for_url('loop://', timeout=0.1)
+
+    def tearDown(self):
+        self.port.close()
+
+    def test_reply_with_data(self):
+        self.port.write(b"\r\n10.000 ul/m\r\n1:")
+        start = time.monotonic()
+        lines, prompt = read_pump_reply(self.port, "1", timeout=1)
+        self.assertLess(time.monotonic() - start, 0.1)
+        self.assertEqual(lines, [b"10.000 ul/m"])
+        self.assertEqual(prompt, ":")
+
+    def test_address_zero(self):
+        for reply in (b"\r\n>", b"\r\n0>", b"\r\n00>"):
+            self.port.write(reply)
+            self.assertEqual(read_pump_reply(self.port, "0", timeout=1), ([], ">"))
+
+    def test_incomplete_reply(self):
+        logged = []
+        self.port.write(b"\r\n10.000 ul/m\r\n")
+        with self.assertRaises(PumpTimeout):
+            read_pump_reply(self.port, "1", timeout=0.05, log=logged.append)
+        self.assertEqual(logged, [b"\r\n10.000 ul/m\r\n"])
+
+    def test_other_pumps_prompt(self):
+        self.port.write(b"\r\n2<")
+        with self.assertRaises(PumpTimeout):
+            read_pump_reply(self.port, "1", timeout=0.05)
+
+    def test_pipelined_replies(self):
+        # the replies to several commands sent in one go, arriving in arbitrary chunks
+        replies = b"\r\n1:\r\nINFUSE\r\n1:\r\n0.025\r\n1:\r\n1>"
+        reader = PumpReplyReader(self.port, "1")
+        self.port.write(replies[:9])
+        self.assertEqual(reader.next(timeout=1), ([], ":"))
+        self.port.write(replies[9:])
+        self.assertEqual([reader.next(timeout=1) for _ in range(3)], [([b"INFUSE"], ":"), ([b"0.025"], ":"), ([], ">")])
+        with self.assertRaises(PumpTimeout):
+            reader.next(timeout=0.05)
+
+
+class FakePump:
+    """enough of a Harvard pump at address 1 on a serial port for HPump: replies to commands as soon as they're written"""
+    is_open = True
+
+    def __init__(self):
+        self.replies = b""
+        self.commands = []
+        self.settings = {"DIR": "INFUSE", "MOD": "PUMP", "TGT": "1.000", "RAT": "10.000 ul/m", "RFR": "10.000 ul/m"}
+        self.prompt = ":"
+
+    def open(self):
+        pass
+
+    def reset_input_buffer(self):
+        self.replies = b""
+
+    @property
+    def in_waiting(self):
+        return len(self.replies)
+
+    def read(self, size=1):
+        data, self.replies = self.replies[:size], self.replies[size:]
+        return data
+
+    def write(self, data):
+        for command in data.decode().split("\n\r")[:-1]:
+            command = command[1:]  # the address
+            self.commands.append(command)
+            reply = ""
+            if command == "RUN":
+                self.prompt = ">" if self.settings["DIR"] == "INFUSE" else "<"
+            elif command == "STP":
+                self.prompt = ":"
+            elif command in ("DIRINF", "DIRREF"):
+                self.settings["DIR"] = "INFUSE" if command == "DIRINF" else "REFILL"
+            elif command == "MOD VOL":
+                self.settings["MOD"] = "VOLUME"
+            elif command[:3] in ("TGT", "RAT", "RFR") and len(command) > 3:
+                value = float(command[3:8] if command[:3] != "TGT" else command[3:])
+                self.settings[command[:3]] = "%.3f" % value + (" ul/m" if command[:3] != "TGT" else "")
+            elif command in self.settings:
+                reply = self.settings[command] + "\r\n"
+            self.replies += ("\r\n" + reply + "1" + self.prompt).encode()
+
+
+class TestHPump(unittest.TestCase):
+
+    def setUp(self):
+        self.port = FakePump()
+        HPump.enabled = True
+        self.pump = HPump(address=1, logger=logging.getLogger("test"), lock=threading.RLock())
+
+    def tearDown(self):
+        HPump.enabled = False
+
+    def test_volume_program_skips_what_is_set(self):
+        self.pump.run_volume_program(0.025, 10, resource=self.port)
+        self.assertEqual(self.port.commands, ["DIRINF", "MOD VOL", "TGT0.025", "RAT00010UM", "DIR", "MOD", "TGT", "RAT", "RUN"])
+        self.assertTrue(self.pump.running)
+        self.port.commands.clear()
+        self.pump.run_volume_program(0.05, 10, resource=self.port)
+        self.assertEqual(self.port.commands, ["TGT00.05", "TGT", "RUN"])
+        self.pump.stop(resource=self.port)
+        self.port.commands.clear()
+        self.pump.run_volume_program(0.05, 10, resource=self.port)
+        self.assertEqual(len(self.port.commands), 9)
+
+    def test_completion(self):
+        self.pump.run_volume_program(0.025, 10, resource=self.port)
+        self.assertAlmostEqual(self.pump.predicted_end - time.time(), 150, delta=1)  # 25 µL at 10 µL/min
+        completion = self.pump.completion
+        self.assertFalse(completion.done())
+        self.pump.stop_pump(resource=self.port)
+        self.assertTrue(completion.done())
+        self.assertIsNone(self.pump.completion)
+
+    def test_resync(self):
+        settings = self.pump.resync(resource=self.port)
+        self.assertEqual(settings, {'direction': "INFUSE", 'mode': "PUMP", 'target volume': 1.0,
+                                    'infuse rate': (10.0, "UM"), 'refill rate': (10.0, "UM")})
+        self.port.commands.clear()
+        self.pump.infuse(resource=self.port)
+        self.pump.set_infuse_rate(10, resource=self.port)
+        self.assertEqual(self.port.commands, [])
+
+
+if __name__ == '__main__':
+    unittest.main()
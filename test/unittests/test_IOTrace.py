@@ -0,0 +1,45 @@
+import os
+import tempfile
+import unittest
+
+from hardware.IOTrace import IOTrace, read_trace, TX, RX
+
+
+class TestIOTrace(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.filename = os.path.join(self.directory.name, 'trace.jsonl')
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_records(self):
+        trace = IOTrace(self.filename, fsync_interval=60)
+        trace.record(TX, 'COM3', b"-1RUN\n\r")
+        trace.record(RX, 'COM3', b"\r\n1>")
+        trace.error('COM3', "no reply")
+        trace.close(timeout=5)
+        records = read_trace(self.filename)
+        self.assertEqual([(record['dir'], record.get('data')) for record in records],
+                         [('tx', b"-1RUN\n\r"), ('rx', b"\r\n1>"), ('error', None)])
+        self.assertEqual(records[2]['message'], "no reply")
+        self.assertGreaterEqual(trace.stats()['fsyncs'], 1)
+
+    def test_rotation(self):
+        trace = IOTrace(self.filename, max_bytes=1000, backup_count=2)
+        for i in range(200):
+            trace.record(RX, 'COM3', b"x" * 10)
+        trace.close(timeout=5)
+        self.assertGreater(trace.stats()['rotations'], 0)
+        self.assertTrue(os.path.exists(self.filename + '.1'))
+        self.assertFalse(os.path.exists(self.filename + '.3'))
+        self.assertEqual(trace.stats()['records written'], 200)
+
+    def test_unused_trace_leaves_no_file(self):
+        IOTrace(self.filename).close(timeout=5)
+        self.assertFalse(os.path.exists(self.filename))
+
+
+if __name__ == '__main__':
+    unittest.main()
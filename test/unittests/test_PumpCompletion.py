@@ -0,0 +1,59 @@
+import time
+import unittest
+
+from hardware.PumpCompletion import PumpCompletionTracker, next_poll_time
+
+
+class FakePump:
+    """a pump that runs for duration seconds"""
+
+    def __init__(self, duration):
+        self.end = time.monotonic() + duration
+        self.wall_end = time.time() + duration
+        self.n_polls = 0
+
+    def is_running(self):
+        self.n_polls += 1
+        return time.monotonic() < self.end
+
+
+class TestPumpCompletion(unittest.TestCase):
+
+    def test_poll_schedule(self):
+        schedule = dict(early=0.5, min_poll=0.05, max_poll=1, sanity_period=30)
+        self.assertEqual(next_poll_time(0, 180, **schedule), 30)  # far from the end: a sanity check
+        self.assertEqual(next_poll_time(170, 180, **schedule), 179.5)  # sleep until just before the end
+        self.assertAlmostEqual(next_poll_time(179.6, 180, **schedule), 179.8)  # closing in
+        self.assertAlmostEqual(next_poll_time(179.99, 180, **schedule), 180.04)
+        self.assertEqual(next_poll_time(190, 180, **schedule), 191)  # late: back off
+
+    def test_completion(self):
+        tracker = PumpCompletionTracker()
+        pumps = [FakePump(0.6), FakePump(0.3)]
+        completions = [tracker.watch(pump, pump.end - time.monotonic()) for pump in pumps]
+        for (pump, completion) in zip(pumps, completions):
+            stopped = completion.result(timeout=5)
+            self.assertLess(stopped - pump.wall_end, 0.1)  # noticed soon after it stopped
+            self.assertLessEqual(pump.n_polls, 6)
+        self.assertEqual(tracker.stats()['watching'], 0)
+
+    def test_late_pump_and_repredict(self):
+        tracker = PumpCompletionTracker()
+        pump = FakePump(0.5)
+        completion = tracker.watch(pump, 0.1)  # predicted too early
+        time.sleep(0.2)
+        tracker.repredict(pump, completion, pump.end - time.monotonic())
+        completion.result(timeout=5)
+        self.assertLess(time.monotonic() - pump.end, 0.1)
+
+    def test_cancelled(self):
+        tracker = PumpCompletionTracker()
+        pump = FakePump(60)
+        completion = tracker.watch(pump, 60)
+        completion.cancel()  # e.g. the pump was started again
+        time.sleep(0.1)
+        self.assertEqual(tracker.stats()['watching'], 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,115 @@
+import csv
+import os
+import tempfile
+import threading
+import time
+import unittest
+
+import numpy as np
+
+from hardware.Recording import RecordingWriter, CSVSegment, BinarySegment, BinaryRecording, FSYNC_ON_FLUSH, BINARY_INDEX_SUFFIX
+from hardware import Recording
+
+HEADER = ['time [s]', 'Pressure 1 [mbar]']
+
+
+class TestRecordingWriter(unittest.TestCase):
+
+    def test_segments(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            writer = RecordingWriter(fsync=FSYNC_ON_FLUSH, flush_interval=0.01)
+            first, second = os.path.join(tmpdir, 'first.csv'), os.path.join(tmpdir, 'second.csv')
+            writer.open_segment(first, HEADER)
+            writer.write(np.array([[0.0, 1.5], [0.1, np.nan]]))
+            writer.write([[0.2, 3.0]])
+            writer.open_segment(second, HEADER)  # rotates without losing anything
+            writer.write(np.array([[0.3, 4.0]]))
+            writer.close_segment()
+            writer.write(np.array([[0.4, 5.0]]))  # not saving: nowhere to go
+            writer.close()
+            with open(first, newline='') as f:
+                self.assertEqual(list(csv.reader(f)), [HEADER, ['0.0', '1.5'], ['0.1', 'nan'], ['0.2', '3.0']])
+            with open(second, newline='') as f:
+                self.assertEqual(list(csv.reader(f)), [HEADER, ['0.3', '4.0']])
+            stats = writer.stats()
+            self.assertEqual(stats['rows written'], 4)
+            self.assertEqual(stats['rows dropped'], 1)
+            self.assertEqual(stats['backlog rows'], 0)
+            self.assertEqual(stats['files'], [first, second])
+
+    def test_full_queue_drops(self):
+        unblock = threading.Event()
+
+        class SlowSegment(CSVSegment):
+            def write(self, rows):
+                unblock.wait()  # a disk that has stalled
+                super().write(rows)
+
+        with tempfile.TemporaryDirectory() as tmpdir:
+            writer = RecordingWriter(max_queue=5, segment_class=SlowSegment)
+            writer.open_segment(os.path.join(tmpdir, 'data.csv'), HEADER)
+            start = time.monotonic()
+            for i in range(100):
+                writer.write(np.array([[i, i]]))
+            self.assertLess(time.monotonic() - start, 1)  # never held up
+            unblock.set()
+            writer.close()
+            stats = writer.stats()
+            self.assertGreater(stats['rows dropped'], 0)
+            self.assertEqual(stats['rows written'] + stats['rows dropped'], 100)
+
+
+class TestBinaryRecording(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.filename = os.path.join(self.tmpdir.name, 'run.elvbin')
+        self.rows = np.column_stack((np.arange(10000) * 0.1, np.sin(np.arange(10000))))
+        self.rows[5, 1] = np.nan
+        segment = BinarySegment(self.filename, HEADER, index_stride=100)
+        for start in range(0, len(self.rows), 333):
+            segment.write(self.rows[start:start + 333])
+        segment.close()
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def test_window(self):
+        recording = BinaryRecording(self.filename)
+        self.assertEqual(recording.columns, HEADER)
+        np.testing.assert_array_equal(recording.data, self.rows)
+        for start_time, end_time in ((123.45, 234.5), (0, 0.25), (-1, None), (999.9, 2000)):
+            first, (times, values) = recording.window(start_time, end_time, 'time [s]', 1)
+            expected = (self.rows[:, 0] >= start_time) & (self.rows[:, 0] <= (np.inf if end_time is None else end_time))
+            self.assertEqual(first, np.argmax(expected))
+            np.testing.assert_array_equal(times, self.rows[expected, 0])
+
+    def test_crash_recovery(self):
+        # a partial last row and a lost index
+        with open(self.filename, 'ab') as f:
+            f.write(b'1234')
+        os.remove(self.filename + BINARY_INDEX_SUFFIX)
+        recording = BinaryRecording(self.filename)
+        self.assertEqual(len(recording), len(self.rows))
+        first, (times,) = recording.window(500, 500.05, 0)
+        np.testing.assert_array_equal(times, [500])
+        recording.close()
+        # and carrying on writing after it
+        segment = BinarySegment(self.filename, HEADER)
+        segment.write([[1000.0, 1.0]])
+        segment.close()
+        self.assertEqual(len(BinaryRecording(self.filename)), len(self.rows) + 1)
+
+    def test_converters(self):
+        csv_filename = os.path.join(self.tmpdir.name, 'run.csv')
+        esi_filename = os.path.join(self.tmpdir.name, 'run.txt')
+        Recording.binary_to_csv(self.filename, csv_filename)
+        Recording.csv_to_binary(csv_filename, os.path.join(self.tmpdir.name, 'from_csv.elvbin'))
+        np.testing.assert_array_equal(BinaryRecording(os.path.join(self.tmpdir.name, 'from_csv.elvbin')).data, self.rows)
+        Recording.binary_to_esi(self.filename, esi_filename)
+        Recording.esi_to_binary(esi_filename, os.path.join(self.tmpdir.name, 'from_esi.elvbin'))
+        np.testing.assert_array_equal(BinaryRecording(os.path.join(self.tmpdir.name, 'from_esi.elvbin')).data, self.rows)
+
+
+if __name__ == '__main__':
+    unittest.main()
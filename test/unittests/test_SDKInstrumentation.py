@@ -0,0 +1,52 @@
+import json
+import os
+import tempfile
+import unittest
+from ctypes import c_int32
+
+from hardware.SDKInstrumentation import SDKInstrumentation, BUCKET_EDGES
+
+
+class FakeTimer:
+    """returns the times it's given, one per call"""
+
+    def __init__(self, times):
+        self.times = iter(times)
+
+    def __call__(self):
+        return next(self.times)
+
+
+class TestSDKInstrumentation(unittest.TestCase):
+
+    def test_histograms_errors_and_slow_calls(self):
+        # three calls taking 1 ms, 2 ms and 200 ms
+        instrumentation = SDKInstrumentation(slow_threshold=0.1, timer=FakeTimer([0, 0.001, 1, 1.002, 2, 2.2]))
+        errors = iter([0, -8000, 0])
+        get_press = instrumentation.wrap('OB1_Get_Press', lambda instr_ID, channel: next(errors), 1)
+        self.assertEqual(get_press(0, c_int32(2)), 0)
+        self.assertEqual(get_press(0, c_int32(2)), -8000)
+        get_press(0, 3)
+        stats = {(call['function'], call['channel']): call for call in instrumentation.dump()['calls']}
+        self.assertEqual(stats['OB1_Get_Press', 2]['calls'], 2)
+        self.assertEqual(stats['OB1_Get_Press', 2]['error codes'], {'-8000': 1})
+        self.assertAlmostEqual(stats['OB1_Get_Press', 2]['max time'], 0.002)
+        self.assertEqual(sum(stats['OB1_Get_Press', 2]['histogram']), 2)
+        self.assertLessEqual(stats['OB1_Get_Press', 2]['p99'], BUCKET_EDGES[13])
+        self.assertEqual([call['channel'] for call in instrumentation.dump()['slow calls']], [3])
+        self.assertIn('(codes: -8000 x1)', instrumentation.summary()[0])
+
+    def test_dump_is_json(self):
+        instrumentation = SDKInstrumentation()
+        instrumentation.wrap('OB1_Initialization', lambda *args: 0)('ASRL8::INSTR', 3, 3, 3, 3)
+        with tempfile.TemporaryDirectory() as tmpdir:
+            filename = os.path.join(tmpdir, 'sdk_stats.json')
+            instrumentation.write_dump(filename)
+            with open(filename, encoding='utf-8') as f:
+                dump = json.load(f)
+        self.assertEqual(dump['calls'][0]['function'], 'OB1_Initialization')
+        self.assertIsNone(dump['calls'][0]['channel'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,48 @@
+import unittest
+
+from hardware.Scheduling import FixedRateScheduler
+
+
+class FakeClock:
+    """a monotonic clock that only moves when something sleeps or works"""
+
+    def __init__(self):
+        self.now = 100.0
+
+    def __call__(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.now += seconds
+
+
+class TestFixedRateScheduler(unittest.TestCase):
+
+    def test_no_drift(self):
+        clock = FakeClock()
+        scheduler = FixedRateScheduler(0.1, clock=clock, sleep=clock.sleep)
+        ticks = []
+        for _ in range(50):
+            ticks.append(scheduler.wait())
+            clock.now += 0.03  # the work in each iteration
+        self.assertAlmostEqual(ticks[-1] - ticks[0], 49 * 0.1)
+        stats = scheduler.stats()
+        self.assertEqual(stats['ticks'], 50)
+        self.assertEqual(stats['overruns'], 0)
+        self.assertAlmostEqual(stats['mean period'], 0.1)
+
+    def test_overrun(self):
+        clock = FakeClock()
+        scheduler = FixedRateScheduler(0.1, clock=clock, sleep=clock.sleep)
+        first = scheduler.wait()
+        clock.now += 0.35  # a slow iteration misses two whole deadlines
+        second = scheduler.wait()
+        self.assertEqual(scheduler.stats()['overruns'], 2)
+        third = scheduler.wait()
+        # we rejoin the original grid rather than starting a new one
+        self.assertAlmostEqual((third - first) / 0.1, round((third - first) / 0.1))
+        self.assertGreater(third, second)
+
+
+if __name__ == '__main__':
+    unittest.main()
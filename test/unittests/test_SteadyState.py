@@ -0,0 +1,43 @@
+import unittest
+
+import numpy as np
+
+from hardware.SteadyState import SteadyStateDetector, is_steady
+
+
+class TestSteadyStateDetector(unittest.TestCase):
+
+    def test_noisy_but_steady(self):
+        rng = np.random.default_rng(0)
+        times = np.arange(0, 10, 0.1)
+        values = 25 + rng.normal(0, 0.2, len(times))
+        detector = SteadyStateDetector(2, target=25, margin=0.5)
+        self.assertTrue(detector.extend(times, values))
+        # it should notice as soon as the first full window is in
+        self.assertLess(detector.time_to_steady_state, 2.5)
+
+    def test_drift_is_not_steady(self):
+        times = np.arange(0, 10, 0.1)
+        values = 25 + 0.4 * times / 10  # never leaves the margin, but keeps going
+        detector = SteadyStateDetector(2, target=25, margin=0.5, max_slope=0.01)
+        self.assertFalse(detector.extend(times, values))
+
+    def test_stats_match_numpy(self):
+        times = np.arange(0, 5, 0.1)
+        values = 3 * times + 1 + np.sin(times)
+        detector = SteadyStateDetector(1, margin=1)
+        detector.extend(times, values)
+        window = times >= times[-1] - 1 - 1e-9
+        mean, std, slope = detector.stats()
+        self.assertAlmostEqual(mean, np.mean(values[window]))
+        self.assertAlmostEqual(std, np.std(values[window]))
+        self.assertAlmostEqual(slope, np.polyfit(times[window], values[window], 1)[0])
+
+    def test_off_target(self):
+        times = np.arange(0, 10, 0.1)
+        self.assertFalse(is_steady(times, np.full(len(times), 20.0), 2, target=25, margin=0.5))
+        self.assertTrue(is_steady(times, np.full(len(times), 25.0), 2, target=25, margin=0.5))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,88 @@
+import os
+import tempfile
+import unittest
+
+import numpy as np
+
+from hardware.TimeSeries import TimeSeriesStore
+
+COLUMNS = {'time [s]': 0, 'Pressure 1 [mbar]': 1, 'Volume flow rate 1 [µL/min]': 2}
+
+
+class TestTimeSeriesStore(unittest.TestCase):
+
+    def test_append_and_columns(self):
+        store = TimeSeriesStore(COLUMNS, initial_capacity=2)
+        store.append({'time [s]': 0.0, 'Pressure 1 [mbar]': 10.0, 'Volume flow rate 1 [µL/min]': 1.0})
+        store.append([1.0, 20.0, 2.0])
+        store.extend([{'time [s]': 2.0, 'Pressure 1 [mbar]': 30.0}])
+        store.extend(np.array([[3.0, 40.0, 4.0], [4.0, 50.0, 5.0]]))
+        self.assertEqual(len(store), 5)
+        np.testing.assert_array_equal(store.column('time [s]'), [0, 1, 2, 3, 4])
+        np.testing.assert_array_equal(store.column(1), [10, 20, 30, 40, 50])
+        self.assertTrue(np.isnan(store.column('Volume flow rate 1 [µL/min]')[2]))
+        self.assertEqual(store.last_row()['Pressure 1 [mbar]'], 50.0)
+        with self.assertRaises(KeyError):
+            store.column('Pressure 2 [mbar]')
+
+    def test_views_survive_growth(self):
+        store = TimeSeriesStore(COLUMNS, initial_capacity=2)
+        store.extend(np.zeros((2, 3)))
+        view = store.column(0)
+        store.extend(np.ones((10, 3)))
+        np.testing.assert_array_equal(view, [0, 0])
+        self.assertEqual(len(store.column(0)), 12)
+
+    def test_last_row_empty(self):
+        store = TimeSeriesStore(COLUMNS)
+        with self.assertRaises(IndexError):
+            store.last_row()
+
+    def test_spill(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            spill_filename = os.path.join(tmpdir, 'spill.bin')
+            store = TimeSeriesStore(COLUMNS, initial_capacity=4, max_rows=8, spill_filename=spill_filename)
+            for i in range(20):
+                store.append([i, 2 * i, 3 * i])
+            self.assertLessEqual(len(store), 8)
+            spilled = store.read_spilled()
+            self.assertEqual(len(spilled) + len(store), 20)
+            np.testing.assert_array_equal(np.concatenate([spilled[:, 0], store.column(0)]), np.arange(20))
+            del spilled
+            store.close(delete=True)
+            self.assertFalse(os.path.exists(spill_filename))
+
+    def test_tail_across_spill(self):
+        store = TimeSeriesStore(COLUMNS, initial_capacity=4, max_rows=8)
+        for i in range(5):
+            store.append([i, 0, 0])
+        first, (times,) = store.tail(3, 'time [s]')
+        self.assertEqual(first, 3)
+        np.testing.assert_array_equal(times, [3, 4])
+        for i in range(5, 20):
+            store.append([i, 0, 0])
+        self.assertEqual(store.total_rows, 20)
+        self.assertEqual(store.first_index + len(store), 20)
+        # rows that were pushed out aren't returned, but the overall numbering still holds
+        first, (times,) = store.tail(0, 'time [s]')
+        self.assertEqual(first, store.first_index)
+        np.testing.assert_array_equal(times, np.arange(first, 20))
+
+
+    def test_window(self):
+        store = TimeSeriesStore(COLUMNS, initial_capacity=4, max_rows=8)
+        for i in range(20):
+            store.append([0.5 * i, i, 0])
+        first, (times, pressures) = store.window(7.0, 8.0, 'time [s]', 'Pressure 1 [mbar]')
+        self.assertEqual(first, 14)
+        np.testing.assert_array_equal(times, [7.0, 7.5, 8.0])
+        np.testing.assert_array_equal(pressures, [14, 15, 16])
+        # a start before the oldest in-memory row just gives everything from there on
+        first, (times,) = store.window(0, None, 'time [s]')
+        self.assertEqual(first, store.first_index)
+        self.assertEqual(times[-1], 9.5)
+        first, (times,) = store.window(100, None, 'time [s]')
+        self.assertEqual(len(times), 0)
+
+if __name__ == '__main__':
+    unittest.main()
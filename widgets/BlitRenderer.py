@@ -0,0 +1,105 @@
+"""Blitted rendering of live matplotlib plots, on the Tk main loop.
+
+Redrawing a whole figure (three twin axes with their ticks and labels) every
+time new data comes in is slow, and tkinter isn't thread safe, so drawing from
+worker threads is asking for trouble. Instead, BlitRenderer keeps a copy of the
+figure without its moving parts (the "animated" artists: data lines, markers)
+and on each refresh only restores that background and draws the animated
+artists on top of it (blitting). Everything happens on the Tk main loop through
+after(): other threads only call request(), and any number of requests between
+two refreshes turn into one redraw. The whole figure is only redrawn when
+something in the background changes, like the axis limits or labels, or the
+window gets resized.
+"""
+import threading
+import time
+
+
+class BlitRenderer:
+    """refreshes a FigureCanvasTkAgg from the Tk main loop, blitting only its animated artists
+
+    prepare is called on the main loop before each refresh, to bring the artists up to date. It returns True if it
+    changed anything in the background (axis limits, labels...), so that the whole figure needs redrawing."""
+    DEFAULT_PERIOD = 50  # ms between checks for redraw requests, so at most 20 refreshes per second
+
+    def __init__(self, widget, canvas, prepare=None, period=None):
+        self.widget = widget  # any Tk widget, for after()
+        self.canvas = canvas
+        self.prepare = prepare
+        self.period = BlitRenderer.DEFAULT_PERIOD if period is None else period
+        self.artists = []
+        self.background = None
+        self._lock = threading.Lock()
+        self._requested = False
+        self._full_requested = False
+        self._after_id = None
+        self.n_full_draws = 0
+        self.n_blits = 0
+        self.last_render_time = float('nan')  # seconds
+        # every full draw (ours, or from resizing, the toolbar...) saves the new background
+        canvas.mpl_connect('draw_event', self._on_draw)
+
+    def add_artist(self, artist):
+        """blit artist (a line, a vline...) on each refresh instead of drawing it into the background"""
+        artist.set_animated(True)
+        self.artists.append(artist)
+
+    def clear_artists(self):
+        """stop blitting every artist. They become part of the background again (unless removed from their axes)"""
+        for artist in self.artists:
+            artist.set_animated(False)
+        self.artists = []
+
+    def request(self, full=False):
+        """ask for a refresh at the next tick of the main loop. Safe to call from any thread"""
+        with self._lock:
+            self._requested = True
+            self._full_requested = self._full_requested or full
+
+    def start(self):
+        """start checking for requests on the Tk main loop"""
+        if self._after_id is None:
+            self._after_id = self.widget.after(self.period, self._tick)
+
+    def stop(self):
+        if self._after_id is not None:
+            self.widget.after_cancel(self._after_id)
+            self._after_id = None
+
+    def _tick(self):
+        # reschedule first, so one bad refresh doesn't stop all the following ones
+        self._after_id = self.widget.after(self.period, self._tick)
+        with self._lock:
+            if not self._requested:
+                return
+            full = self._full_requested
+            self._requested = self._full_requested = False
+        self.render(full)
+
+    def render(self, full=False):
+        """refresh right now. Only call this from the main loop"""
+        start = time.perf_counter()
+        if self.prepare is not None:
+            full = self.prepare() or full
+        if full or self.background is None:
+            self.canvas.draw()  # _on_draw saves the background and draws the artists
+            self.n_full_draws += 1
+        else:
+            self.canvas.restore_region(self.background)
+            self._draw_artists()
+            self.canvas.blit(self.canvas.figure.bbox)
+            self.n_blits += 1
+        self.last_render_time = time.perf_counter() - start
+
+    def _on_draw(self, event):
+        self.background = self.canvas.copy_from_bbox(self.canvas.figure.bbox)
+        self._draw_artists()
+
+    def _draw_artists(self):
+        figure = self.canvas.figure
+        for artist in self.artists:
+            if artist.figure is figure:  # skip artists that have been removed from their axes
+                figure.draw_artist(artist)
+
+    def stats(self):
+        return {'full draws': self.n_full_draws, 'blits': self.n_blits, 'last render time': self.last_render_time}
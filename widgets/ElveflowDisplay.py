@@ -1,14 +1,18 @@
 import tkinter as tk
 import tkinter.font
 import logging
-import csv
 import numpy as np
 from hardware import FileIO
+from hardware.TimeSeries import TimeSeriesStore
+from hardware.Decimation import DecimationCache
+from hardware.Recording import RecordingWriter, CSVSegment, BinarySegment, FSYNC_ON_FLUSH, FSYNC_POLICIES, BINARY_SUFFIX
+from widgets.BlitRenderer import BlitRenderer
 import threading
 import time
 import os.path
 import warnings
 import matplotlib
+import matplotlib.transforms
 matplotlib.use('TkAgg')
 from matplotlib import pyplot as plt
 
@@ -30,6 +34,7 @@ class ElveflowDisplay(tk.Canvas):
     DEFAULT_Y1_LABEL = 'Pressure 1 [mbar]'
     DEFAULT_Y2_LABEL = 'Volume flow rate 1 [µL/min]'
     DEFAULT_Y3_LABEL = 'Volume flow rate 4 [µL/min]'
+    PID_CONFIG_KEY = 'channel%i_pid_%s'  # autotuned constants in the [Elveflow] config, per channel and sensor type
 
     def __init__(self, window, height, width, elveflow_config, errorlogger, maingui, **kwargs):
         """Start the FluidLevel object with default paramaters."""
@@ -54,13 +59,23 @@ class ElveflowDisplay(tk.Canvas):
         (self.kp_var, self.ki_var, self.kd_var) = (tk.StringVar(), tk.StringVar(), tk.StringVar())
         self.kp_var.set(50)
         self.ki_var.set(50)
+        self.useAutotuned_var = tk.BooleanVar(value=False)  # use each channel's autotuned constants (if any) instead of the P, I, D boxes
 
         # internal variables
         self.dataTitle = "Elveflow data"
         self.errorlogger = errorlogger
         self.elveflow_config = elveflow_config
-        self.saveFile = None
-        self.saveFileWriter = None
+        # writes the saved rows from its own thread, so a slow disk doesn't hold up polling.
+        # Recordings are CSV unless the config asks for the (much smaller and faster to load) binary format
+        if elveflow_config.get("recording_format", "csv") == "binary":
+            segment_class, self.recording_suffix = BinarySegment, BINARY_SUFFIX
+        else:
+            segment_class, self.recording_suffix = CSVSegment, ".csv"
+        fsync = elveflow_config.get("recording_fsync", FSYNC_ON_FLUSH)
+        if fsync not in FSYNC_POLICIES:
+            errorlogger.warning("Unknown recording_fsync %r in the config (should be one of %s); using %r" % (fsync, ', '.join(FSYNC_POLICIES), FSYNC_ON_FLUSH))
+            fsync = FSYNC_ON_FLUSH
+        self.recorder = RecordingWriter(errorlogger, fsync=fsync, segment_class=segment_class)
         self.started_shutting_down = False
         self.done_shutting_down = False
 
@@ -70,7 +85,7 @@ class ElveflowDisplay(tk.Canvas):
         self.exit_lock = threading.Lock() # to make shutdown not hang.
         self.run_flag = threading.Event()
         self.save_flag = threading.Event()
-        self.saveFileNameSuffix_var.set("_%d.csv" % time.time())
+        self.saveFileNameSuffix_var.set("_%d%s" % (time.time(), self.recording_suffix))
 
         # tkinter elements
         # https://stackoverflow.com/questions/31440167/placing-plot-on-tkinter-main-window-in-python
@@ -142,6 +157,7 @@ class ElveflowDisplay(tk.Canvas):
             self.pressureValue_entry = [None, None, None, None]
             self.isPressure_toggle = [None, None, None, None]
             self.pressureSettingActive_toggle = [None, None, None, None]
+            self.autotune_button = [None, None, None, None]
 
             for i in range(4):
                 self.isPressure_toggle[i] = PressureVolumeToggle(self.setElveflow_frame, variable=self.isPressure_var[i])
@@ -154,6 +170,8 @@ class ElveflowDisplay(tk.Canvas):
                 self.pressureSettingActive_toggle[i] = Toggle(self.setElveflow_frame, defaultValue=False, text='Set', variable=self.pressureSettingActive_var[i], compound=tk.CENTER,
                                                               onToggleOn=lambda i=i: self.start_pressure(channel=i+1, isPressure=self.isPressure_var[i].get()), onToggleOff=lambda i=i: self.stop_pressure(channel=i+1))
                 self.pressureSettingActive_toggle[i].grid(row=2, column=i, padx=ElveflowDisplay.PADDING, pady=ElveflowDisplay.PADDING)
+                self.autotune_button[i] = tk.Button(self.setElveflow_frame, text='Autotune', command=lambda i=i: self.autotune(channel=i+1))
+                self.autotune_button[i].grid(row=4, column=i, padx=ElveflowDisplay.PADDING, pady=ElveflowDisplay.PADDING)
 
             tk.Label(self.setElveflow_frame, text="P, I, D constants:").grid(row=3, column=0, padx=ElveflowDisplay.PADDING, pady=ElveflowDisplay.PADDING)
             self.kp_entry = tk.Entry(self.setElveflow_frame, textvariable=self.kp_var)
@@ -165,6 +183,10 @@ class ElveflowDisplay(tk.Canvas):
             self.kd_entry = tk.Entry(self.setElveflow_frame, textvariable=self.kd_var)
             self.kd_entry.grid(row=3, column=3, padx=ElveflowDisplay.PADDING, pady=ElveflowDisplay.PADDING)
             self.kd_entry.config(width=int(remaining_width_per_column / fontsize))  # width is in units of font size
+            self.useAutotuned_checkbutton = tk.Checkbutton(self.setElveflow_frame, text='Use autotuned P, I, D', variable=self.useAutotuned_var, bg="#aaddff")
+            self.useAutotuned_checkbutton.grid(row=5, column=0, columnspan=2, padx=ElveflowDisplay.PADDING, pady=ElveflowDisplay.PADDING)
+            self.sdkStats_button = tk.Button(self.setElveflow_frame, text='SDK call statistics', command=self.dump_sdk_stats)
+            self.sdkStats_button.grid(row=5, column=2, columnspan=2, padx=ElveflowDisplay.PADDING, pady=ElveflowDisplay.PADDING)
             rowcounter += 1
 
         tkinter.ttk.Separator(self, orient=tk.HORIZONTAL).grid(row=rowcounter, column=1, columnspan=3, sticky='ew', padx=ElveflowDisplay.PADDING, pady=ElveflowDisplay.PADDING)
@@ -189,6 +211,13 @@ class ElveflowDisplay(tk.Canvas):
         self.canvas = matplotlib.backends.backend_tkagg.FigureCanvasTkAgg(self.the_fig, self)
         self.canvas.draw()
         self.canvas.get_tk_widget().grid(row=0, column=0, rowspan=rowcounter, padx=ElveflowDisplay.PADDING, pady=ElveflowDisplay.PADDING)
+        # the polling thread only asks for redraws; the renderer does them on the main loop
+        self.renderer = BlitRenderer(self, self.canvas, self.update_plot)
+        self.renderer.start()
+        # if set (to a hardware.AnomalyDetection.AnomalyDetector), it gets fed every sample straight from the Elveflow
+        self.anomaly_detector = None
+        # channel -> the flow rate run_volume left it running at, until the channel's pressure is changed or stopped
+        self.flow_set = {}
 
         self._initialize_variables()
         self.run_flag.set()
@@ -196,12 +225,22 @@ class ElveflowDisplay(tk.Canvas):
     def _initialize_variables(self):
         """create or reset all the internal variables"""
         self.elveflow_handler = None
-        self.data = []
+        try:
+            self.data.close(delete=True)  # the spill file only backs the plot; the recording is what's kept
+        except AttributeError:
+            pass  # the first time around, there's no store yet
+        self.data = TimeSeriesStore(FileIO.ELVEFLOW_DATA_COLUMNS,
+                                    spill_filename=os.path.join(ElveflowDisplay.OUTPUT_FOLDER, "spill_%d.bin" % time.time()))
+        self.decimation = DecimationCache(self.data)
         self.run_flag.clear()
         self.save_flag.clear()
         self.the_line1 = self.ax1.plot([], [], color=ElveflowDisplay.COLOR_Y1)[0]
         self.the_line2 = self.ax2.plot([], [], color=ElveflowDisplay.COLOR_Y2)[0]
         self.the_line3 = self.ax3.plot([], [], color=ElveflowDisplay.COLOR_Y3)[0]
+        self.renderer.clear_artists()
+        for line in (self.the_line1, self.the_line2, self.the_line3):
+            self.renderer.add_artist(line)
+        self._reset_plot_state()
         self.data_x_label_optionmenu.config(state=tk.DISABLED)
         self.data_y1_label_optionmenu.config(state=tk.DISABLED)
         self.data_y2_label_optionmenu.config(state=tk.DISABLED)
@@ -215,12 +254,10 @@ class ElveflowDisplay(tk.Canvas):
             self.startSaving_button.config(state=tk.DISABLED)
             self.stopSaving_button.config(state=tk.DISABLED)
             self.saveFileName_entry.config(state=tk.DISABLED)
-            for item in self.pressureSettingActive_toggle:
+            for item in self.pressureSettingActive_toggle + self.autotune_button + [self.sdkStats_button]:
                 item.config(state=tk.DISABLED)
             for item in self.pressureValue_entry:
                 item.config(state=tk.DISABLED)
-            self.saveFile = None
-            self.saveFileWriter = None
 
     def populate_dropdowns(self):
         self.data_x_label_optionmenu['menu'].delete(0, 'end')
@@ -233,6 +270,14 @@ class ElveflowDisplay(tk.Canvas):
             self.data_y2_label_optionmenu['menu'].add_command(label=item, command=lambda item=item: self.data_y2_label_var.set(item))
             self.data_y3_label_optionmenu['menu'].add_command(label=item, command=lambda item=item: self.data_y3_label_var.set(item))
 
+    def _simulator(self):
+        """a simulated OB1 if the config asks for one (elveflow_simulator = yes), else None for the real Elveflow64.dll"""
+        if not self.elveflow_config.getboolean('elveflow_simulator', False):
+            return None
+        from hardware.ElveflowSimulator import OB1Simulator
+        self.errorlogger.warning("Using a SIMULATED Elveflow (elveflow_simulator is set in the config)")
+        return OB1Simulator()
+
     def start(self):
         if self.elveflow_handler is not None:
             raise RuntimeError("the elveflow_handler is already running!")
@@ -243,7 +288,7 @@ class ElveflowDisplay(tk.Canvas):
 
         if FileIO.USE_SDK:
             # self.sourcename_entry.config(state=tk.DISABLED)
-            for item in self.pressureSettingActive_toggle:
+            for item in self.pressureSettingActive_toggle + self.autotune_button + [self.sdkStats_button]:
                 item.config(state=tk.NORMAL)
             for item in self.pressureValue_entry:
                 item.config(state=tk.NORMAL)
@@ -255,7 +300,10 @@ class ElveflowDisplay(tk.Canvas):
                                                            errorlogger=self.errorlogger,
                                                            sensortypes=list(map(lambda x: FileIO.SDK_SENSOR_TYPES[x],
                                                                                 [self.elveflow_config['sensor1_type'], self.elveflow_config['sensor2_type'], self.elveflow_config['sensor3_type'], self.elveflow_config['sensor4_type']])),  # TODO: make this not ugly
+                                                           sdk=self._simulator(),
                                                            )
+            if self.anomaly_detector is not None:
+                self.elveflow_handler.add_row_listener(self.anomaly_detector.feed)
             # self.sourcename_var.set(str(self.elveflow_handler.sourcename, encoding='ascii'))
         else:
             self.elveflow_handler = FileIO.ElveflowHandler()
@@ -286,12 +334,14 @@ class ElveflowDisplay(tk.Canvas):
                             # simulate `while run_flag.is_set()` but protected by a lock
                             # really only useful during closedown
                             break
-                        new_data = self.elveflow_handler.fetchAll()
+                        new_data = self.elveflow_handler.fetchBatch()
+                        if not FileIO.USE_SDK and len(self.data) == 0 and self.elveflow_handler.getHeader() is not None:
+                            # log files have their own columns, which we only know once the header has been read
+                            self.data.reset(columns={name: i for (i, name) in enumerate(self.elveflow_handler.getHeader())})
                         self.data.extend(new_data)
-                        self.update_plot()
+                        self.renderer.request()
                     if save_flag.is_set():
-                        for dict_ in new_data:
-                            self.saveFileWriter.writerow([str(dict_[key]) for key in self.elveflow_handler.header])
+                        self.recorder.write(new_data)
                     time.sleep(ElveflowDisplay.POLLING_PERIOD)
             finally:
                 if self.started_shutting_down:
@@ -307,7 +357,7 @@ class ElveflowDisplay(tk.Canvas):
         if FileIO.USE_SDK:
             self.startSaving_button.config(state=tk.NORMAL)
             self.saveFileName_entry.config(state=tk.NORMAL)
-            self.saveFileNameSuffix_var.set("_%d.csv" % time.time())
+            self.saveFileNameSuffix_var.set("_%d%s" % (time.time(), self.recording_suffix))
 
     def stop(self, shutdown=False):
         import traceback
@@ -318,7 +368,7 @@ class ElveflowDisplay(tk.Canvas):
         if FileIO.USE_SDK:
             for item in self.pressureSettingActive_var:
                 item.set(False)
-            for item in self.pressureSettingActive_toggle:
+            for item in self.pressureSettingActive_toggle + self.autotune_button + [self.sdkStats_button]:
                 item.config(state=tk.DISABLED)
             for item in self.pressureValue_entry:
                 item.config(state=tk.DISABLED)
@@ -330,6 +380,7 @@ class ElveflowDisplay(tk.Canvas):
         self.stop_saving(shutdown=shutdown)
         if shutdown:
             self.started_shutting_down = True
+            self.renderer.stop()
 
             if not self.run_flag.is_set():
                 # wait, there's no elveflow polling thread to set the done_shutting_down flag
@@ -338,107 +389,123 @@ class ElveflowDisplay(tk.Canvas):
 
             # only clear the run flag after setting the started_shutting_down flag
             self.run_flag.clear()
+            self.data.close(delete=True)
         else:
             self.run_flag.clear()
             self._initialize_variables()
 
     def start_saving(self):
         if self.elveflow_handler.header is not None:
-            self.save_flag.set()
             self.stopSaving_button.config(state=tk.NORMAL)
             self.startSaving_button.config(state=tk.DISABLED)
             self.saveFileName_entry.config(state=tk.DISABLED)
-            self.saveFile = open(os.path.join(ElveflowDisplay.OUTPUT_FOLDER, self.saveFileName_var.get() + self.saveFileNameSuffix_var.get()), 'a', encoding="utf-8", newline='')
-            self.saveFileWriter = csv.writer(self.saveFile)
-            self.saveFileWriter.writerow(self.elveflow_handler.header)
-            self.errorlogger.debug('started saving to %s' % self.saveFile.name)
+            filename = os.path.join(ElveflowDisplay.OUTPUT_FOLDER, self.saveFileName_var.get() + self.saveFileNameSuffix_var.get())
+            # each start/stop of saving is its own file
+            self.recorder.open_segment(filename, self.elveflow_handler.header)
+            self.save_flag.set()
+            self.errorlogger.debug('started saving to %s' % filename)
         else:
             self.errorlogger.error('cannot start saving (header is unknown). Try again in a moment')
 
     def stop_saving(self, shutdown=False):
         if self.save_flag.is_set():
-            self.errorlogger.debug('stopped saving')
-        self.save_flag.clear()
+            self.save_flag.clear()
+            self.recorder.close_segment()
+            self.errorlogger.debug('stopped saving (%s)' % self.recorder.stats())
         if FileIO.USE_SDK and not shutdown:
             self.stopSaving_button.config(state=tk.DISABLED)
             self.startSaving_button.config(state=tk.NORMAL)
             self.saveFileName_entry.config(state=tk.NORMAL)
 
-        self.saveFileNameSuffix_var.set("_%d.csv" % time.time())
-
-        if self.saveFile is not None:
-            self.saveFile.close()
-
-    def update_plot(self):
-        data_x_label_var = self.data_x_label_var.get()
-        data_y1_label_var = self.data_y1_label_var.get()
-        data_y2_label_var = self.data_y2_label_var.get()
-        data_y3_label_var = self.data_y3_label_var.get()
+        self.saveFileNameSuffix_var.set("_%d%s" % (time.time(), self.recording_suffix))
+        if shutdown:
+            self.recorder.close()
+
+    def _reset_plot_state(self, selection=None):
+        """forget everything update_plot has worked out incrementally, so that the next update starts over"""
+        self.plot_selection = selection
+        self.plot_first_index = None  # the store's first_index when we started over
+        self.plot_next_index = 0  # overall index of the first row not looked at yet
+        self.plot_extremes = np.array([np.inf, -np.inf] * 4)  # running x min, x max, y1 min, y1 max, ... of the raw values
+        self.plot_offsets = np.zeros(8)
+        self.plot_x_sorted = False  # whether the x axis is the time, so only the visible part needs drawing
+        self.applied_limits = None
+
+    def _start_plot_over(self, selection):
+        self._reset_plot_state(selection)
+        self.plot_first_index = self.data.first_index
+        self.decimation.clear()
+        data_x_label_var, data_y1_label_var, data_y2_label_var, data_y3_label_var = selection
         self.ax1.set_xlabel(data_x_label_var, fontsize=14)
         self.ax1.set_ylabel(data_y1_label_var, fontsize=14, color=ElveflowDisplay.COLOR_Y1)
         self.ax2.set_ylabel(data_y2_label_var, fontsize=14, color=ElveflowDisplay.COLOR_Y2)
         self.ax3.set_ylabel(data_y3_label_var, fontsize=14, color=ElveflowDisplay.COLOR_Y3)
+        # time is shown relative to starttime. Shifting the lines with a transform instead of subtracting
+        # from the data means nothing has to be copied or recomputed when new data comes in
+        time_label = self.elveflow_handler.header[0] if self.elveflow_handler is not None else None
+        self.plot_x_sorted = (selection[0] == time_label)
+        offsets = [self.starttime if label == time_label else 0 for label in selection]
+        self.plot_offsets = np.repeat(offsets, 2)
+        for (line, ax, y_offset) in ((self.the_line1, self.ax1, offsets[1]), (self.the_line2, self.ax2, offsets[2]), (self.the_line3, self.ax3, offsets[3])):
+            line.set_transform(matplotlib.transforms.Affine2D().translate(-offsets[0], -y_offset) + ax.transData)
+
+    def update_plot(self):
+        """show the new data. Only the rows added since the last update are looked at (to keep the running extremes),
+        and the lines only get about two points per pixel of the visible range (see hardware.Decimation),
+        so this takes about as long after hours of data as after a few seconds.
+        This is self.renderer's prepare step, so it runs on the main loop: call self.renderer.request() instead.
+        Returns whether the axes changed (so the whole figure needs redrawing, not just the lines)"""
+        redraw_axes = False
+        selection = (self.data_x_label_var.get(), self.data_y1_label_var.get(), self.data_y2_label_var.get(), self.data_y3_label_var.get())
+        if (selection != self.plot_selection or self.data.first_index != self.plot_first_index
+                or self.data.total_rows < self.plot_next_index):
+            # the axes changed, old rows were pushed out of memory, or the store was reset: start over with what's in memory
+            self._start_plot_over(selection)
+            redraw_axes = True
         try:
-            data_x = np.array([elt[data_x_label_var] for elt in self.data])
-            data_y1 = np.array([elt[data_y1_label_var] for elt in self.data])
-            data_y2 = np.array([elt[data_y2_label_var] for elt in self.data])
-            data_y3 = np.array([elt[data_y3_label_var] for elt in self.data])
-            if data_x_label_var == self.elveflow_handler.header[0]:
-                data_x -= self.starttime
-            if data_y1_label_var == self.elveflow_handler.header[0]:
-                data_y1 -= self.starttime
-            if data_y2_label_var == self.elveflow_handler.header[0]:
-                data_y2 -= self.starttime
-            if data_y3_label_var == self.elveflow_handler.header[0]:
-                data_y3 -= self.starttime
-            extremes = [np.nanmin(data_x), np.nanmax(data_x), np.nanmin(data_y1), np.nanmax(data_y1), np.nanmin(data_y2), np.nanmax(data_y2), np.nanmin(data_y3), np.nanmax(data_y3)]
-            if len(data_x) > 0:
-                # https://stackoverflow.com/questions/4098131/how-to-update-a-plot-in-matplotlib/4098938#4098938
-                self.the_line1.set_data(data_x, data_y1)
-                self.the_line2.set_data(data_x, data_y2)
-                self.the_line3.set_data(data_x, data_y3)
+            # these are views into the store, so never modify them in place
+            first, new_columns = self.data.tail(self.plot_next_index, *selection)
+            self.plot_next_index = first + len(new_columns[0])
+            if len(new_columns[0]) > 0:
+                # fmin/fmax skip NaNs (without warning about all-NaN columns)
+                for i, column in enumerate(new_columns):
+                    self.plot_extremes[2*i] = np.fmin(self.plot_extremes[2*i], np.fmin.reduce(column))
+                    self.plot_extremes[2*i+1] = np.fmax(self.plot_extremes[2*i+1], np.fmax.reduce(column))
         except (ValueError, KeyError):
-            extremes = [*self.ax1.get_xlim(), *self.ax1.get_ylim(), *self.ax2.get_ylim(), *self.ax3.get_ylim()]
-        if extremes[1] - extremes[0] == 0:
-            extremes[1] += 1
-        if extremes[3] - extremes[2] == 0:
-            extremes[3] += 1
-        if extremes[5] - extremes[4] == 0:
-            extremes[5] += 1
-        if extremes[7] - extremes[6] == 0:
-            extremes[7] += 1
+            pass
+        extremes = list(self.plot_extremes - self.plot_offsets)
+        current = [*self.ax1.get_xlim(), *self.ax1.get_ylim(), *self.ax2.get_ylim(), *self.ax3.get_ylim()]
+        for i in range(0, 8, 2):
+            if not (np.isfinite(extremes[i]) and np.isfinite(extremes[i+1])):
+                # nothing (valid) to show yet
+                extremes[i:i+2] = current[i:i+2]
+            elif extremes[i+1] - extremes[i] == 0:
+                extremes[i+1] += 1
 
         limits = [item if item is not None else extremes[i]
                   for (i, item) in enumerate(self.axisLimits_numbers)]
-        self.ax1.set_xlim(*limits[0:2])
-        self.ax1.set_ylim(*limits[2:4])
-        self.ax2.set_ylim(*limits[4:6])
-        self.ax3.set_ylim(*limits[6:8])
-
-        # HACK:
-        # self.canvas.draw doesn't shut down properly for whatever reason when clicking the exit button
-        # so instead, spawn a daemon thread (a thread that automatically dies at the end of the program -
-        # we haven't been using them elsewhere because they don't allow for graceful exiting/handling of
-        # acquired resources, but I think it shouldn't matter if we crash-exit drawing to the screen
-        # because we're closing the screen anyway, even if it becomes corrupted)
-        def thisIsDumb():
-            self.canvas.draw()
-        tempThread = threading.Thread(target=thisIsDumb, daemon=True)
-        tempThread.start()
-
-        # also update the main tab's sheath pressure display
-        # TODO!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!
+        if limits != self.applied_limits:
+            self.ax1.set_xlim(*limits[0:2])
+            self.ax1.set_ylim(*limits[2:4])
+            self.ax2.set_ylim(*limits[4:6])
+            self.ax3.set_ylim(*limits[6:8])
+            self.applied_limits = limits
+            redraw_axes = True
+
         try:
-            self.maingui.initialize_sheath_display_var.set('Sheath pressure:\n%d' % self.data[-1][
-                "Pressure %s [mbar]" %
-                (FileIO.ELVEFLOW_DATA_COLUMNS["Pressure 1 [mbar]"] + int(self.elveflow_config["elveflow_sheath_channel"]) - 1)
-                ])
-        except IndexError:
+            # https://stackoverflow.com/questions/4098131/how-to-update-a-plot-in-matplotlib/4098938#4098938
+            x_range = (self.applied_limits[0] + self.plot_offsets[0], self.applied_limits[1] + self.plot_offsets[0])
+            n_buckets = max(int(self.ax1.bbox.width), 1)
+            for line, y_label in ((self.the_line1, selection[1]), (self.the_line2, selection[2]), (self.the_line3, selection[3])):
+                line.set_data(*self.decimation.view(selection[0], y_label, x_range, n_buckets, self.plot_x_sorted))
+        except (ValueError, KeyError):
             pass
+        return redraw_axes
 
     def start_pressure(self, channel=1, isPressure=True):
         i = channel - 1
         pressureValue = self.pressureValue_var[i]
+        self.flow_set.pop(channel, None)
         self.setPressureStop_flag[i] = threading.Event()
         self.setPressureStop_flag[i].clear()
         try:
@@ -452,27 +519,9 @@ class ElveflowDisplay(tk.Canvas):
                     self.errorlogger.error("Channel %d flow meter is not turned on" % channel)
                     self.pressureSettingActive_var[i].set(False)
                     return
-                try:
-                    kp = float(self.kp_var.get())
-                    self.kp_var.set(str(kp))
-                except ValueError:
-                    kp = 0
-                    self.kp_var.set("0.0")
-                try:
-                    ki = float(self.ki_var.get())
-                    self.ki_var.set(str(ki))
-                except ValueError:
-                    ki = 0
-                    self.ki_var.set("0.0")
-                try:
-                    kd = float(self.kd_var.get())
-                    self.kd_var.set(str(kd))
-                except ValueError:
-                    kd = 0
-                    self.kd_var.set("0.0")
                 flowrate_to_set = int(float(pressureValue.get()))
                 pressureValue.set(str(flowrate_to_set))
-                self.elveflow_handler.set_volume_loop(channel, flowrate_to_set, interrupt_event=self.setPressureStop_flag[i], pid_constants=(kp, ki, kd))
+                self.elveflow_handler.set_volume_loop(channel, flowrate_to_set, interrupt_event=self.setPressureStop_flag[i], pid_constants=self.get_pid_constants(channel))
         except ValueError:
             self.errorlogger.error("unknown value for channel %i (pressure value is %r)" % (channel, pressureValue.get()))
             pressureValue.set("")
@@ -482,6 +531,7 @@ class ElveflowDisplay(tk.Canvas):
         '''stop changing the pressure. Pressure-controlled systems will remain at whatever value it is currently set at;
         volume-controlled systems will drop to zero pressure'''
         i = channel - 1
+        self.flow_set.pop(channel, None)
         # self.errorlogger.info('Stopping Elveflow Channel %d', channel)
         try:
             self.setPressureStop_flag[i].set()
@@ -489,14 +539,15 @@ class ElveflowDisplay(tk.Canvas):
             pass
 
     def run_volume(self, channel=1, target=0, margin=0.15, stable_time=2):
-        """run a volume PID loop until you are within +/- margin of the target
-        for at least stable_time (in seconds) amount of time.
+        """run a volume PID loop until the flow rate is steady within +/- margin of the target
+        over a window of stable_time (in seconds).
 
         Unlike start_pressure(isPressure=False), this stops when it reaches the
         target and blocks until then.
         """
         i = channel - 1
         pressureValue = self.pressureValue_var[i]
+        self.flow_set.pop(channel, None)
         self.setPressureStop_flag[i] = threading.Event()
         self.setPressureStop_flag[i].clear()
 
@@ -504,6 +555,38 @@ class ElveflowDisplay(tk.Canvas):
             self.errorlogger.error("Channel %d flow meter is not turned on" % channel)
             self.pressureSettingActive_var[i].set(False)
             return
+        self.pressureValue_var[i].set(target)
+        pressureValue.set(str(target))
+        end_pressure = self.elveflow_handler.run_volume(channel, target, interrupt_event=self.setPressureStop_flag[i], pid_constants=self.get_pid_constants(channel), margin=margin, stable_time=stable_time)
+        self.errorlogger.info("Done setting the pressure in Channel %s to %.3f (time to steady state: %s s)" %
+                              (channel, end_pressure, self.elveflow_handler.time_to_steady_state.get(channel)))
+        self.pressureValue_var[i].set(round(end_pressure))
+        if not self.setPressureStop_flag[i].is_set():
+            self.flow_set[channel] = target
+
+    def dump_sdk_stats(self):
+        """log how long the Elveflow SDK calls have been taking and how often they failed, and save all the
+        details (histograms, slow calls) as JSON in the output folder"""
+        if self.elveflow_handler is None:
+            self.errorlogger.error("The Elveflow isn't connected")
+            return
+        self.errorlogger.info("Elveflow SDK calls since connecting:\n%s" % '\n'.join(self.elveflow_handler.instrumentation.summary()))
+        filename = os.path.join(ElveflowDisplay.OUTPUT_FOLDER, "sdk_stats_%d.json" % time.time())
+        try:
+            self.elveflow_handler.instrumentation.write_dump(filename)
+            self.errorlogger.info("Saved the SDK call statistics to %s" % filename)
+        except OSError as e:
+            self.errorlogger.error("Could not save the SDK call statistics to %s: %s" % (filename, e))
+
+    def get_pid_constants(self, channel=1):
+        """the PID constants typed into the P, I, D boxes; or, if "Use autotuned P, I, D" is ticked and there are
+        autotuned ones in the config for this channel's current sensor type, those"""
+        if self.useAutotuned_var.get():
+            key = ElveflowDisplay.PID_CONFIG_KEY % (channel, self.elveflow_config.get('sensor%i_type' % channel, 'none'))
+            try:
+                return tuple(float(x) for x in self.elveflow_config[key].split(','))
+            except (KeyError, ValueError):
+                self.errorlogger.warning("Channel %d hasn't been autotuned for this sensor; using the P, I, D boxes" % channel)
         try:
             kp = float(self.kp_var.get())
             self.kp_var.set(str(kp))
@@ -522,11 +605,36 @@ class ElveflowDisplay(tk.Canvas):
         except ValueError:
             kd = 0
             self.kd_var.set("0.0")
-        self.pressureValue_var[i].set(target)
-        pressureValue.set(str(target))
-        end_pressure = self.elveflow_handler.run_volume(channel, target, interrupt_event=self.setPressureStop_flag[i], pid_constants=(kp, ki, kd), margin=margin, stable_time=stable_time)
-        self.errorlogger.info("Done setting the pressure in Channel %s to %.3f" % (channel, end_pressure))
-        self.pressureValue_var[i].set(round(end_pressure))
+        return (kp, ki, kd)
+
+    def set_pid_boxes(self, kp, ki, kd):
+        self.kp_var.set('%.6g' % kp)
+        self.ki_var.set('%.6g' % ki)
+        self.kd_var.set('%.6g' % kd)
+
+    def autotune(self, channel=1):
+        """in a new thread, autotune the flow rate PID constants of a channel around the flow rate typed into its box,
+        store them in the config for this channel and sensor type, and put them in the P, I, D boxes"""
+        i = channel - 1
+        sensor_type = self.elveflow_config.get('sensor%i_type' % channel, 'none')
+        if sensor_type == "none":
+            self.errorlogger.error("Channel %d flow meter is not turned on" % channel)
+            return
+        try:
+            target = float(self.pressureValue_var[i].get())
+        except ValueError:
+            self.errorlogger.error("Type the flow rate to autotune channel %d around into its box first" % channel)
+            return
+        self.stop_pressure(channel)
+        self.setPressureStop_flag[i] = threading.Event()
+
+        def autotune_thread():
+            result = self.elveflow_handler.autotune_volume(channel, target, interrupt_event=self.setPressureStop_flag[i])
+            if result is None:
+                return
+            self.elveflow_config[ElveflowDisplay.PID_CONFIG_KEY % (channel, sensor_type)] = ', '.join('%.6g' % x for x in result['pid constants'])
+            self.after(0, self.set_pid_boxes, *result['pid constants'])  # Tk variables belong to the main thread
+        threading.Thread(target=autotune_thread, daemon=True).start()
 
     def set_axis_limits(self):
         for i, x in enumerate(self.axisLimits_var):
@@ -537,7 +645,7 @@ class ElveflowDisplay(tk.Canvas):
             except ValueError:
                 x.set("")
                 self.axisLimits_numbers[i] = None
-        self.update_plot() # just, like, don't do this and also close the program at the same time
+        self.renderer.request(full=True)
 
 class Toggle(tk.Label):
     # https://www.reddit.com/r/learnpython/comments/7sx953/how_to_add_a_toggle_switch_in_tkinter/